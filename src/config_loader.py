@@ -4,6 +4,7 @@ import shutil
 import logging
 import configparser
 
+from lazy_loader import LazySingleton
 from logging_utils import logger_factory
 
 
@@ -52,4 +53,4 @@ class ConfigLoader(object):
             raise ValueError('Missing value for required field "{}"'.format(field))
 
 
-config = ConfigLoader().get_config()
+config = LazySingleton('config', lambda: ConfigLoader().get_config())
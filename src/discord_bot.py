@@ -1,66 +1,112 @@
+import io
+import os
+import sys
+import time
 import asyncio
-import requests
 import logging
-from typing import Optional, Union
+import math
+from typing import Callable, Optional, Sequence, Union
 
-import numpy
-import cv2
 import discord
 from discord.ext import commands as disc_commands
 
+from lazy_loader import startup_profiler
 from config_loader import config
 from logging_utils import logger_factory
+from metrics import QUEUE_DEPTH, STAGE_SECONDS, MetricsServer, metrics
+from live_profiler import ProfilerBusyError, live_profiler
+from loop_watchdog import loop_watchdog
 from simple_data_saver import simple_saver
 from basic_utils import BasicUtils
 from shared_constants import HeroTown
-from tip_recognizer import Tip, TipRecognizer
-from stonk_sheet_querier import StonkSheetQuerier
-from stonk_sheet_updater import StonkSheetUpdater
+from tip_recognizer import Tip
+from vision_quota import VisionDeferredError, vision_quota
+from stonk_sheet_base import SheetTimeoutError
+from stonk_sheet_querier import PriceChange, StonkSheetQuerier
+from price_snapshots import PriceSnapshotStore
+from sheet_profiles import SheetProfileRouter
+from image_archive import image_archive
+from image_memory_budget import image_memory_budget
+from tip_pipeline import TipPipeline, TipPipelineResult
+from tip_job_queue import TipJob, TipJobDispatcher, TipJobFailedError, TipJobQueue, TipJobResult
+from tip_worker import TipWorkerSupervisor
 from discord_paginator import Page, PageGenerator, PageNavigator
 
 
 class FailedURLsPages(PageGenerator):
    EMBED_COLOR = discord.Color.red()
+   # Max total size of the images attached to a page, under Discord's upload limit.
+   MAX_ATTACHED_SIZE = 8 * 1024 * 1024
 
-   def __init__(self, failed_urls: list[str], urls_per_page: int) -> None:
+   def __init__(self, failed_urls: Sequence[str], urls_per_page: int) -> None:
       super().__init__()
-      # Make a copy since original list will be cleared afterward.
-      self._failed_urls = [url for url in failed_urls]
+      # Only the URLs of the displayed page are ever read from the store.
+      self._failed_urls = failed_urls
       self._urls_per_page = urls_per_page
-      self._pages = []
-      self._make_pages()
-
-   def get_pages(self) -> list[Page]:
-      return self._pages
-
-   def _make_pages(self) -> None:
-      if self._failed_urls:
-         self._pages = self._make_failed_urls_pages()
+      # Failed images are attached from the image archive, so they can be reviewed even once their
+      # links expired.
+      self._attach_images = image_archive.enabled
+
+   def get_page_count(self) -> int:
+      return max(math.ceil(len(self._failed_urls) / self._urls_per_page), 1)
+
+   def get_page(self, page_idx: int) -> Page:
+      if len(self._failed_urls) == 0:
+         return self._make_default_page()
+      return self._make_failed_urls_page(page_idx)
+
+   def _make_failed_urls_page(self, page_idx: int) -> Page:
+      start = page_idx * self._urls_per_page
+      urls = self._failed_urls[start:start + self._urls_per_page]
+      lines = []
+      files = None
+      if self._attach_images:
+         files = []
+         attached_size = 0
+         for url in urls:
+            filepath = image_archive.get_file(url)
+            if (filepath is None) or (attached_size + os.path.getsize(filepath) > self.MAX_ATTACHED_SIZE):
+               lines.append('<{}>'.format(url))
+               continue
+            attached_size += os.path.getsize(filepath)
+            filename = 'fail-{}{}'.format(start + len(files) + 1, os.path.splitext(filepath)[1])
+            lines.append('<{}> ({})'.format(url, filename))
+            files.append(discord.File(filepath, filename=filename))
       else:
-         self._pages = [self._make_default_page()]
-
-   def _make_failed_urls_pages(self) -> list[Page]:
-      pages = []
-      failed_urls_for_pages = BasicUtils.split_list_to_chunks(
-         self._failed_urls, self._urls_per_page)
-      page_count = len(failed_urls_for_pages)
-      for idx, urls in enumerate(failed_urls_for_pages):
-         page_number = idx + 1
-         embed_content = '\n'.join(['<{}>'.format(url) for url in urls])
-         embed = discord.Embed(description=embed_content, color=self.EMBED_COLOR)
-         embed.set_footer(text='Displayed {} in {} URLs. Page {}/{}'.format(
-            len(urls), len(self._failed_urls), page_number, page_count))
-         pages.append(Page(embed=embed))
-      return pages
+         lines = ['<{}>'.format(url) for url in urls]
+      embed = discord.Embed(description='\n'.join(lines), color=self.EMBED_COLOR)
+      embed.set_footer(text='Displayed {} in {} URLs. Page {}/{}'.format(
+         len(urls), len(self._failed_urls), page_idx + 1, self.get_page_count()))
+      return Page(embed=embed, files=files)
 
    def _make_default_page(self) -> Page:
       embed = discord.Embed(description='No new failed image so far.', color=self.EMBED_COLOR)
       embed.set_footer(text='Page 1/1')
-      return Page(embed=embed)
+      return Page(embed=embed, files=[] if self._attach_images else None)
+
+
+class FailedURLsNavigator(PageNavigator):
+   def __init__(self, generator: PageGenerator, author_id: int, curr_page: int,
+                on_page_changed: Callable[[int, int], None]) -> None:
+      super().__init__(generator, author_id, persistent=True, curr_page=curr_page)
+      self._on_page_changed_callback = on_page_changed
+
+   async def _on_page_changed(self, interaction: discord.Interaction) -> None:
+      self._on_page_changed_callback(interaction.message.id, self.get_curr_page())
 
 
 class TipProcessingCog(disc_commands.Cog):
-   FAILED_URLS_SAVE_KEY = 'failed-urls'
+   # Pile of failed URLs of a (guild, channel), saved as a list of items.
+   FAILED_URLS_SAVE_KEY = 'failed-urls-{}-{}'
+   # All piles saved as a single value by older versions.
+   LEGACY_FAILED_URLS_SAVE_KEY = 'failed-urls'
+   # Failed URLs moved out of the pile by a ";fails" command, displayed by a navigator.
+   FAILED_URLS_BATCH_SAVE_KEY = 'failed-urls-batch-{}'
+   # State of navigators which should keep working after a restart, by message ID.
+   FAILS_NAVIGATORS_SAVE_KEY = 'failed-urls-navigators'
+   # Tip messages deferred by the Vision quota, as (channel ID, message ID, reason, retry time) items.
+   # Items saved by older versions have no reason nor retry time.
+   DEFERRED_MESSAGES_SAVE_KEY = 'vision-deferred-messages'
    DEFAULT_REACTION_EMOJI = '✅'
    DEFAULT_ERR_REACTION_EMOJI = '❌'
    EMBED_COLOR = discord.Color.blue()
@@ -69,7 +115,9 @@ class TipProcessingCog(disc_commands.Cog):
                 prod_privileged_guilds: list[int], allowed_channels: list[str],
                 should_mention_roles: bool, mention_roles: list[str], reaction_emoji: int,
                 err_reaction_emoji: int, mention_author: bool, history_messages_limit: int,
-                failed_urls_per_page: int) -> None:
+                failed_urls_per_page: int, max_saved_fails_navigators: int, deferred_retry_interval: float,
+                tip_job_queue: Optional[TipJobQueue], tip_job_poll_interval: float,
+                sheet_profile_router: SheetProfileRouter) -> None:
       self.bot = bot
       self._log = log
       self._prod_mode = prod_mode
@@ -84,10 +132,35 @@ class TipProcessingCog(disc_commands.Cog):
       self._mention_author = mention_author
       self._history_messages_limit = history_messages_limit
       self._failed_urls_per_page = failed_urls_per_page
-      self._failed_urls = simple_saver.load_key(
-         self.FAILED_URLS_SAVE_KEY, {})
-      self._tip_recognizer = TipRecognizer()
-      self._sheet_updater = StonkSheetUpdater()
+      self._max_saved_fails_navigators = max_saved_fails_navigators
+      self._migrate_legacy_failed_urls()
+      self._fails_navigators = simple_saver.load_key(
+         self.FAILS_NAVIGATORS_SAVE_KEY, {})
+      self._fails_navigators_restored = False
+      self._deferred_retry_interval = deferred_retry_interval
+      self._deferred_retry_task = None
+      self._sheet_profile_router = sheet_profile_router
+      # Tips are read here, or by the tip workers when the queue is given (split deployment).
+      self._tip_pipeline = None
+      self._tip_job_dispatcher = None
+      if tip_job_queue is None:
+         self._tip_pipeline = TipPipeline(sheet_profile_router)
+      else:
+         self._tip_job_dispatcher = TipJobDispatcher(tip_job_queue, tip_job_poll_interval,
+                                                     self._on_orphan_tip_job_result)
+
+   def cog_unload(self) -> None:
+      if self._deferred_retry_task:
+         self._deferred_retry_task.cancel()
+      if self._tip_job_dispatcher:
+         self._tip_job_dispatcher.stop()
+      if self._tip_pipeline:
+         self._tip_pipeline.shutdown()
+
+   def warm_up(self) -> None:
+      # Blocking. Gets the clients and worker processes ready before the first tip comes in.
+      if self._tip_pipeline:
+         self._tip_pipeline.warm_up()
 
    @disc_commands.command()
    async def fails(self, ctx: disc_commands.Context) -> None:
@@ -95,16 +168,38 @@ class TipProcessingCog(disc_commands.Cog):
          return
       channel_name = ctx.channel.name
       guild_id = ctx.guild.id
-      content = FailedURLsPages(self._failed_urls[guild_id][channel_name], self._failed_urls_per_page)
-      self._failed_urls[guild_id][channel_name].clear()
-      simple_saver.save_key(self.FAILED_URLS_SAVE_KEY, self._failed_urls)
-      await PageNavigator(ctx, content.get_pages(), timeout=1800).run()
+      # Move the channel's pile into its own batch, which the navigator reads pages from.
+      batch_id = ctx.message.id
+      simple_saver.move_items(self.FAILED_URLS_SAVE_KEY.format(guild_id, channel_name),
+                              self.FAILED_URLS_BATCH_SAVE_KEY.format(batch_id))
+      navigator = self._make_fails_navigator(batch_id, ctx.author.id, 0)
+      message = await navigator.run(ctx.channel)
+      self._fails_navigators[message.id] = (batch_id, ctx.author.id, 0)
+      self._evict_fails_navigators()
+      simple_saver.save_key(self.FAILS_NAVIGATORS_SAVE_KEY, self._fails_navigators)
+
+   @disc_commands.command()
+   async def usage(self, ctx: disc_commands.Context) -> None:
+      if not self._should_respond_to_command(ctx):
+         return
+      lines = [vision_quota.get_usage_msg(ctx.guild.id),
+               self._tip_pipeline.tip_recognizer.get_ocr_latency_msg() if self._tip_pipeline else
+               'OCR latency: measured by the tip workers.',
+               image_memory_budget.get_usage_msg() if self._tip_pipeline else
+               'Image memory: measured by the tip workers.',
+               'Deferred tip messages: {}.'.format(simple_saver.count_items(self.DEFERRED_MESSAGES_SAVE_KEY))]
+      embed = discord.Embed(description='\n'.join(lines), color=self.EMBED_COLOR)
+      await ctx.message.reply(embed=embed, mention_author=self._mention_author)
 
    @disc_commands.Cog.listener()
    async def on_ready(self) -> None:
+      if not self._fails_navigators_restored:
+         self._restore_fails_navigators()
+      if self._deferred_retry_task is None:
+         self._deferred_retry_task = asyncio.create_task(self._retry_deferred_messages())
+      if self._tip_job_dispatcher:
+         self._tip_job_dispatcher.start()
       for guild in self.bot.guilds:
-         if guild.id not in self._failed_urls:
-            self._failed_urls[guild.id] = {channel: [] for channel in self._allowed_channels}
          for channel in guild.text_channels:
             if channel.name in self._allowed_channels:
                async for message in channel.history(limit=self._history_messages_limit):
@@ -121,25 +216,155 @@ class TipProcessingCog(disc_commands.Cog):
    async def _process_message(self, message: discord.Message) -> None:
       if not self._should_respond_to_message(message):
          return
+      logger_factory.set_correlation_id('msg-{}'.format(message.id))
+      with QUEUE_DEPTH.labels('messages').track_inprogress():
+         await self._process_tip_message(message)
+
+   async def _process_tip_message(self, message: discord.Message) -> None:
       self._log.info('Processing message, id={}, channel="{}", user="{}"'.format(
          message.id, message.channel.name, message.author.name))
-      tips, failed_urls = self._process_attachments(message.attachments)
-      if (len(tips) + len(failed_urls)) == 0:
+      try:
+         image_count = sum(1 for attachment in message.attachments if TipPipeline.is_image(attachment.content_type))
+         if image_count:
+            await asyncio.to_thread(vision_quota.admit, message.guild.id, image_count)
+         result = await self._run_tip_pipeline(message)
+      except VisionDeferredError as e:
+         # Leave the whole message for later, so it is replied to once with all its tips.
+         self._defer_tip_message(message.channel.id, message.id, e)
+         return
+      except TipJobFailedError as e:
+         self._log.error('Failed processing message by tip workers, id={}, reason="{}"'.format(message.id, str(e)))
+         return
+      await self._reply_to_tip_message(message, result)
+
+   async def _run_tip_pipeline(self, message: discord.Message) -> TipPipelineResult:
+      profile_name = self._sheet_profile_router.get_profile(message.guild.id, message.channel.name).name
+      update_sheet = self._should_perform_sensitive_actions(message.guild)
+      if self._tip_job_dispatcher is None:
+         return await self._tip_pipeline.process(profile_name, message.attachments, update_sheet)
+      job = TipJob(message.guild.id, message.channel.id, message.id, profile_name, update_sheet,
+                   [(attachment.url, attachment.content_type, attachment.size) for attachment in message.attachments])
+      return await self._tip_job_dispatcher.run(job)
+
+   async def _reply_to_tip_message(self, message: discord.Message, result: TipPipelineResult) -> None:
+      if (len(result.tips) + len(result.failed_urls)) == 0:
          # Nothing to do.
          return
-      # (Sensitive) Add new tips to stonk sheet.
-      if self._should_perform_sensitive_actions(message.guild):
-         for tip in tips:
-            self._sheet_updater.update_sheet(tip)
       # Add new failed tip images to the channel's pile.
-      if failed_urls:
-         self._failed_urls[message.guild.id][message.channel.name].extend(failed_urls)
-         simple_saver.save_key(self.FAILED_URLS_SAVE_KEY, self._failed_urls)
+      if result.failed_urls:
+         simple_saver.append_items(
+            self.FAILED_URLS_SAVE_KEY.format(message.guild.id, message.channel.name), result.failed_urls)
       # Post reply and react to message.
-      embed = self._get_embed_for_reply(tips, failed_urls, message.guild)
-      emoji = self._get_err_reaction_emoji() if failed_urls else self._get_reaction_emoji()
-      await message.reply(embed=embed, mention_author=self._mention_author)
-      await message.add_reaction(emoji)
+      embed = self._get_embed_for_reply(result.tips, result.duplicate_tips, result.conflicting_tips,
+                                        result.failed_urls, message.guild)
+      has_errors = result.failed_urls or result.conflicting_tips
+      emoji = self._get_err_reaction_emoji() if has_errors else self._get_reaction_emoji()
+      with STAGE_SECONDS.labels('discord_reply').time():
+         await message.reply(embed=embed, mention_author=self._mention_author)
+         await message.add_reaction(emoji)
+      # Let the price change subscribers know right away, rather than on the next periodic check.
+      new_tip_count = len(result.tips) - len(result.duplicate_tips) - len(result.conflicting_tips)
+      if new_tip_count > 0 and self._should_perform_sensitive_actions(message.guild):
+         profile = self._sheet_profile_router.get_profile(message.guild.id, message.channel.name)
+         self.bot.dispatch('stonk_sheet_updated', profile.name)
+
+   async def _on_orphan_tip_job_result(self, job: TipJob, result: TipJobResult) -> None:
+      # Result of a message queued before the bot restarted. Reply to it the same.
+      logger_factory.set_correlation_id('msg-{}'.format(job.message_id))
+      try:
+         pipeline_result = TipJobDispatcher.get_pipeline_result(result)
+      except VisionDeferredError as e:
+         self._defer_tip_message(job.channel_id, job.message_id, e)
+         return
+      except TipJobFailedError as e:
+         self._log.error('Failed processing message by tip workers, id={}, reason="{}"'.format(job.message_id, str(e)))
+         return
+      try:
+         channel = self.bot.get_channel(job.channel_id) or await self.bot.fetch_channel(job.channel_id)
+         message = await channel.fetch_message(job.message_id)
+         # Skipped if replied to meanwhile.
+         if self._should_respond_to_message(message):
+            await self._reply_to_tip_message(message, pipeline_result)
+      except discord.NotFound:
+         return
+      except Exception as e:
+         self._log.error('Failed replying to tip job, id={}, exception="{}"'.format(job.message_id, repr(e)))
+
+   def _defer_tip_message(self, channel_id: int, message_id: int, error: VisionDeferredError) -> None:
+      self._log.warning('Deferred message, id={}, reason="{}", retry_after={:.0f}s'.format(
+         message_id, str(error), error.retry_after))
+      simple_saver.append_items(self.DEFERRED_MESSAGES_SAVE_KEY,
+                                [(channel_id, message_id, str(error), time.time() + error.retry_after)])
+
+   async def _retry_deferred_messages(self) -> None:
+      while True:
+         await asyncio.sleep(self._deferred_retry_interval)
+         if not vision_quota.is_available():
+            continue
+         # Messages deferred until the caps reset or the rate limits let them through again are
+         # left alone until then, rather than fetched only to be deferred again.
+         entries = simple_saver.get_items(self.DEFERRED_MESSAGES_SAVE_KEY)
+         now = time.time()
+         due_entries = [entry for entry in entries if (len(entry) < 4) or (entry[3] <= now)]
+         if not due_entries:
+            continue
+         simple_saver.clear_items(self.DEFERRED_MESSAGES_SAVE_KEY)
+         simple_saver.append_items(self.DEFERRED_MESSAGES_SAVE_KEY,
+                                   [entry for entry in entries if (len(entry) >= 4) and (entry[3] > now)])
+         self._log.info('Retrying deferred messages, count={}, waiting={}'.format(
+            len(due_entries), len(entries) - len(due_entries)))
+         for idx, entry in enumerate(due_entries):
+            if not vision_quota.is_available():
+               # Put the rest back, after any message deferred again meanwhile.
+               simple_saver.append_items(self.DEFERRED_MESSAGES_SAVE_KEY, due_entries[idx:])
+               break
+            channel_id, message_id = entry[:2]
+            try:
+               channel = self.bot.get_channel(channel_id) or await self.bot.fetch_channel(channel_id)
+               message = await channel.fetch_message(message_id)
+               # Skipped if processed meanwhile, e.g. by the history replay after a reconnection.
+               await self._process_message(message)
+            except discord.NotFound:
+               continue
+            except Exception as e:
+               self._log.error('Failed retrying deferred message, id={}, exception="{}"'.format(message_id, repr(e)))
+
+   def _make_fails_navigator(self, batch_id: int, author_id: int, curr_page: int) -> FailedURLsNavigator:
+      failed_urls = simple_saver.get_items_view(self.FAILED_URLS_BATCH_SAVE_KEY.format(batch_id))
+      content = FailedURLsPages(failed_urls, self._failed_urls_per_page)
+      return FailedURLsNavigator(content, author_id, curr_page, self._on_fails_page_changed)
+
+   def _on_fails_page_changed(self, message_id: int, curr_page: int) -> None:
+      if message_id not in self._fails_navigators:
+         return
+      batch_id, author_id, _ = self._fails_navigators[message_id]
+      self._fails_navigators[message_id] = (batch_id, author_id, curr_page)
+      simple_saver.save_key(self.FAILS_NAVIGATORS_SAVE_KEY, self._fails_navigators)
+
+   def _migrate_legacy_failed_urls(self) -> None:
+      legacy_failed_urls = simple_saver.load_key(self.LEGACY_FAILED_URLS_SAVE_KEY)
+      if legacy_failed_urls is None:
+         return
+      for guild_id, channels in legacy_failed_urls.items():
+         for channel_name, failed_urls in channels.items():
+            simple_saver.append_items(self.FAILED_URLS_SAVE_KEY.format(guild_id, channel_name), failed_urls)
+      simple_saver.delete_key(self.LEGACY_FAILED_URLS_SAVE_KEY)
+
+   def _restore_fails_navigators(self) -> None:
+      # Re-attach the navigators to their messages so their buttons work again after a restart.
+      for message_id, (batch_id, author_id, curr_page) in self._fails_navigators.items():
+         # Batches used to be saved as a single value.
+         simple_saver.migrate_key_to_items(self.FAILED_URLS_BATCH_SAVE_KEY.format(batch_id))
+         self.bot.add_view(self._make_fails_navigator(batch_id, author_id, curr_page), message_id=message_id)
+      self._fails_navigators_restored = True
+      self._log.info('Restored failed-URLs navigators, count={}'.format(len(self._fails_navigators)))
+
+   def _evict_fails_navigators(self) -> None:
+      # Only keep the latest navigators. Dicts keep insertion order so the oldest ones come first.
+      while len(self._fails_navigators) > self._max_saved_fails_navigators:
+         message_id = next(iter(self._fails_navigators))
+         batch_id, _, _ = self._fails_navigators.pop(message_id)
+         simple_saver.clear_items(self.FAILED_URLS_BATCH_SAVE_KEY.format(batch_id))
 
    def _should_perform_sensitive_actions(self, guild: discord.Guild) -> bool:
       return (not self._prod_mode) or (guild.id in self._prod_privileged_guilds)
@@ -169,44 +394,27 @@ class TipProcessingCog(disc_commands.Cog):
             return False
       return True
 
-   def _process_attachments(self, attachments: list[discord.Attachment]) -> tuple[list[Tip], list[str]]:
-      tips = []
-      failed_urls = []
-      for attachment in attachments:
-         if not self._is_attached_image(attachment):
-            # Skip non-image attachments.
-            continue
-         image_url = attachment.url
-         image = self._load_attached_image(image_url)
-         if image is None:
-            failed_urls.append(image_url)
-            continue
-         success, tip = self._tip_recognizer.process_tip(image)
-         if success:
-            tip.url = image_url
-            tips.append(tip)
-         else:
-            failed_urls.append(image_url)
-      return tips, failed_urls
-
-   def _is_attached_image(self, attachment: discord.Attachment) -> bool:
-      return attachment.content_type and attachment.content_type.startswith('image/')
-
-   def _load_attached_image(self, url: str) -> Optional[numpy.ndarray]:
-      try:
-         response = requests.get(url, stream=True).raw
-         image_array = numpy.asarray(bytearray(response.read()), dtype='uint8')
-         return cv2.imdecode(image_array, cv2.IMREAD_COLOR)
-      except Exception as e:
-         self._log.error(
-            'Unknown error occurred while fetching image, url="{}", exception="{}"'.format(url, repr(e)))
-         return None
-
-   def _get_embed_for_reply(self, tips: list[Tip], failed_urls: list[str], guild: discord.Guild) -> discord.Embed:
+   def _get_embed_for_reply(self, tips: list[Tip], duplicate_tips: list[Tip],
+                            conflicting_tips: list[tuple[Tip, Tip]], failed_urls: list[str],
+                            guild: discord.Guild) -> discord.Embed:
       embed = discord.Embed(color=self.EMBED_COLOR)
-      if tips:
-         lines = [tip.to_string() for tip in tips]
+      conflicting_ids = {id(tip) for tip, _ in conflicting_tips}
+      duplicate_ids = {id(tip) for tip in duplicate_tips}
+      success_tips = [tip for tip in tips if id(tip) not in conflicting_ids]
+      if success_tips:
+         lines = []
+         for tip in success_tips:
+            suffix = ' (already recorded)' if id(tip) in duplicate_ids else ''
+            lines.append(tip.to_string() + suffix)
          embed.add_field(name='SUCCESS', value='\n'.join(lines), inline=False)
+      if conflicting_tips:
+         lines = ['{} conflicts with recorded {} from <{}>'.format(
+            tip.to_string(), recorded_tip.to_string(), recorded_tip.url)
+            for tip, recorded_tip in conflicting_tips]
+         lines.append('')  # Separation line.
+         if self._should_mention_roles:
+            lines.append(''.join([role.mention for role in self._get_mention_roles(guild)]))
+         embed.add_field(name='CONFLICT', value='\n'.join(lines), inline=False)
       if failed_urls:
          lines = ['Cannot read <{}>'.format(url) for url in failed_urls]
          lines.append('')  # Separation line.
@@ -238,32 +446,82 @@ class TipProcessingCog(disc_commands.Cog):
 
 class SheetHelperCog(disc_commands.Cog):
    EMBED_COLOR = discord.Color.dark_gray()
+   # Max number of files attached to a message by Discord.
+   MAX_EXPORTED_EVENTS = 10
+   # Price change subscriptions, as (towns, min change percent) by (guild ID, channel ID, user ID).
+   # No towns means all of them, no min change percent means any change.
+   SUBSCRIPTIONS_SAVE_KEY = 'price-change-subscriptions'
+   NOTIFICATIONS = metrics.counter(
+      'price_change_notifications', 'Number of price change notifications sent to the querying channels.')
 
    def __init__(self, bot: disc_commands.Bot, log: logging.Logger,
-                allowed_channels: list[str], mention_author: bool) -> None:
+                allowed_channels: list[str], mention_author: bool, precompute_on_new_turn: bool,
+                new_turn_delay: float, precompute_target_turns: list[int], post_turn_digest: bool,
+                price_watch_interval: float, sheet_profile_router: SheetProfileRouter) -> None:
       self.bot = bot
       self._log = log
       self._allowed_channels = allowed_channels
       self._mention_author = mention_author
-      self._sheet_querier = StonkSheetQuerier()
+      self._precompute_on_new_turn = precompute_on_new_turn
+      self._new_turn_delay = new_turn_delay
+      self._precompute_target_turns = precompute_target_turns
+      self._post_turn_digest = post_turn_digest
+      self._new_turn_tasks = []
+      self._price_watch_interval = price_watch_interval
+      self._price_watch_tasks = []
+      # Set to check a sheet profile's prices right away, by profile name.
+      self._price_watch_events: dict[str, asyncio.Event] = {}
+      self._subscriptions = simple_saver.load_key(self.SUBSCRIPTIONS_SAVE_KEY, {})
+      # One querier per sheet profile. Commands are answered from the sheet of their guild/channel.
+      self._sheet_profile_router = sheet_profile_router
+      self._sheet_queriers = {profile.name: StonkSheetQuerier(profile)
+                              for profile in sheet_profile_router.get_profiles()}
+
+   def warm_up(self) -> None:
+      for profile_name, sheet_querier in self._sheet_queriers.items():
+         try:
+            sheet_querier.warm_up()
+         except Exception as e:
+            self._log.error('Failed opening stonk sheet, profile="{}", exception="{}"'.format(profile_name, repr(e)))
+
+   def cog_unload(self) -> None:
+      for task in self._new_turn_tasks + self._price_watch_tasks:
+         task.cancel()
+
+   @disc_commands.Cog.listener()
+   async def on_ready(self) -> None:
+      if self._precompute_on_new_turn and not self._new_turn_tasks:
+         self._new_turn_tasks = [asyncio.create_task(self._run_new_turns(profile_name, sheet_querier))
+                                 for profile_name, sheet_querier in self._sheet_queriers.items()]
+      if not self._price_watch_tasks:
+         self._price_watch_events = {profile_name: asyncio.Event() for profile_name in self._sheet_queriers}
+         self._price_watch_tasks = [asyncio.create_task(self._watch_price_changes(profile_name, sheet_querier))
+                                    for profile_name, sheet_querier in self._sheet_queriers.items()]
+
+   @disc_commands.Cog.listener()
+   async def on_stonk_sheet_updated(self, profile_name: str) -> None:
+      # Dispatched by TipProcessingCog once it wrote new tips.
+      event = self._price_watch_events.get(profile_name)
+      if event is not None:
+         event.set()
 
    @disc_commands.command()
    async def sheet(self, ctx: disc_commands.Context) -> None:
       if not self._should_respond_to_command(ctx):
          return
-      await self._respond_to_command(ctx, self._sheet_querier.get_sheet_msg())
+      await self._respond_to_command(ctx, await self._get_sheet_querier(ctx).get_sheet_msg())
 
    @disc_commands.command()
    async def round(self, ctx: disc_commands.Context) -> None:
       if not self._should_respond_to_command(ctx):
          return
-      await self._respond_to_command(ctx, self._sheet_querier.get_current_turn_msg())
+      await self._respond_to_command(ctx, self._get_sheet_querier(ctx).get_current_turn_msg())
 
    @disc_commands.command(aliases=['bb'])
    async def bestbuy(self, ctx: disc_commands.Context) -> None:
       if not self._should_respond_to_command(ctx):
          return
-      await self._respond_to_command(ctx, self._sheet_querier.get_best_buy_msg())
+      await self._respond_to_command(ctx, await self._get_sheet_querier(ctx).get_best_buy_msg())
 
    @disc_commands.command(aliases=['tb', 'check'])
    async def targetbuy(self, ctx: disc_commands.Context, *args) -> None:
@@ -291,7 +549,7 @@ class SheetHelperCog(disc_commands.Cog):
          contents.append('Invalid argument(s): {}. Accept positive numbers only.'.format(
             ', '.join(invalid_args)))
       if target_turns:
-         contents.append(self._sheet_querier.get_target_buy_msg(target_turns))
+         contents.append(await self._get_sheet_querier(ctx).get_target_buy_msg(target_turns))
       await self._respond_to_command(ctx, '\n'.join(contents))
 
    @disc_commands.command()
@@ -328,13 +586,219 @@ class SheetHelperCog(disc_commands.Cog):
             ', '.join(invalid_args),
             ', '.join(accepts)))
       if stocks:
-         contents.append(self._sheet_querier.get_tips_msg(stocks))
+         contents.append(await self._get_sheet_querier(ctx).get_tips_msg(stocks))
       await self._respond_to_command(ctx, '\n'.join(contents))
 
+   @disc_commands.command(aliases=['sub'])
+   async def subscribe(self, ctx: disc_commands.Context, *args) -> None:
+      if not self._should_respond_to_command(ctx):
+         return
+      subscription_key = (ctx.guild.id, ctx.channel.id, ctx.author.id)
+      option_accepts_dict = {e.value.lower(): e for e in HeroTown
+                             if e is not HeroTown.UNKNOWN}
+      accepts_msg = 'Accept: all, {}, and a min change like 10%.'.format(', '.join(option_accepts_dict.keys()))
+      if len(args) == 0:
+         subscription = self._subscriptions.get(subscription_key)
+         if subscription is None:
+            await self._respond_to_command(ctx, 'You have no subscription in this channel. {}'.format(accepts_msg))
+         else:
+            await self._respond_to_command(ctx, self._get_subscription_msg(*subscription))
+         return
+
+      stocks = set()
+      min_change_percent = None
+      invalid_args = []
+      for arg in args:
+         if arg == 'all':
+            stocks.update(option_accepts_dict.values())
+         elif arg in option_accepts_dict:
+            stocks.add(option_accepts_dict[arg])
+         elif arg.endswith('%'):
+            try:
+               value = float(arg[:-1])
+               if value > 0:
+                  min_change_percent = value
+               else:
+                  invalid_args.append(arg)
+            except ValueError:
+               invalid_args.append(arg)
+         else:
+            invalid_args.append(arg)
+      if invalid_args:
+         await self._respond_to_command(ctx, 'Invalid argument(s): {}. {}'.format(', '.join(invalid_args), accepts_msg))
+         return
+      # All the towns are the same as none given.
+      if len(stocks) == len(option_accepts_dict):
+         stocks = set()
+      subscription = (tuple(sorted(stock.value for stock in stocks)), min_change_percent)
+      profile_name = self._sheet_profile_router.get_profile(ctx.guild.id, ctx.channel.name).name
+      if not self._get_profile_subscriptions(profile_name) and profile_name in self._price_watch_events:
+         # Not watched without subscribers. Take the current prices as reference right away.
+         self._price_watch_events[profile_name].set()
+      self._subscriptions[subscription_key] = subscription
+      simple_saver.save_key(self.SUBSCRIPTIONS_SAVE_KEY, self._subscriptions)
+      await self._respond_to_command(ctx, self._get_subscription_msg(*subscription))
+
+   @disc_commands.command(aliases=['unsub'])
+   async def unsubscribe(self, ctx: disc_commands.Context) -> None:
+      if not self._should_respond_to_command(ctx):
+         return
+      if self._subscriptions.pop((ctx.guild.id, ctx.channel.id, ctx.author.id), None) is None:
+         await self._respond_to_command(ctx, 'You have no subscription in this channel.')
+         return
+      simple_saver.save_key(self.SUBSCRIPTIONS_SAVE_KEY, self._subscriptions)
+      await self._respond_to_command(ctx, 'You will no longer be notified of new tips in this channel.')
+
+   @disc_commands.command()
+   async def export(self, ctx: disc_commands.Context) -> None:
+      if not self._should_respond_to_command(ctx):
+         return
+      # Read from the saved price data only, no call to the sheet.
+      profile = self._sheet_profile_router.get_profile(ctx.guild.id, ctx.channel.name)
+      snapshots = await asyncio.to_thread(self._get_sheet_querier(ctx).get_snapshots)
+      if not snapshots:
+         await self._respond_to_command(ctx, 'No saved price data so far.')
+         return
+      snapshots = snapshots[-self.MAX_EXPORTED_EVENTS:]
+      files = [discord.File(io.BytesIO(PriceSnapshotStore.to_csv(snapshot).encode('utf-8')),
+                            filename='stonks-{}-{}.csv'.format(profile.name, snapshot.starting_time))
+               for snapshot in snapshots]
+      content = 'Price data of the last {} event(s), one file per event.'.format(len(snapshots))
+      embed = discord.Embed(color=self.EMBED_COLOR)
+      embed.add_field(name='', value=content, inline=False)
+      with STAGE_SECONDS.labels('discord_reply').time():
+         await ctx.message.reply(embed=embed, files=files, mention_author=self._mention_author)
+
+   async def cog_command_error(self, ctx: disc_commands.Context, error: disc_commands.CommandError) -> None:
+      original = getattr(error, 'original', error)
+      self._log.error('Failed handling command, command="{}", exception="{}"'.format(
+         ctx.command.qualified_name if ctx.command else '', repr(original)))
+      if isinstance(original, SheetTimeoutError):
+         await self._respond_to_command(ctx, 'The stonk sheet is not responding. Please try again later.')
+
    async def _respond_to_command(self, ctx: disc_commands.Context, content: str) -> None:
       embed = discord.Embed(color=self.EMBED_COLOR)
       embed.add_field(name='', value=content, inline=False)
-      await ctx.message.reply(embed=embed, mention_author=self._mention_author)
+      with STAGE_SECONDS.labels('discord_reply').time():
+         await ctx.message.reply(embed=embed, mention_author=self._mention_author)
+
+   async def _run_new_turns(self, profile_name: str, sheet_querier: StonkSheetQuerier) -> None:
+      # Right after a new turn starts, many members ask the same questions. Answer them all at once.
+      while True:
+         seconds_to_next_turn = sheet_querier.get_seconds_to_next_turn()
+         if seconds_to_next_turn is None:
+            return
+         await asyncio.sleep(seconds_to_next_turn + self._new_turn_delay)
+         try:
+            best_buy_msg, tips_msg = await sheet_querier.precompute_answers(self._precompute_target_turns)
+         except Exception as e:
+            self._log.error('Failed precomputing answers of new turn, profile="{}", exception="{}"'.format(
+               profile_name, repr(e)))
+            continue
+         self._log.info('Precomputed answers of new turn, profile="{}"'.format(profile_name))
+         if self._post_turn_digest:
+            await self._send_turn_digest(profile_name, best_buy_msg, tips_msg)
+
+   async def _send_turn_digest(self, profile_name: str, best_buy_msg: str, tips_msg: str) -> None:
+      embed = discord.Embed(color=self.EMBED_COLOR)
+      embed.add_field(name='BEST BUY', value=best_buy_msg, inline=False)
+      embed.add_field(name='TIPS', value=tips_msg, inline=False)
+      for guild in self.bot.guilds:
+         for channel in list(guild.text_channels) + list(guild.threads):
+            if channel.name not in self._allowed_channels:
+               continue
+            if self._sheet_profile_router.get_profile(guild.id, channel.name).name != profile_name:
+               continue
+            try:
+               with STAGE_SECONDS.labels('discord_reply').time():
+                  await channel.send(embed=embed)
+            except Exception as e:
+               self._log.error('Failed sending turn digest, channel="{}", exception="{}"'.format(
+                  channel.name, repr(e)))
+
+   async def _watch_price_changes(self, profile_name: str, sheet_querier: StonkSheetQuerier) -> None:
+      # At most one sheet fetch per check, whatever the number of subscribers, instead of each of
+      # them polling ";tips". Checked periodically, and right after the bot wrote new tips.
+      event = self._price_watch_events[profile_name]
+      while True:
+         try:
+            await asyncio.wait_for(event.wait(), self._price_watch_interval)
+         except asyncio.TimeoutError:
+            pass
+         # Data fetched by the commands since the last check is reused, unless new tips were just written.
+         max_age = 0 if event.is_set() else self._price_watch_interval
+         event.clear()
+         if not self._get_profile_subscriptions(profile_name):
+            # Nobody to notify, so no fetch. Changes meanwhile are not notified to the next subscribers.
+            sheet_querier.reset_price_changes()
+            continue
+         try:
+            changes = await sheet_querier.get_price_changes(max_age)
+         except Exception as e:
+            self._log.error('Failed checking price changes, profile="{}", exception="{}"'.format(
+               profile_name, repr(e)))
+            continue
+         if changes:
+            self._log.info('Found price changes, profile="{}", count={}'.format(profile_name, len(changes)))
+            await self._notify_subscribers(profile_name, sheet_querier, changes)
+
+   async def _notify_subscribers(self, profile_name: str, sheet_querier: StonkSheetQuerier,
+                                 changes: list[PriceChange]) -> None:
+      # A single message per channel for all the changes found at once, mentioning its subscribers
+      # interested in any of them.
+      channel_notifications = {}
+      for channel, user_id, hero_town_names, min_change_percent in self._get_profile_subscriptions(profile_name):
+         matched_changes = [change for change in changes
+                            if self._is_subscribed_change(change, hero_town_names, min_change_percent)]
+         if not matched_changes:
+            continue
+         _, user_ids, channel_changes = channel_notifications.setdefault(channel.id, (channel, [], set()))
+         user_ids.append(user_id)
+         channel_changes.update(matched_changes)
+      for channel, user_ids, channel_changes in channel_notifications.values():
+         # In the order found.
+         channel_changes = [change for change in changes if change in channel_changes]
+         embed = discord.Embed(color=self.EMBED_COLOR)
+         embed.add_field(name='NEW TIPS', value=sheet_querier.get_price_changes_msg(channel_changes)[:1024],
+                         inline=False)
+         try:
+            with STAGE_SECONDS.labels('discord_reply').time():
+               await channel.send(' '.join('<@{}>'.format(user_id) for user_id in user_ids), embed=embed)
+            self.NOTIFICATIONS.inc()
+         except Exception as e:
+            self._log.error('Failed sending price change notification, channel="{}", exception="{}"'.format(
+               channel.name, repr(e)))
+
+   def _get_profile_subscriptions(self, profile_name: str
+                                  ) -> list[tuple[discord.abc.Messageable, int, tuple[str, ...], Optional[float]]]:
+      # (Channel, user ID, towns, min change percent) of the subscriptions to the given sheet profile.
+      subscriptions = []
+      for (guild_id, channel_id, user_id), (hero_town_names, min_change_percent) in self._subscriptions.items():
+         channel = self.bot.get_channel(channel_id)
+         if channel is None:
+            continue
+         if self._sheet_profile_router.get_profile(guild_id, channel.name).name != profile_name:
+            continue
+         subscriptions.append((channel, user_id, hero_town_names, min_change_percent))
+      return subscriptions
+
+   @staticmethod
+   def _is_subscribed_change(change: PriceChange, hero_town_names: tuple[str, ...],
+                             min_change_percent: Optional[float]) -> bool:
+      if hero_town_names and (change.hero_town_name not in hero_town_names):
+         return False
+      if min_change_percent is None:
+         return True
+      return (change.change_percent is not None) and (abs(change.change_percent) >= min_change_percent)
+
+   def _get_subscription_msg(self, hero_town_names: tuple[str, ...], min_change_percent: Optional[float]) -> str:
+      return 'You will be notified of new tips for {}{} in this channel.'.format(
+         ', '.join(hero_town_names) or 'all stocks',
+         '' if min_change_percent is None else ' changing by {:g}% or more'.format(min_change_percent))
+
+   def _get_sheet_querier(self, ctx: disc_commands.Context) -> StonkSheetQuerier:
+      profile = self._sheet_profile_router.get_profile(ctx.guild.id, ctx.channel.name)
+      return self._sheet_queriers[profile.name]
 
    def _should_respond_to_command(self, ctx: disc_commands.Context) -> bool:
       if ctx.channel.name not in self._allowed_channels:
@@ -343,19 +807,85 @@ class SheetHelperCog(disc_commands.Cog):
       return True
 
 
+class ProfilingCog(disc_commands.Cog):
+   EMBED_COLOR = discord.Color.dark_gold()
+   # Profile files larger than this are not attached to the reply, only saved on the host.
+   MAX_ATTACHMENT_SIZE = 8 * 1024 * 1024
+
+   def __init__(self, bot: disc_commands.Bot, log: logging.Logger, prod_mode: bool,
+                prod_privileged_guilds: list[int], profiling_roles: list[str], mention_author: bool) -> None:
+      self.bot = bot
+      self._log = log
+      self._prod_mode = prod_mode
+      self._prod_privileged_guilds = prod_privileged_guilds
+      self._profiling_roles = profiling_roles
+      self._mention_author = mention_author
+
+   @disc_commands.command()
+   async def profile(self, ctx: disc_commands.Context, duration: Optional[float] = None) -> None:
+      if not self._should_respond_to_command(ctx):
+         return
+      if live_profiler.is_running():
+         await self._respond_to_command(ctx, 'Already profiling. Please wait for it to finish.')
+         return
+      duration = min(duration or live_profiler.default_duration, live_profiler.max_duration)
+      await self._respond_to_command(ctx, 'Profiling for {} seconds.'.format(duration))
+      try:
+         report = await live_profiler.profile(duration)
+      except ProfilerBusyError as e:
+         await self._respond_to_command(ctx, str(e))
+         return
+      files = [discord.File(filepath) for filepath in (report.folded_file, report.report_file)
+               if os.path.getsize(filepath) <= self.MAX_ATTACHMENT_SIZE]
+      content = '```\n{}\n```'.format('\n'.join(report.summary)[:1000])
+      await self._respond_to_command(ctx, content, files)
+
+   @disc_commands.command()
+   async def blocking(self, ctx: disc_commands.Context) -> None:
+      if not self._should_respond_to_command(ctx):
+         return
+      if not loop_watchdog.enabled:
+         await self._respond_to_command(ctx, 'The event loop watchdog is disabled.')
+         return
+      content = '```\n{}\n```'.format('\n'.join(loop_watchdog.get_report())[:1000])
+      await self._respond_to_command(ctx, content)
+
+   async def _respond_to_command(self, ctx: disc_commands.Context, content: str,
+                                 files: Sequence[discord.File] = ()) -> None:
+      embed = discord.Embed(color=self.EMBED_COLOR)
+      embed.add_field(name='', value=content, inline=False)
+      await ctx.message.reply(embed=embed, files=list(files), mention_author=self._mention_author)
+
+   def _should_respond_to_command(self, ctx: disc_commands.Context) -> bool:
+      if ctx.guild is None:
+         return False
+      if self._prod_mode and (ctx.guild.id not in self._prod_privileged_guilds):
+         # Only privileged guilds may profile the production bot.
+         return False
+      if not any(role.name in self._profiling_roles for role in ctx.author.roles):
+         # Ignore commands from members without the profiling-roles.
+         return False
+      return True
+
+
 class DiscordBot(object):
    CONFIG_SECTION = 'discord-bot'
+   COMMAND_SECONDS = metrics.histogram(
+      'command_seconds', 'Latency of handling a command in seconds.', ('command',))
 
    def __init__(self) -> None:
       self._setup_logging()
       self._prod_mode = config.getboolean(self.CONFIG_SECTION, 'prod_mode')
+      self._metrics_server = MetricsServer()
+      self._command_start_times = {}
+      self._warm_up_tasks = []
+      self._tip_worker_supervisor = None
       asyncio.get_event_loop().run_until_complete(self._setup_discord_bot())
 
    def run(self) -> None:
-      self._bot.run(self._auth_token,
-         log_handler=logger_factory.handler,
-         log_formatter=logger_factory.formatter,
-         log_level=logging.INFO)
+      # Route discord.py's own logs through the shared non-blocking handler.
+      logger_factory.get_logger('discord').setLevel(logging.INFO)
+      self._bot.run(self._auth_token, log_handler=None)
 
    def _setup_logging(self) -> None:
       self._log = logger_factory.get_logger('discord-bot')
@@ -369,6 +899,11 @@ class DiscordBot(object):
       self._bot = disc_commands.Bot(
          command_prefix=config.get(self.CONFIG_SECTION, 'command_prefix'),
          intents=intents)
+      # Things that must run on the bot's own event loop are only started once it is running.
+      self._bot.setup_hook = self._setup_hook
+      self._bot.add_listener(self._on_ready, 'on_ready')
+      self._bot.before_invoke(self._before_command)
+      self._bot.after_invoke(self._after_command)
       # Setup TipProcessingCog.
       prod_privileged_guilds = BasicUtils.get_int_list_from_csv(
          config.get(self.CONFIG_SECTION, 'prod_privileged_guilds'))
@@ -380,11 +915,71 @@ class DiscordBot(object):
       mention_author = config.getboolean(self.CONFIG_SECTION, 'mention_author')
       history_messages_limit = config.getint(self.CONFIG_SECTION, 'history_messages_limit')
       failed_urls_per_page = config.getint(self.CONFIG_SECTION, 'failed_urls_per_page')
-      await self._bot.add_cog(TipProcessingCog(
-         self._bot, self._log, self._prod_mode, prod_privileged_guilds, tip_posting_channels,
-         should_mention_roles, tip_mention_roles, tip_reaction_emoji, tip_err_reaction_emoji,
-         mention_author, history_messages_limit, failed_urls_per_page))
+      max_saved_fails_navigators = config.getint(self.CONFIG_SECTION, 'max_saved_fails_navigators')
+      deferred_retry_interval = config.getfloat('vision-quota', 'retry_interval')
+      # Split deployment: tip messages are queued for the tip worker processes.
+      tip_job_queue = None
+      if config.getboolean('tip-workers', 'enabled'):
+         tip_job_queue = TipJobQueue(config.getfloat('tip-workers', 'job_lease_seconds'),
+                                     config.getint('tip-workers', 'max_job_attempts'))
+         self._tip_worker_supervisor = TipWorkerSupervisor()
+      tip_job_poll_interval = config.getfloat('tip-workers', 'poll_interval')
+      # Both cogs route guilds/channels to their stonk sheet the same way.
+      sheet_profile_router = SheetProfileRouter()
+      with startup_profiler.step('init TipProcessingCog'):
+         await self._bot.add_cog(TipProcessingCog(
+            self._bot, self._log, self._prod_mode, prod_privileged_guilds, tip_posting_channels,
+            should_mention_roles, tip_mention_roles, tip_reaction_emoji, tip_err_reaction_emoji,
+            mention_author, history_messages_limit, failed_urls_per_page, max_saved_fails_navigators,
+            deferred_retry_interval, tip_job_queue, tip_job_poll_interval, sheet_profile_router))
       # Setup SheetHelperCog.
       tip_querying_channels = BasicUtils.get_list_from_csv(config.get(self.CONFIG_SECTION, 'tip_querying_channels'))
-      await self._bot.add_cog(SheetHelperCog(
-         self._bot, self._log, tip_querying_channels, mention_author))
+      precompute_on_new_turn = config.getboolean('stonk-sheet-querier', 'precompute_on_new_turn')
+      new_turn_delay = config.getfloat('stonk-sheet-querier', 'new_turn_delay')
+      precompute_target_turns = BasicUtils.get_int_list_from_csv(
+         config.get('stonk-sheet-querier', 'precompute_target_turns'))
+      post_turn_digest = config.getboolean('stonk-sheet-querier', 'post_turn_digest')
+      price_watch_interval = config.getfloat('stonk-sheet-querier', 'price_watch_interval')
+      with startup_profiler.step('init SheetHelperCog'):
+         await self._bot.add_cog(SheetHelperCog(
+            self._bot, self._log, tip_querying_channels, mention_author, precompute_on_new_turn,
+            new_turn_delay, precompute_target_turns, post_turn_digest, price_watch_interval,
+            sheet_profile_router))
+      # Setup ProfilingCog.
+      profiling_roles = BasicUtils.get_list_from_csv(config.get(self.CONFIG_SECTION, 'profiling_roles'))
+      await self._bot.add_cog(ProfilingCog(
+         self._bot, self._log, self._prod_mode, prod_privileged_guilds, profiling_roles, mention_author))
+
+   async def _setup_hook(self) -> None:
+      loop_watchdog.start()
+      await self._metrics_server.start()
+      if self._tip_worker_supervisor:
+         self._tip_worker_supervisor.start()
+      # Clients and worker processes are started lazily. Get them ready in the background while
+      # logging in, rather than on the first tip or command.
+      for cog in self._bot.cogs.values():
+         if hasattr(cog, 'warm_up'):
+            self._warm_up_tasks.append(asyncio.create_task(self._warm_up_cog(cog)))
+
+   async def _warm_up_cog(self, cog: disc_commands.Cog) -> None:
+      try:
+         with startup_profiler.step('warm up {}'.format(cog.qualified_name)):
+            await asyncio.to_thread(cog.warm_up)
+      except Exception:
+         # Not fatal. The same work is retried on first use.
+         self._log.exception('Failed warming up, cog={}'.format(cog.qualified_name))
+
+   async def _on_ready(self) -> None:
+      if startup_profiler.is_enabled() and startup_profiler.mark_ready():
+         report = '\n'.join(startup_profiler.get_report())
+         self._log.info(report)
+         print(report, file=sys.stderr)
+
+   async def _before_command(self, ctx: disc_commands.Context) -> None:
+      logger_factory.set_correlation_id('cmd-{}'.format(ctx.message.id))
+      self._command_start_times[ctx.message.id] = time.perf_counter()
+
+   async def _after_command(self, ctx: disc_commands.Context) -> None:
+      start_time = self._command_start_times.pop(ctx.message.id, None)
+      if start_time is not None:
+         self.COMMAND_SECONDS.labels(ctx.command.qualified_name).observe(time.perf_counter() - start_time)
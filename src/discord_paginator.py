@@ -1,25 +1,33 @@
 import abc
-from typing import Optional
+from typing import Optional, Sequence
 
 import discord
-from discord.ext import commands as disc_commands
 
 
 class Page(object):
    def __init__(self, content: Optional[str] = None,
-                embed: Optional[discord.Embed] = None) -> None:
+                embed: Optional[discord.Embed] = None, files: Optional[Sequence[discord.File]] = None) -> None:
       self.content = content
       self.embed = embed
+      # Files attached to the page. Pages of a generator should all have files or none of them, since
+      # the attachments of the previous page are only replaced by the files of the new one.
+      self.files = files
 
 
 class PageGenerator(abc.ABC):
+   # Pages are rendered on demand, so a generator should never need to build all of them upfront.
    @abc.abstractmethod
-   def get_pages(self) -> list[Page]:
-      return []
+   def get_page_count(self) -> int:
+      return 0
+
+   @abc.abstractmethod
+   def get_page(self, page_idx: int) -> Page:
+      return Page()
 
 
 class PageNavigator(discord.ui.View):
    NAV_BTN_STYLE = discord.ButtonStyle.gray
+   NAV_BTN_CUSTOM_ID_PREFIX = 'page-navigator'
 
    NAV_BTN_NEXT_PAGE_INAME = 'next-page'
    NAV_BTN_NEXT_PAGE_EMOJI = '▶️'
@@ -33,14 +41,19 @@ class PageNavigator(discord.ui.View):
    NAV_BTN_LAST_PAGE_INAME = 'last-page'
    NAV_BTN_LAST_PAGE_EMOJI = '⏭️'
 
-   def __init__(self, ctx: disc_commands.Context, pages: list[Page], timeout: Optional[float] = None) -> None:
-      super().__init__(timeout=timeout)
-      self._ctx = ctx
-      self._pages = pages
+   def __init__(self, generator: PageGenerator, author_id: int, timeout: Optional[float] = None,
+                persistent: bool = False, curr_page: int = 0) -> None:
+      # A persistent navigator keeps working after a restart once re-registered with the bot,
+      # which requires it to never time out.
+      super().__init__(timeout=None if persistent else timeout)
+      self._generator = generator
+      self._author_id = author_id
+      self._persistent = persistent
       self._nav_btns = {}
-      self._curr_page = 0
-      self._max_page = len(self._pages) - 1
+      self._max_page = max(self._generator.get_page_count() - 1, 0)
+      self._curr_page = min(max(curr_page, 0), self._max_page)
       self._setup_nav_btns()
+      self._update_nav_btns_state()
 
    def _setup_nav_btns(self) -> None:
       self._register_nav_btn(self.NAV_BTN_FIRST_PAGE_INAME, self._onclick_first_page,
@@ -53,8 +66,10 @@ class PageNavigator(discord.ui.View):
          self.NAV_BTN_LAST_PAGE_EMOJI)
 
    def _register_nav_btn(self, intra_name: str, callback, emoji: str, disabled: bool = False) -> None:
+      # Persistent views are matched to their message by (message ID, custom ID).
+      custom_id = '{}:{}'.format(self.NAV_BTN_CUSTOM_ID_PREFIX, intra_name) if self._persistent else None
       nav_btn = discord.ui.Button(
-         style=self.NAV_BTN_STYLE, emoji=emoji, disabled=disabled)
+         style=self.NAV_BTN_STYLE, emoji=emoji, disabled=disabled, custom_id=custom_id)
       nav_btn.callback = callback
       self._nav_btns[intra_name] = nav_btn
       self.add_item(nav_btn)
@@ -75,16 +90,27 @@ class PageNavigator(discord.ui.View):
       self._curr_page = self._max_page
       await self._update_message(interaction)
 
-   async def run(self) -> None:
-      page = self._pages[self._curr_page]
+   def get_curr_page(self) -> int:
+      return self._curr_page
+
+   async def run(self, channel: discord.abc.Messageable) -> discord.Message:
+      page = self._generator.get_page(self._curr_page)
       self._update_nav_btns_state()
-      await self._ctx.channel.send(content=page.content, embed=page.embed, view=self)
+      return await channel.send(content=page.content, embed=page.embed, files=page.files, view=self)
 
    async def _update_message(self, interaction: discord.Interaction) -> None:
-      page = self._pages[self._curr_page]
+      page = self._generator.get_page(self._curr_page)
       self._update_nav_btns_state()
-      await interaction.message.edit(content=page.content, embed=page.embed, view=self)
+      if page.files is None:
+         await interaction.message.edit(content=page.content, embed=page.embed, view=self)
+      else:
+         await interaction.message.edit(content=page.content, embed=page.embed, attachments=page.files, view=self)
       await interaction.response.defer()
+      await self._on_page_changed(interaction)
+
+   async def _on_page_changed(self, interaction: discord.Interaction) -> None:
+      # Subclasses can override this to e.g. save the navigator's state.
+      pass
 
    def _update_nav_btns_state(self) -> None:
       self._nav_btns[self.NAV_BTN_FIRST_PAGE_INAME].disabled = self._is_at_first_page()
@@ -100,4 +126,4 @@ class PageNavigator(discord.ui.View):
 
    async def interaction_check(self, interaction: discord.Interaction) -> bool:
       # Allow only the user which invoked the command to be able to use the interaction.
-      return interaction.user == self._ctx.author
+      return interaction.user.id == self._author_id
@@ -0,0 +1,202 @@
+import os
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+from typing import Optional
+
+from lazy_loader import LazySingleton
+from config_loader import config
+from logging_utils import logger_factory
+from metrics import metrics
+
+
+class ImageArchive(object):
+   # Tip images downloaded from Discord, kept on disk so they can be processed again without the
+   # network, even once their links expired. Images are stored once per content (SHA-256 of the
+   # downloaded data), as downloaded (re-encoding costs far more than locating the tips), and
+   # looked up by the URL they came from.
+   # The least recently used images are evicted past a max total size.
+   CONFIG_SECTION = 'image-archive'
+   INDEX_FILE = 'index.sqlite3'
+   # Fraction of the max size the archive is brought down to when evicting, so eviction doesn't
+   # happen again on every new image.
+   EVICTION_TARGET = 0.9
+   # File extension by image header. Older versions re-encoded every image to WebP.
+   FILE_EXTS = ((b'\x89PNG', '.png'), (b'\xff\xd8', '.jpg'), (b'RIFF', '.webp'), (b'GIF8', '.gif'))
+   UNKNOWN_FILE_EXT = '.img'
+   LOOKUPS = metrics.counter(
+      'image_archive_lookups', 'Number of attachments looked up in the image archive, by result.', ('result',))
+   SIZE_BYTES = metrics.gauge('image_archive_bytes', 'Total size of the archived images in bytes.')
+
+   def __init__(self) -> None:
+      self._setup_logging()
+      self.enabled = config.getboolean(self.CONFIG_SECTION, 'enabled')
+      self._directory = os.path.join(os.environ['ROOT_DIR'], config.get(self.CONFIG_SECTION, 'directory'))
+      self._max_size = config.getfloat(self.CONFIG_SECTION, 'max_size_mb') * 1024 * 1024
+      self._lock = threading.Lock()
+      self._conn = None
+      if self.enabled:
+         self._connect()
+
+   @staticmethod
+   def get_digest(image_data: bytes) -> str:
+      return hashlib.sha256(image_data).hexdigest()
+
+   @classmethod
+   def get_file_ext(cls, image_data: bytes) -> str:
+      for header, ext in cls.FILE_EXTS:
+         if image_data[:len(header)] == header:
+            return ext
+      return cls.UNKNOWN_FILE_EXT
+
+   @staticmethod
+   def get_url_key(url: str) -> str:
+      # Discord signs its attachment links with query parameters which change over time.
+      return url.split('?', 1)[0]
+
+   def load(self, url: str) -> Optional[bytes]:
+      # Archived image downloaded from the given URL, if any.
+      filepath = self.get_file(url)
+      if filepath is None:
+         return None
+      try:
+         with open(filepath, 'rb') as file:
+            return file.read()
+      except OSError as e:
+         self._log.error('Failed reading archived image, path="{}", exception="{}"'.format(filepath, repr(e)))
+         return None
+
+   def get_file(self, url: str) -> Optional[str]:
+      if not self.enabled:
+         return None
+      with self._lock:
+         row = self._conn.execute('SELECT digest FROM urls WHERE url = ?', (self.get_url_key(url),)).fetchone()
+         if row is None:
+            self.LOOKUPS.labels('miss').inc()
+            return None
+         filepath = self._find_path(row[0])
+         if filepath is None:
+            # Removed from outside. Forget about it.
+            self._delete_images_locked([row[0]])
+            self.LOOKUPS.labels('miss').inc()
+            return None
+         with self._conn:
+            self._conn.execute('UPDATE images SET last_used = ? WHERE digest = ?', (time.time(), row[0]))
+      self.LOOKUPS.labels('hit').inc()
+      return filepath
+
+   def get_files(self) -> list[tuple[str, str]]:
+      # (URL, file path) of every archived image, most recently used first.
+      if not self.enabled:
+         return []
+      with self._lock:
+         rows = self._conn.execute(
+            'SELECT urls.url, images.digest FROM urls JOIN images ON urls.digest = images.digest '
+            'ORDER BY images.last_used DESC').fetchall()
+      files = []
+      for url, digest in rows:
+         filepath = self._find_path(digest)
+         if filepath is not None:
+            files.append((url, filepath))
+      return files
+
+   def get_new_file(self, digest: str, image_data: bytes) -> Optional[str]:
+      # Path the given image should be written to, or None if it is already archived.
+      with self._lock:
+         row = self._conn.execute('SELECT 1 FROM images WHERE digest = ?', (digest,)).fetchone()
+      if row is not None:
+         return None
+      filepath = self._get_path(digest, self.get_file_ext(image_data))
+      os.makedirs(os.path.dirname(filepath), exist_ok=True)
+      return filepath
+
+   def add(self, url: str, digest: str) -> None:
+      # Records an image written to the path given by get_new_file(), or already archived, as
+      # downloaded from the given URL.
+      filepath = self._find_path(digest)
+      if filepath is None:
+         return
+      size = os.path.getsize(filepath)
+      with self._lock:
+         with self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO images (digest, size, last_used) VALUES (?, ?, ?)',
+                               (digest, size, time.time()))
+            self._conn.execute('INSERT OR REPLACE INTO urls (url, digest) VALUES (?, ?)',
+                               (self.get_url_key(url), digest))
+         self._evict_locked()
+      self._log.debug('Archived image, digest="%s", size=%d, url="%s"', digest, size, url)
+
+   def discard(self, digest: str) -> None:
+      # Removes the image written to the path given by get_new_file(), if it is not to be archived.
+      with self._lock:
+         row = self._conn.execute('SELECT 1 FROM images WHERE digest = ?', (digest,)).fetchone()
+         filepath = self._find_path(digest)
+         if (row is None) and (filepath is not None):
+            try:
+               os.remove(filepath)
+            except FileNotFoundError:
+               pass
+
+   def _evict_locked(self) -> None:
+      total_size = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM images').fetchone()[0]
+      if total_size > self._max_size:
+         evicted_digests = []
+         evicted_size = 0
+         target_size = self._max_size * self.EVICTION_TARGET
+         for digest, size in self._conn.execute('SELECT digest, size FROM images ORDER BY last_used'):
+            if total_size - evicted_size <= target_size:
+               break
+            evicted_digests.append(digest)
+            evicted_size += size
+         self._delete_images_locked(evicted_digests)
+         total_size -= evicted_size
+         self._log.info('Evicted archived images, count={}, size={}'.format(len(evicted_digests), evicted_size))
+      self.SIZE_BYTES.set(total_size)
+
+   def _delete_images_locked(self, digests: list[str]) -> None:
+      with self._conn:
+         for digest in digests:
+            self._conn.execute('DELETE FROM images WHERE digest = ?', (digest,))
+            self._conn.execute('DELETE FROM urls WHERE digest = ?', (digest,))
+      for digest in digests:
+         filepath = self._find_path(digest)
+         try:
+            if filepath is not None:
+               os.remove(filepath)
+         except FileNotFoundError:
+            pass
+
+   def _get_path(self, digest: str, ext: str) -> str:
+      # Spread over sub-directories, so none of them holds too many files.
+      return os.path.join(self._directory, digest[:2], digest + ext)
+
+   def _find_path(self, digest: str) -> Optional[str]:
+      # The extension depends on the image format, which the index doesn't keep.
+      for ext in [ext for _, ext in self.FILE_EXTS] + [self.UNKNOWN_FILE_EXT]:
+         filepath = self._get_path(digest, ext)
+         if os.path.exists(filepath):
+            return filepath
+      return None
+
+   def _connect(self) -> None:
+      os.makedirs(self._directory, exist_ok=True)
+      # Shared with the tip workers of the split deployment.
+      self._conn = sqlite3.connect(os.path.join(self._directory, self.INDEX_FILE), timeout=30,
+                                   check_same_thread=False)
+      self._conn.execute('PRAGMA journal_mode=WAL')
+      with self._conn:
+         self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS images (digest TEXT PRIMARY KEY, size INTEGER NOT NULL, '
+            'last_used REAL NOT NULL)')
+         self._conn.execute('CREATE INDEX IF NOT EXISTS images_last_used ON images (last_used)')
+         self._conn.execute('CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, digest TEXT NOT NULL)')
+         self._conn.execute('CREATE INDEX IF NOT EXISTS urls_digest ON urls (digest)')
+
+   def _setup_logging(self) -> None:
+      self._log = logger_factory.get_logger('image-archive')
+      self._log.setLevel(logging.INFO)
+
+
+image_archive = LazySingleton('image_archive', ImageArchive)
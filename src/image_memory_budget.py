@@ -0,0 +1,188 @@
+import time
+import struct
+import asyncio
+import logging
+import contextlib
+from typing import AsyncIterator, Optional
+
+from lazy_loader import LazySingleton
+from config_loader import config
+from logging_utils import logger_factory
+from metrics import STAGE_SECONDS, metrics
+from vision_quota import VisionDeferredError
+
+
+class ImageMemoryDeferredError(VisionDeferredError):
+   pass
+
+
+class MemoryReservation(object):
+   def __init__(self, budget: 'ImageMemoryBudget') -> None:
+      self._budget = budget
+      self.size = 0
+      self.is_admitted = False
+
+   async def resize(self, size: int) -> None:
+      # Waits for the budget if growing.
+      await self._budget._resize(self, size)
+
+
+class ImageMemoryBudget(object):
+   # Bounds the memory held by the images in flight: downloaded data, its copy shared with the
+   # image workers, and the decoded image with the full-size copies made while locating the tips.
+   # Images wait for their share of the budget before being downloaded (attachment size), then
+   # before being decoded (dimensions read from the image header). Messages whose images waited
+   # too long are deferred.
+   CONFIG_SECTION = 'image-memory-budget'
+   # Bytes per pixel of the decoded (BGR) image.
+   DECODED_PIXEL_SIZE = 3
+   # Decoded over encoded size, assumed for images whose dimensions can't be read from the header.
+   FALLBACK_DECODED_RATIO = 10
+   JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+   IN_FLIGHT_BYTES = metrics.gauge('image_memory_in_flight_bytes', 'Memory reserved by the images in flight.')
+   PEAK_BYTES = metrics.gauge('image_memory_peak_bytes', 'Peak memory reserved by the images in flight.')
+   DEFERRED = metrics.counter(
+      'image_memory_deferred', 'Number of images deferred after waiting for the memory budget.')
+
+   def __init__(self) -> None:
+      self._setup_logging()
+      self.enabled = config.getboolean(self.CONFIG_SECTION, 'enabled')
+      self.max_bytes = int(config.getfloat(self.CONFIG_SECTION, 'max_in_flight_mb') * 1024 * 1024)
+      self._decoded_copies = config.getint(self.CONFIG_SECTION, 'decoded_copies')
+      self._max_wait = config.getfloat(self.CONFIG_SECTION, 'max_wait')
+      self.in_flight_bytes = 0
+      self.peak_bytes = 0
+      # Admitted reservations, oldest first.
+      self._reservations: list[MemoryReservation] = []
+      self._waiters: list[asyncio.Future] = []
+
+   @contextlib.asynccontextmanager
+   async def reserve(self, size: int) -> AsyncIterator[MemoryReservation]:
+      # Raises ImageMemoryDeferredError if the budget stayed exhausted for too long.
+      reservation = MemoryReservation(self)
+      try:
+         await self._resize(reservation, size)
+         yield reservation
+      finally:
+         self._release(reservation)
+
+   def get_image_cost(self, image_data: bytes) -> int:
+      dimensions = self.get_image_dimensions(image_data)
+      if dimensions is None:
+         decoded_size = len(image_data) * self.FALLBACK_DECODED_RATIO
+      else:
+         decoded_size = dimensions[0] * dimensions[1] * self.DECODED_PIXEL_SIZE
+      return 2 * len(image_data) + decoded_size * self._decoded_copies
+
+   def get_usage_msg(self) -> str:
+      return 'Image memory: {:.0f} MB in flight, peak {:.0f} MB of {:.0f} MB budget.'.format(
+         self.in_flight_bytes / 1024 / 1024, self.peak_bytes / 1024 / 1024, self.max_bytes / 1024 / 1024)
+
+   @classmethod
+   def get_image_dimensions(cls, image_data: bytes) -> Optional[tuple[int, int]]:
+      # (Width, height) read from the header of PNG, JPEG and WebP images, without decoding them.
+      if image_data[:8] == b'\x89PNG\r\n\x1a\n' and len(image_data) >= 24:
+         return struct.unpack('>II', image_data[16:24])
+      if image_data[:2] == b'\xff\xd8':
+         return cls._get_jpeg_dimensions(image_data)
+      if image_data[:4] == b'RIFF' and image_data[8:12] == b'WEBP' and len(image_data) >= 30:
+         chunk = image_data[12:16]
+         if chunk == b'VP8X':
+            return (1 + int.from_bytes(image_data[24:27], 'little'), 1 + int.from_bytes(image_data[27:30], 'little'))
+         if chunk == b'VP8L':
+            bits = int.from_bytes(image_data[21:25], 'little')
+            return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+         if chunk == b'VP8 ':
+            width, height = struct.unpack('<HH', image_data[26:30])
+            return width & 0x3FFF, height & 0x3FFF
+      return None
+
+   @classmethod
+   def _get_jpeg_dimensions(cls, image_data: bytes) -> Optional[tuple[int, int]]:
+      idx = 2
+      while idx + 9 <= len(image_data):
+         if image_data[idx] != 0xFF:
+            return None
+         marker = image_data[idx + 1]
+         if marker == 0xFF:
+            # Fill byte.
+            idx += 1
+            continue
+         if marker in cls.JPEG_SOF_MARKERS:
+            height, width = struct.unpack('>HH', image_data[idx + 5:idx + 9])
+            return width, height
+         if (marker == 0x01) or (0xD0 <= marker <= 0xD8):
+            # Markers without a segment.
+            idx += 2
+            continue
+         idx += 2 + struct.unpack('>H', image_data[idx + 2:idx + 4])[0]
+      return None
+
+   async def _resize(self, reservation: MemoryReservation, size: int) -> None:
+      extra = size - reservation.size
+      if self.enabled and extra > 0 and not self._can_admit(reservation, extra):
+         await self._wait_for_budget(reservation, extra)
+      self.in_flight_bytes += extra
+      reservation.size = size
+      if not reservation.is_admitted:
+         reservation.is_admitted = True
+         self._reservations.append(reservation)
+      if self.in_flight_bytes > self.peak_bytes:
+         self.peak_bytes = self.in_flight_bytes
+         self.PEAK_BYTES.set(self.peak_bytes)
+      self.IN_FLIGHT_BYTES.set(self.in_flight_bytes)
+      if extra < 0:
+         self._wake_waiters()
+
+   def _can_admit(self, reservation: MemoryReservation, extra: int) -> bool:
+      if self.in_flight_bytes + extra <= self.max_bytes:
+         return True
+      # The oldest image always goes on, so images larger than the budget, or growing once
+      # downloaded, can't wait on each other forever.
+      return (not self._reservations) or (self._reservations[0] is reservation)
+
+   async def _wait_for_budget(self, reservation: MemoryReservation, extra: int) -> None:
+      loop = asyncio.get_running_loop()
+      start = time.perf_counter()
+      deadline = loop.time() + self._max_wait
+      while not self._can_admit(reservation, extra):
+         timeout = deadline - loop.time()
+         waiter = loop.create_future()
+         self._waiters.append(waiter)
+         try:
+            if timeout <= 0:
+               raise asyncio.TimeoutError()
+            await asyncio.wait_for(waiter, timeout)
+         except asyncio.TimeoutError:
+            self.DEFERRED.inc()
+            self._log.warning('Image memory budget exhausted, in_flight={}, requested={}, waited={:.1f}s'.format(
+               self.in_flight_bytes, extra, time.perf_counter() - start))
+            raise ImageMemoryDeferredError('Image memory budget exhausted') from None
+         finally:
+            if waiter in self._waiters:
+               self._waiters.remove(waiter)
+      STAGE_SECONDS.labels('memory_wait').observe(time.perf_counter() - start)
+
+   def _release(self, reservation: MemoryReservation) -> None:
+      if reservation.is_admitted:
+         self._reservations.remove(reservation)
+         reservation.is_admitted = False
+      self.in_flight_bytes -= reservation.size
+      reservation.size = 0
+      self.IN_FLIGHT_BYTES.set(self.in_flight_bytes)
+      self._wake_waiters()
+
+   def _wake_waiters(self) -> None:
+      # Each of them checks again whether it fits.
+      waiters = self._waiters
+      self._waiters = []
+      for waiter in waiters:
+         if not waiter.done():
+            waiter.set_result(None)
+
+   def _setup_logging(self) -> None:
+      self._log = logger_factory.get_logger('image-memory-budget')
+      self._log.setLevel(logging.INFO)
+
+
+image_memory_budget = LazySingleton('image_memory_budget', ImageMemoryBudget)
@@ -0,0 +1,230 @@
+import os
+import time
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from typing import Optional
+
+from lazy_loader import startup_profiler
+from config_loader import config
+from logging_utils import LoggingUtils, logger_factory
+from metrics import QUEUE_DEPTH, STAGE_SECONDS, metrics
+from simple_data_saver import simple_saver
+from tip_image_locator import OpenCVError, TipImageLocator
+from tip_prefilter import NotATipError, TipPreFilter
+
+
+# Locator and pre-filter owned by each worker process, created once by the pool's initializer.
+_worker_locator: Optional[TipImageLocator] = None
+_worker_prefilter: Optional[TipPreFilter] = None
+
+
+class TipExtractionResult(object):
+   # Sent back by the worker processes. Images rejected by the pre-filter have no tip image, only
+   # the reason of their rejection.
+   def __init__(self, durations: dict[str, float], tip_image: Optional[bytes] = None,
+                tip_regions: Optional[list[tuple[int, int, int, int]]] = None, profile: str = '',
+                threshold: Optional[int] = None, reject_reason: Optional[str] = None, archive_error: Optional[str] = None
+                ) -> None:
+      # Stage durations are measured in the worker since the metrics live in the main process.
+      self.durations = durations
+      self.tip_image = tip_image
+      self.tip_regions = tip_regions or []
+      self.profile = profile
+      self.threshold = threshold
+      self.reject_reason = reject_reason
+      # An image not written to the archive is simply not archived, the error is only logged.
+      self.archive_error = archive_error
+
+
+def _init_worker(log_queue: multiprocessing.Queue) -> None:
+   global _worker_locator, _worker_prefilter
+   LoggingUtils.forward_to_parent(log_queue)
+   _worker_locator = TipImageLocator()
+   _worker_prefilter = TipPreFilter()
+
+
+def _extract_tip_image_in_worker(shm_name: str, data_size: int, preferred_thresholds: dict[str, int],
+                                 archive_file: Optional[str]) -> TipExtractionResult:
+   # Attach to the buffer filled by the main process instead of receiving the raw image data
+   # through pickling. The decoded image never leaves this process, only the (much smaller)
+   # encoded tip image is sent back, with all the tips found stacked in it.
+   # Tip images are also written to the image archive as received, if given a file for it.
+   durations = {}
+   start = time.perf_counter()
+   shm = shared_memory.SharedMemory(name=shm_name)
+   image_data = shm.buf[:data_size]
+   try:
+      # JPEG images are checked by the pre-filter before being decoded, the others once decoded
+      # since their reduced decode costs as much as the full one.
+      is_checked_before_decode = _worker_prefilter.enabled and _worker_prefilter.is_jpeg(image_data)
+      try:
+         if is_checked_before_decode:
+            _worker_prefilter.check_image(image_data)
+            durations['prefilter'] = time.perf_counter() - start
+            start = time.perf_counter()
+         image = _worker_locator.decode_image(image_data)
+         durations['decode'] = time.perf_counter() - start
+         start = time.perf_counter()
+         if _worker_prefilter.enabled and not is_checked_before_decode:
+            _worker_prefilter.check_decoded_image(image)
+            durations['prefilter'] = time.perf_counter() - start
+            start = time.perf_counter()
+      except NotATipError as e:
+         durations['prefilter'] = time.perf_counter() - start
+         return TipExtractionResult(durations, reject_reason=str(e))
+      decoded = start
+      archive_error = None
+      if archive_file:
+         archive_error = _archive_image(image_data, archive_file)
+         durations['archive'] = time.perf_counter() - decoded
+         decoded = time.perf_counter()
+   finally:
+      # Views into the buffer must be released before it can be closed.
+      image_data.release()
+      shm.close()
+   profile = _worker_locator.get_device_profile(image)
+   tip_images, threshold = _worker_locator.extract_tip_images(image, preferred_thresholds.get(profile))
+   tip_image, tip_regions = _worker_locator.stack_tip_images(tip_images)
+   tip_image = _worker_locator.encode_image(tip_image)
+   durations['locate'] = time.perf_counter() - decoded
+   return TipExtractionResult(durations, tip_image, tip_regions, profile, threshold, archive_error=archive_error)
+
+
+def _pack_tip_images_in_worker(tip_images: list[bytes], max_width: int
+                               ) -> tuple[bytes, list[tuple[int, int]], dict[str, float]]:
+   # Packs the tip images of several attachments into the mosaic read by a single OCR request.
+   start = time.perf_counter()
+   images = [_worker_locator.decode_image(tip_image) for tip_image in tip_images]
+   mosaic, offsets = _worker_locator.pack_tip_images(images, max_width)
+   mosaic = _worker_locator.encode_image(mosaic)
+   return mosaic, offsets, {'pack': time.perf_counter() - start}
+
+
+def _archive_image(image_data: memoryview, archive_file: str) -> Optional[str]:
+   # Returns the error which prevented writing the archive file, if any.
+   tmp_file = '{}.{}.tmp'.format(archive_file, os.getpid())
+   try:
+      # Written aside then moved over, so a crash never leaves a truncated image in the archive.
+      with open(tmp_file, 'wb') as file:
+         file.write(image_data)
+      os.replace(tmp_file, archive_file)
+   except Exception as e:
+      try:
+         os.remove(tmp_file)
+      except FileNotFoundError:
+         pass
+      return repr(e)
+   return None
+
+
+def _warm_up_worker() -> None:
+   pass
+
+
+class ImageWorkerPool(object):
+   CONFIG_SECTION = 'image-worker-pool'
+   # Border threshold which last located a tip, per device profile (i.e. screenshot resolution).
+   TIP_BORDER_THRESHOLDS_SAVE_KEY = 'tip-border-thresholds'
+
+   def __init__(self) -> None:
+      self._setup_logging()
+      self._tip_border_thresholds = simple_saver.load_key(self.TIP_BORDER_THRESHOLDS_SAVE_KEY, {})
+      self._prefilter_results = metrics.counter(
+         'prefilter_results', 'Number of images checked by the tip pre-filter, by result.', ('result',))
+      self._threshold_uses = metrics.counter(
+         'tip_border_threshold_uses', 'Number of tips located with each border threshold.', ('threshold',))
+      # Zero means one worker per available CPU core.
+      self._max_workers = config.getint(self.CONFIG_SECTION, 'max_workers') or os.cpu_count()
+      # Workers are forked from a clean server process rather than from this one, which already
+      # holds the threads of the Google and Discord clients.
+      self._mp_context = multiprocessing.get_context('forkserver')
+      # The heavy imports are done once in the server process rather than in every worker.
+      self._mp_context.set_forkserver_preload(['numpy', 'cv2', __name__])
+      self._start_executor()
+
+   async def extract_tip_image(self, image_data: bytes, archive_file: Optional[str] = None
+                               ) -> tuple[bytes, list[tuple[int, int, int, int]], Optional[tuple[str, int]]]:
+      # Returns the encoded image of all the tips found, the region of each of them, and the device
+      # profile and border threshold which clearly located the latest tip, if any. The threshold
+      # is only worth remembering once the tip is read, see remember_tip_border_threshold().
+      # The screenshot is written to the archive file if given, once known to be a tip.
+      data_size = len(image_data)
+      # Zero-sized shared memory is not allowed. Empty data will fail decoding in the worker anyway.
+      shm = shared_memory.SharedMemory(create=True, size=max(data_size, 1))
+      executor = self._executor
+      try:
+         shm.buf[:data_size] = image_data
+         with QUEUE_DEPTH.labels('image_pool').track_inprogress():
+            future = executor.submit(
+               _extract_tip_image_in_worker, shm.name, data_size, self._tip_border_thresholds, archive_file)
+            result = await asyncio.wrap_future(future)
+         for stage, duration in result.durations.items():
+            STAGE_SECONDS.labels(stage).observe(duration)
+         if result.reject_reason is not None:
+            self._prefilter_results.labels('rejected').inc()
+            raise NotATipError(result.reject_reason)
+         self._prefilter_results.labels('accepted').inc()
+         if result.archive_error is not None:
+            self._log.error('Failed archiving image, path="{}", error="{}"'.format(archive_file, result.archive_error))
+         if result.threshold is None:
+            return result.tip_image, result.tip_regions, None
+         self._threshold_uses.labels(result.threshold).inc()
+         return result.tip_image, result.tip_regions, (result.profile, result.threshold)
+      except BrokenProcessPool:
+         self._restart_broken_executor(executor)
+         raise OpenCVError('Image worker crashed while processing image, size={}'.format(data_size))
+      finally:
+         shm.close()
+         shm.unlink()
+
+   async def pack_tip_images(self, tip_images: list[bytes], max_width: int) -> tuple[bytes, list[tuple[int, int]]]:
+      # Returns the encoded mosaic of the given tip images, and the offset of each of them within it.
+      executor = self._executor
+      try:
+         with QUEUE_DEPTH.labels('image_pool').track_inprogress():
+            future = executor.submit(_pack_tip_images_in_worker, tip_images, max_width)
+            mosaic, offsets, durations = await asyncio.wrap_future(future)
+      except BrokenProcessPool:
+         self._restart_broken_executor(executor)
+         raise OpenCVError('Image worker crashed while packing tip images, count={}'.format(len(tip_images)))
+      for stage, duration in durations.items():
+         STAGE_SECONDS.labels(stage).observe(duration)
+      return mosaic, offsets
+
+   def warm_up(self) -> None:
+      # Starting the first worker also starts the server process, which preloads the heavy imports.
+      with startup_profiler.step('start image worker'):
+         self._executor.submit(_warm_up_worker).result()
+
+   def remember_tip_border_threshold(self, profile: str, threshold: int) -> None:
+      # Tried first on the following screenshots of the same profile.
+      if self._tip_border_thresholds.get(profile) != threshold:
+         # Replaced rather than mutated, since the old dict may still be pickled for a submitted job.
+         self._tip_border_thresholds = dict(self._tip_border_thresholds, **{profile: threshold})
+         simple_saver.save_key(self.TIP_BORDER_THRESHOLDS_SAVE_KEY, self._tip_border_thresholds)
+         self._log.info('Remembered tip border threshold, profile={}, threshold={}'.format(profile, threshold))
+
+   def _restart_broken_executor(self, executor: ProcessPoolExecutor) -> None:
+      # A worker died abruptly (e.g. crashed inside OpenCV). Replace the whole pool so that
+      # following images can still be processed.
+      if executor is self._executor:
+         self._log.error('Image worker pool is broken. Restarting...')
+         self.shutdown()
+         self._start_executor()
+
+   def _start_executor(self) -> None:
+      self._executor = ProcessPoolExecutor(
+         max_workers=self._max_workers, mp_context=self._mp_context, initializer=_init_worker,
+         initargs=(logger_factory.get_child_queue(self._mp_context),))
+      self._log.info('Started image worker pool, max_workers={}'.format(self._max_workers))
+
+   def shutdown(self) -> None:
+      self._executor.shutdown(wait=False, cancel_futures=True)
+
+   def _setup_logging(self) -> None:
+      self._log = logger_factory.get_logger('image-worker-pool')
+      self._log.setLevel(logging.INFO)
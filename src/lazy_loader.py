@@ -0,0 +1,129 @@
+import sys
+import time
+import types
+import builtins
+import importlib
+import threading
+import contextlib
+from typing import Any, Callable, Iterator
+
+
+class StartupProfiler(object):
+   # Measures each import and initialization step until the bot is ready. Only records anything
+   # once enabled, which must happen before the steps to measure are imported.
+   REPORT_MAX_STEPS = 25
+
+   def __init__(self) -> None:
+      self._enabled = False
+      self._start_time = time.perf_counter()
+      self._ready_time = None
+      self._lock = threading.Lock()
+      # Entries of (name, total duration, duration excluding nested steps).
+      self._steps = []
+      # Stack of nested steps' durations per thread, used to compute each step's own duration.
+      self._local = threading.local()
+      self._original_import = builtins.__import__
+
+   def is_enabled(self) -> bool:
+      return self._enabled
+
+   def enable(self) -> None:
+      if self._enabled:
+         return
+      self._enabled = True
+      builtins.__import__ = self._timed_import
+
+   @contextlib.contextmanager
+   def step(self, name: str) -> Iterator[None]:
+      if not self._enabled:
+         yield
+         return
+      if not hasattr(self._local, 'stack'):
+         self._local.stack = []
+      stack = self._local.stack
+      stack.append(0.0)
+      start = time.perf_counter()
+      try:
+         yield
+      finally:
+         duration = time.perf_counter() - start
+         nested_duration = stack.pop()
+         if stack:
+            stack[-1] += duration
+         with self._lock:
+            self._steps.append((name, duration, duration - nested_duration))
+
+   def mark_ready(self) -> bool:
+      # Returns whether this is the first time the bot is ready, i.e. whether to report.
+      with self._lock:
+         if self._ready_time is not None:
+            return False
+         self._ready_time = time.perf_counter()
+         return True
+
+   def get_report(self) -> list[str]:
+      with self._lock:
+         steps = sorted(self._steps, key=lambda e: e[2], reverse=True)
+         ready_time = self._ready_time if self._ready_time is not None else time.perf_counter()
+      lines = ['Startup profile, ready_after={:.3f}s, steps={}'.format(ready_time - self._start_time, len(steps))]
+      lines.append('{:>9} {:>9}  {}'.format('self(s)', 'total(s)', 'step'))
+      for name, duration, self_duration in steps[:self.REPORT_MAX_STEPS]:
+         lines.append('{:>9.3f} {:>9.3f}  {}'.format(self_duration, duration, name))
+      return lines
+
+   def _timed_import(self, name: str, globals=None, locals=None, fromlist=(), level: int = 0) -> types.ModuleType:
+      # Only time the first, absolute import of a module. Others are a dictionary lookup.
+      if level or (name in sys.modules):
+         return self._original_import(name, globals, locals, fromlist, level)
+      with self.step('import {}'.format(name)):
+         return self._original_import(name, globals, locals, fromlist, level)
+
+
+startup_profiler = StartupProfiler()
+
+
+class LazyModule(types.ModuleType):
+   # Stands for a module which is only imported when one of its attributes is first accessed.
+   # The module's attributes are then copied over, so later accesses cost as much as usual.
+   def __getattr__(self, attr: str) -> Any:
+      module = self._load()
+      return getattr(module, attr)
+
+   def _load(self) -> types.ModuleType:
+      module = sys.modules.get(self.__name__)
+      if module is None:
+         with startup_profiler.step('import {}'.format(self.__name__)):
+            module = importlib.import_module(self.__name__)
+      self.__dict__.update(module.__dict__)
+      return module
+
+
+def lazy_import(name: str) -> types.ModuleType:
+   if name in sys.modules:
+      return sys.modules[name]
+   return LazyModule(name)
+
+
+class LazySingleton(object):
+   # Stands for an object which is only created when one of its attributes is first accessed.
+   def __init__(self, name: str, factory: Callable[[], Any]) -> None:
+      object.__setattr__(self, '_lazy_name', name)
+      object.__setattr__(self, '_lazy_factory', factory)
+      object.__setattr__(self, '_lazy_lock', threading.RLock())
+      object.__setattr__(self, '_lazy_instance', None)
+
+   def __getattr__(self, attr: str) -> Any:
+      return getattr(self._get_lazy_instance(), attr)
+
+   def __setattr__(self, attr: str, value: Any) -> None:
+      setattr(self._get_lazy_instance(), attr, value)
+
+   def _get_lazy_instance(self) -> Any:
+      instance = self._lazy_instance
+      if instance is None:
+         with self._lazy_lock:
+            if self._lazy_instance is None:
+               with startup_profiler.step('init {}'.format(self._lazy_name)):
+                  object.__setattr__(self, '_lazy_instance', self._lazy_factory())
+            instance = self._lazy_instance
+      return instance
@@ -0,0 +1,218 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+import functools
+import contextlib
+import tracemalloc
+from collections import Counter
+from typing import Callable, Iterator, Optional
+
+from lazy_loader import LazySingleton
+from config_loader import config
+from logging_utils import logger_factory
+
+
+class ProfilerBusyError(Exception):
+   pass
+
+
+class ProfileReport(object):
+   def __init__(self, duration: float, sample_count: int, folded_file: str, report_file: str,
+                summary: list[str]) -> None:
+      self.duration = duration
+      self.sample_count = sample_count
+      self.folded_file = folded_file
+      self.report_file = report_file
+      self.summary = summary
+
+
+class ProfilingSession(object):
+   # Stacks of all the threads sampled at a fixed interval, and the time spent in the hooked
+   # regions, until stopped.
+   # Python frames at the top of a thread waiting for work. Such samples are dropped, so the
+   # profile only shows where time is actually spent.
+   IDLE_LEAF_FRAMES = {
+      ('selectors.py', 'select'),
+      ('threading.py', 'wait'),
+      ('queue.py', 'get'),
+      ('thread.py', '_worker'),
+      ('handlers.py', 'dequeue'),
+      ('connection.py', '_recv'),
+      ('connection.py', '_poll'),
+      ('process.py', 'wait_result_broken_or_wakeup')
+   }
+
+   def __init__(self, sample_interval: float) -> None:
+      self._sample_interval = sample_interval
+      self._stop_event = threading.Event()
+      self._sampler_thread = threading.Thread(target=self._sample, name='live-profiler', daemon=True)
+      self._lock = threading.Lock()
+      self.stacks = Counter()
+      self.sample_count = 0
+      # Hook name to [call count, total seconds, max seconds].
+      self.hooks = {}
+
+   def start(self) -> None:
+      self._sampler_thread.start()
+
+   def stop(self) -> None:
+      self._stop_event.set()
+      self._sampler_thread.join()
+
+   def record_hook(self, name: str, duration: float) -> None:
+      with self._lock:
+         stats = self.hooks.setdefault(name, [0, 0.0, 0.0])
+         stats[0] += 1
+         stats[1] += duration
+         stats[2] = max(stats[2], duration)
+
+   def _sample(self) -> None:
+      sampler_id = threading.get_ident()
+      while not self._stop_event.wait(self._sample_interval):
+         thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+         for thread_id, frame in sys._current_frames().items():
+            if thread_id == sampler_id:
+               continue
+            leaf_code = frame.f_code
+            if (os.path.basename(leaf_code.co_filename), leaf_code.co_name) in self.IDLE_LEAF_FRAMES:
+               continue
+            names = []
+            while frame is not None:
+               code = frame.f_code
+               # Qualified names (with the class) only exist from Python 3.11.
+               names.append('{}:{}'.format(os.path.basename(code.co_filename),
+                                           getattr(code, 'co_qualname', code.co_name)))
+               frame = frame.f_back
+            names.append(thread_names.get(thread_id, str(thread_id)))
+            names.reverse()
+            self.stacks[';'.join(names)] += 1
+         self.sample_count += 1
+
+
+class LiveProfiler(object):
+   # Profiles the running bot on demand, without restarting it: a sampling CPU profiler writing
+   # stacks in the folded format of flame graph tools, and tracemalloc's top allocation sites.
+   # Only threads of this process are sampled, not the image worker processes.
+   CONFIG_SECTION = 'live-profiler'
+   REPORT_MAX_LEAVES = 10
+
+   def __init__(self) -> None:
+      self._setup_logging()
+      self._sample_interval = config.getfloat(self.CONFIG_SECTION, 'sample_interval')
+      self.default_duration = config.getfloat(self.CONFIG_SECTION, 'default_duration')
+      self.max_duration = config.getfloat(self.CONFIG_SECTION, 'max_duration')
+      self._output_dir = os.path.join(os.environ['ROOT_DIR'], config.get(self.CONFIG_SECTION, 'output_dir'))
+      self._top_allocations = config.getint(self.CONFIG_SECTION, 'top_allocations')
+      self._tracemalloc_frames = config.getint(self.CONFIG_SECTION, 'tracemalloc_frames')
+      self._session: Optional[ProfilingSession] = None
+
+   def is_running(self) -> bool:
+      return self._session is not None
+
+   @contextlib.contextmanager
+   def hook(self, name: str) -> Iterator[None]:
+      # Marks a hot path whose calls are reported while profiling. Costs nothing otherwise.
+      session = self._session
+      if session is None:
+         yield
+         return
+      start = time.perf_counter()
+      try:
+         yield
+      finally:
+         session.record_hook(name, time.perf_counter() - start)
+
+   async def profile(self, duration: float) -> ProfileReport:
+      if self._session is not None:
+         raise ProfilerBusyError('Already profiling')
+      duration = min(duration, self.max_duration)
+      session = ProfilingSession(self._sample_interval)
+      self._session = session
+      # Allocations may already be traced since startup (PYTHONTRACEMALLOC), then keep it that way.
+      was_tracing = tracemalloc.is_tracing()
+      try:
+         if not was_tracing:
+            tracemalloc.start(self._tracemalloc_frames)
+         start_snapshot = tracemalloc.take_snapshot()
+         session.start()
+         self._log.info('Started profiling, duration={}'.format(duration))
+         start = time.perf_counter()
+         try:
+            await asyncio.sleep(duration)
+         finally:
+            session.stop()
+            end_snapshot = tracemalloc.take_snapshot()
+            if not was_tracing:
+               tracemalloc.stop()
+         duration = time.perf_counter() - start
+      finally:
+         self._session = None
+      report = await asyncio.to_thread(self._write_report, session, duration, start_snapshot, end_snapshot)
+      self._log.info('Finished profiling, samples={}, folded_file="{}", report_file="{}"'.format(
+         report.sample_count, report.folded_file, report.report_file))
+      return report
+
+   def _write_report(self, session: ProfilingSession, duration: float, start_snapshot: tracemalloc.Snapshot,
+                     end_snapshot: tracemalloc.Snapshot) -> ProfileReport:
+      os.makedirs(self._output_dir, exist_ok=True)
+      file_prefix = os.path.join(self._output_dir, time.strftime('profile-%Y%m%d-%H%M%S'))
+      folded_file = file_prefix + '.folded'
+      with open(folded_file, 'w') as file:
+         for stack, count in session.stacks.most_common():
+            file.write('{} {}\n'.format(stack, count))
+
+      summary = ['Profiled for {:.1f}s, samples={}, interval={}s'.format(
+         duration, session.sample_count, self._sample_interval)]
+      summary.append('')
+      summary.append('Hooks (calls, total seconds, max seconds):')
+      for name, (count, total, longest) in sorted(session.hooks.items()):
+         summary.append('  {}: {}, {:.3f}, {:.3f}'.format(name, count, total, longest))
+      summary.append('')
+      summary.append('Busiest functions (samples on top of the stack):')
+      leaves = Counter()
+      for stack, count in session.stacks.items():
+         leaves[stack.rsplit(';', 1)[-1]] += count
+      for leaf, count in leaves.most_common(self.REPORT_MAX_LEAVES):
+         summary.append('  {}: {}'.format(leaf, count))
+
+      lines = list(summary)
+      lines.append('')
+      lines.append('Top allocation sites by growth during the run:')
+      for stat in end_snapshot.compare_to(start_snapshot, 'lineno')[:self._top_allocations]:
+         lines.append('  {}'.format(stat))
+      lines.append('')
+      lines.append('Top allocation sites at the end of the run:')
+      for stat in end_snapshot.statistics('lineno')[:self._top_allocations]:
+         lines.append('  {}'.format(stat))
+      report_file = file_prefix + '.txt'
+      with open(report_file, 'w') as file:
+         file.write('\n'.join(lines) + '\n')
+      return ProfileReport(duration, session.sample_count, folded_file, report_file, summary)
+
+   def _setup_logging(self) -> None:
+      self._log = logger_factory.get_logger('live-profiler')
+      self._log.setLevel(logging.INFO)
+
+
+live_profiler = LazySingleton('live_profiler', LiveProfiler)
+
+
+def profiler_hook(name: str) -> Callable[[Callable], Callable]:
+   # Decorator marking a hot path (function or coroutine function) for the live profiler.
+   def decorator(func: Callable) -> Callable:
+      if asyncio.iscoroutinefunction(func):
+         @functools.wraps(func)
+         async def async_wrapper(*args, **kwargs):
+            with live_profiler.hook(name):
+               return await func(*args, **kwargs)
+         return async_wrapper
+
+      @functools.wraps(func)
+      def wrapper(*args, **kwargs):
+         with live_profiler.hook(name):
+            return func(*args, **kwargs)
+      return wrapper
+   return decorator
@@ -1,15 +1,108 @@
 import os
+import copy
+import json
+import queue
+import atexit
 import logging
+import logging.handlers
+import threading
+import contextvars
+import multiprocessing
+import multiprocessing.context
+from typing import Optional
+
+from lazy_loader import LazySingleton
+
+
+# ID shared by all log records emitted while handling the same message or command.
+correlation_id = contextvars.ContextVar('correlation_id', default='-')
+
+
+class CorrelationIdFilter(logging.Filter):
+   def filter(self, record: logging.LogRecord) -> bool:
+      record.correlation_id = correlation_id.get()
+      return True
+
+
+class JsonFormatter(logging.Formatter):
+   def format(self, record: logging.LogRecord) -> str:
+      entry = {
+         'time': self.formatTime(record),
+         'logger': record.name,
+         'level': record.levelname,
+         'correlation_id': getattr(record, 'correlation_id', '-'),
+         'message': record.getMessage()
+      }
+      if record.exc_info:
+         entry['exception'] = self.formatException(record.exc_info)
+      elif record.exc_text:
+         entry['exception'] = record.exc_text
+      return json.dumps(entry, ensure_ascii=False)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+   def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+      # Only merge the message with its arguments here, since they may be mutated by the caller
+      # after this returns. The actual formatting and disk write happen on the listener's thread.
+      record = copy.copy(record)
+      record.msg = record.getMessage()
+      record.args = None
+      if record.exc_info:
+         record.exc_text = logging.Formatter().formatException(record.exc_info)
+         record.exc_info = None
+      return record
 
 
 class LoggingUtils(object):
    LOG_FORMAT = r'%(asctime)s - %(name)s - [%(levelname)s] %(message)s'
    LOG_FILE = os.path.join(os.environ['ROOT_DIR'], 'runtime.log')
+   # Rotate the log file once it reaches this size, keeping a fixed number of old files.
+   LOG_FILE_MAX_BYTES = 20 * 1024 * 1024
+   LOG_FILE_BACKUP_COUNT = 5
+   # Queue to the parent process, in child processes (e.g. image workers). Only the parent writes
+   # the log file, since rotating a file shared by several processes loses records.
+   _parent_queue: Optional[multiprocessing.Queue] = None
 
    def __init__(self) -> None:
+      # Human-readable formatter for handlers attached by scripts (e.g. printing to the console).
       self.formatter = logging.Formatter(self.LOG_FORMAT)
-      self.handler = logging.FileHandler(self.LOG_FILE)
-      self.handler.setFormatter(self.formatter)
+      self._child_queue = None
+      self._child_listener = None
+      self._child_queue_lock = threading.Lock()
+      if self._parent_queue is not None:
+         self._file_handler = None
+         self.handler = NonBlockingQueueHandler(self._parent_queue)
+         self.handler.addFilter(CorrelationIdFilter())
+         return
+      self._file_handler = logging.handlers.RotatingFileHandler(
+         self.LOG_FILE, maxBytes=self.LOG_FILE_MAX_BYTES, backupCount=self.LOG_FILE_BACKUP_COUNT,
+         encoding='utf-8')
+      self._file_handler.setFormatter(JsonFormatter())
+      # Loggers only push records into an in-memory queue. A background thread drains it
+      # into the log file.
+      log_queue = queue.SimpleQueue()
+      self.handler = NonBlockingQueueHandler(log_queue)
+      self.handler.addFilter(CorrelationIdFilter())
+      self._listener = logging.handlers.QueueListener(log_queue, self._file_handler)
+      self._listener.start()
+      # Flush remaining records on exit.
+      atexit.register(self._listener.stop)
+
+   @classmethod
+   def forward_to_parent(cls, log_queue: multiprocessing.Queue) -> None:
+      # Called by a child process before its first log, with the queue given by its parent.
+      cls._parent_queue = log_queue
+
+   def get_child_queue(self, mp_context: multiprocessing.context.BaseContext) -> multiprocessing.Queue:
+      # Queue for the child processes started with the given context to log through, drained
+      # into this process's log file. Not for child processes themselves.
+      with self._child_queue_lock:
+         if self._child_queue is None:
+            self._child_queue = mp_context.Queue()
+            self._child_listener = logging.handlers.QueueListener(self._child_queue, self._file_handler)
+            self._child_listener.start()
+            atexit.register(self._child_listener.stop)
+         return self._child_queue
 
    def get_logger(self, logger_name: str) -> logging.Logger:
       logger = logging.getLogger(logger_name)
@@ -17,5 +110,8 @@ class LoggingUtils(object):
          logger.addHandler(self.handler)
       return logger
 
+   def set_correlation_id(self, value: str) -> None:
+      correlation_id.set(value)
+
 
-logger_factory = LoggingUtils()
+logger_factory = LazySingleton('logger_factory', LoggingUtils)
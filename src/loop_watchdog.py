@@ -0,0 +1,152 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+from typing import Optional
+
+from lazy_loader import LazySingleton
+from config_loader import config
+from logging_utils import logger_factory
+from metrics import metrics
+
+
+class BlockingSite(object):
+   # Place in the code where the event loop was found blocked, and how long it was blocked there.
+   def __init__(self, name: str) -> None:
+      self.name = name
+      self.count = 0
+      self.total_duration = 0.0
+      self.max_duration = 0.0
+      # Stack captured during the longest block.
+      self.stack: list[traceback.FrameSummary] = []
+
+   def record(self, duration: float, stack: list[traceback.FrameSummary]) -> None:
+      self.count += 1
+      self.total_duration += duration
+      if duration >= self.max_duration:
+         self.max_duration = duration
+         self.stack = stack
+
+
+class LoopWatchdog(object):
+   # Measures the event-loop lag with a heartbeat task, and watches it from a thread: when the
+   # heartbeat is late past a threshold, a callback is blocking the loop (sync client call, CPU
+   # heavy work...) and the loop thread's stack is captured while it still blocks. Blocks are
+   # ranked by site, the innermost frame of the bot's own code in the captured stack.
+   CONFIG_SECTION = 'loop-watchdog'
+   SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+   REPORT_MAX_SITES = 10
+   REPORT_STACK_DEPTH = 8
+   LAG_SECONDS = metrics.gauge('event_loop_lag_seconds', 'Latest measured event-loop lag in seconds.')
+   LAG_DISTRIBUTION = metrics.histogram(
+      'event_loop_lag_distribution_seconds', 'Distribution of the event-loop lag in seconds.',
+      buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5))
+   BLOCKS = metrics.counter(
+      'event_loop_blocks', 'Number of times a callback blocked the event loop past the threshold.')
+
+   def __init__(self) -> None:
+      self._setup_logging()
+      self.enabled = config.getboolean(self.CONFIG_SECTION, 'enabled')
+      self._heartbeat_interval = config.getfloat(self.CONFIG_SECTION, 'heartbeat_interval')
+      self._block_threshold = config.getfloat(self.CONFIG_SECTION, 'block_threshold')
+      self._lock = threading.Lock()
+      self._loop_thread_id = None
+      self._last_beat = 0.0
+      # Stack of the block in progress, captured by the monitor thread.
+      self._blocked_stack: Optional[list[traceback.FrameSummary]] = None
+      self._sites: dict[str, BlockingSite] = {}
+      self._heartbeat_task: Optional[asyncio.Task] = None
+      self._stop_event = threading.Event()
+      self._monitor_thread = None
+
+   def start(self) -> None:
+      # Watches the running event loop.
+      if not self.enabled or self._heartbeat_task is not None:
+         return
+      self._loop_thread_id = threading.get_ident()
+      self._last_beat = time.monotonic()
+      self._stop_event.clear()
+      self._heartbeat_task = asyncio.create_task(self._beat())
+      self._monitor_thread = threading.Thread(target=self._monitor, name='loop-watchdog', daemon=True)
+      self._monitor_thread.start()
+      self._log.info('Watching event loop, heartbeat_interval={}, block_threshold={}'.format(
+         self._heartbeat_interval, self._block_threshold))
+
+   def stop(self) -> None:
+      if self._heartbeat_task is None:
+         return
+      self._heartbeat_task.cancel()
+      self._heartbeat_task = None
+      self._stop_event.set()
+      self._monitor_thread.join()
+      self._monitor_thread = None
+
+   def get_report(self) -> list[str]:
+      sites = sorted(self._sites.values(), key=lambda site: site.total_duration, reverse=True)
+      if not sites:
+         return ['No callback blocked the event loop for more than {}s.'.format(self._block_threshold)]
+      lines = ['Blocking sites, by total blocked time (count, total seconds, max seconds):']
+      for site in sites[:self.REPORT_MAX_SITES]:
+         lines.append('  {}: {}, {:.3f}, {:.3f}'.format(site.name, site.count, site.total_duration, site.max_duration))
+         for frame in site.stack[-self.REPORT_STACK_DEPTH:]:
+            lines.append('    {}:{} in {}'.format(os.path.basename(frame.filename), frame.lineno, frame.name))
+      return lines
+
+   async def _beat(self) -> None:
+      while True:
+         start = time.monotonic()
+         await asyncio.sleep(self._heartbeat_interval)
+         now = time.monotonic()
+         lag = max(0.0, now - start - self._heartbeat_interval)
+         with self._lock:
+            self._last_beat = now
+            stack = self._blocked_stack
+            self._blocked_stack = None
+         self.LAG_SECONDS.set(lag)
+         self.LAG_DISTRIBUTION.observe(lag)
+         if stack is not None:
+            self._record_block(lag, stack)
+
+   def _monitor(self) -> None:
+      # Checked often enough to catch the loop while it is still blocked.
+      while not self._stop_event.wait(self._block_threshold / 2):
+         with self._lock:
+            if self._blocked_stack is not None:
+               continue
+            if time.monotonic() - self._last_beat < self._heartbeat_interval + self._block_threshold:
+               continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is not None:
+               self._blocked_stack = traceback.extract_stack(frame)
+
+   def _record_block(self, duration: float, stack: list[traceback.FrameSummary]) -> None:
+      self.BLOCKS.inc()
+      name = self._get_site_name(stack)
+      site = self._sites.get(name)
+      if site is None:
+         site = self._sites[name] = BlockingSite(name)
+         # Full stack the first time only, the report keeps the one of the longest block.
+         self._log.warning('Event loop blocked, duration={:.3f}s, site="{}", stack:\n{}'.format(
+            duration, name, ''.join(traceback.format_list(stack)).rstrip()))
+      else:
+         self._log.warning('Event loop blocked, duration={:.3f}s, site="{}", count={}'.format(
+            duration, name, site.count + 1))
+      site.record(duration, stack)
+
+   def _get_site_name(self, stack: list[traceback.FrameSummary]) -> str:
+      # Innermost frame of the bot's own code, the library code below it is what it called.
+      for frame in reversed(stack):
+         if os.path.dirname(os.path.abspath(frame.filename)) == self.SRC_DIR:
+            return '{}:{} in {}'.format(os.path.basename(frame.filename), frame.lineno, frame.name)
+      frame = stack[-1]
+      return '{}:{} in {}'.format(os.path.basename(frame.filename), frame.lineno, frame.name)
+
+   def _setup_logging(self) -> None:
+      self._log = logger_factory.get_logger('loop-watchdog')
+      self._log.setLevel(logging.INFO)
+
+
+loop_watchdog = LazySingleton('loop_watchdog', LoopWatchdog)
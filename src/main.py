@@ -1,8 +1,41 @@
-from discord_bot import DiscordBot
+import os
+import argparse
+from typing import Optional
 
+from lazy_loader import startup_profiler
+
+
+def parse_args() -> argparse.Namespace:
+   parser = argparse.ArgumentParser()
+   parser.add_argument('--profile-startup', required=False, action='store_true',
+      help='Report the time taken by each import and initialization step once the bot is ready')
+   parser.add_argument('--tip-worker', required=False, metavar='NAME',
+      help='Run as a tip worker reading the tip messages queued by the bot (split deployment), instead of the bot')
+   parser.add_argument('--parent-pid', required=False, type=int,
+      help='PID of the bot which started this tip worker. The worker stops once the bot is gone')
+   args = parser.parse_args()
+   return args
 
 def main() -> None:
-   DiscordBot().run()
+   args = parse_args()
+   if args.tip_worker:
+      run_tip_worker(args.tip_worker, args.parent_pid)
+      return
+   if args.profile_startup:
+      startup_profiler.enable()
+   # Imported here so the profiler, if enabled, sees every import.
+   with startup_profiler.step('import discord_bot'):
+      from discord_bot import DiscordBot
+   with startup_profiler.step('init DiscordBot'):
+      bot = DiscordBot()
+   bot.run()
+
+def run_tip_worker(name: str, parent_pid: Optional[int]) -> None:
+   # Each worker logs to its own file, since rotating a file shared by several processes loses records.
+   from logging_utils import LoggingUtils
+   LoggingUtils.LOG_FILE = os.path.join(os.environ['ROOT_DIR'], 'runtime-{}.log'.format(name))
+   from tip_worker import TipWorker
+   TipWorker(name, parent_pid).run()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,261 @@
+import time
+import math
+import logging
+import threading
+import contextlib
+from typing import Iterator, Optional
+
+from aiohttp import web
+
+from config_loader import config
+from logging_utils import logger_factory
+from live_profiler import ProfilerBusyError, live_profiler
+
+
+class Metric(object):
+   TYPE = 'untyped'
+
+   def __init__(self, name: str, description: str, label_names: tuple[str, ...] = ()) -> None:
+      self.name = name
+      self.description = description
+      self.label_names = label_names
+      self._lock = threading.Lock()
+      self._children = {}
+
+   def labels(self, *label_values: str) -> 'Metric':
+      if len(label_values) != len(self.label_names):
+         raise ValueError('Wrong number of labels for metric "{}", expected={}, got={}'.format(
+            self.name, self.label_names, label_values))
+      key = tuple(str(value) for value in label_values)
+      with self._lock:
+         if key not in self._children:
+            self._children[key] = self._make_child()
+         return self._children[key]
+
+   def render(self) -> list[str]:
+      lines = [
+         '# HELP {} {}'.format(self.name, self.description),
+         '# TYPE {} {}'.format(self.name, self.TYPE)
+      ]
+      with self._lock:
+         children = list(self._children.items())
+      if not self.label_names:
+         children = [((), self)]
+      for label_values, child in children:
+         labels = dict(zip(self.label_names, label_values))
+         lines.extend(child._render_samples(self.name, labels))
+      return lines
+
+   def _make_child(self) -> 'Metric':
+      return type(self)(self.name, self.description)
+
+   def _render_samples(self, name: str, labels: dict[str, str]) -> list[str]:
+      return []
+
+   @staticmethod
+   def _format_sample(name: str, labels: dict[str, str], value: float) -> str:
+      if labels:
+         label_str = ','.join('{}="{}"'.format(k, v.replace('\\', r'\\').replace('"', r'\"'))
+                              for k, v in labels.items())
+         name = '{}{{{}}}'.format(name, label_str)
+      return '{} {}'.format(name, Metric._format_value(value))
+
+   @staticmethod
+   def _format_value(value: float) -> str:
+      if math.isinf(value):
+         return '+Inf' if value > 0 else '-Inf'
+      return repr(float(value))
+
+
+class Counter(Metric):
+   TYPE = 'counter'
+
+   def __init__(self, name: str, description: str, label_names: tuple[str, ...] = ()) -> None:
+      super().__init__(name, description, label_names)
+      self._value = 0.0
+
+   def inc(self, amount: float = 1) -> None:
+      with self._lock:
+         self._value += amount
+
+   def get(self) -> float:
+      return self._value
+
+   def _render_samples(self, name: str, labels: dict[str, str]) -> list[str]:
+      return [self._format_sample(name + '_total', labels, self._value)]
+
+
+class Gauge(Metric):
+   TYPE = 'gauge'
+
+   def __init__(self, name: str, description: str, label_names: tuple[str, ...] = ()) -> None:
+      super().__init__(name, description, label_names)
+      self._value = 0.0
+
+   def set(self, value: float) -> None:
+      with self._lock:
+         self._value = value
+
+   def inc(self, amount: float = 1) -> None:
+      with self._lock:
+         self._value += amount
+
+   def dec(self, amount: float = 1) -> None:
+      with self._lock:
+         self._value -= amount
+
+   def get(self) -> float:
+      return self._value
+
+   @contextlib.contextmanager
+   def track_inprogress(self) -> Iterator[None]:
+      self.inc()
+      try:
+         yield
+      finally:
+         self.dec()
+
+   def _render_samples(self, name: str, labels: dict[str, str]) -> list[str]:
+      return [self._format_sample(name, labels, self._value)]
+
+
+class Histogram(Metric):
+   TYPE = 'histogram'
+   DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+   def __init__(self, name: str, description: str, label_names: tuple[str, ...] = (),
+                buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+      super().__init__(name, description, label_names)
+      self._buckets = tuple(sorted(buckets)) + (math.inf,)
+      self._bucket_counts = [0] * len(self._buckets)
+      self._sum = 0.0
+      self._count = 0
+
+   def observe(self, value: float) -> None:
+      with self._lock:
+         self._sum += value
+         self._count += 1
+         for idx, upper_bound in enumerate(self._buckets):
+            if value <= upper_bound:
+               self._bucket_counts[idx] += 1
+               break
+
+   @contextlib.contextmanager
+   def time(self) -> Iterator[None]:
+      start = time.perf_counter()
+      try:
+         yield
+      finally:
+         self.observe(time.perf_counter() - start)
+
+   def _make_child(self) -> 'Histogram':
+      return Histogram(self.name, self.description, buckets=self._buckets[:-1])
+
+   def _render_samples(self, name: str, labels: dict[str, str]) -> list[str]:
+      lines = []
+      with self._lock:
+         cumulative_count = 0
+         for upper_bound, count in zip(self._buckets, self._bucket_counts):
+            cumulative_count += count
+            bucket_labels = dict(labels, le=self._format_value(upper_bound))
+            lines.append(self._format_sample(name + '_bucket', bucket_labels, cumulative_count))
+         lines.append(self._format_sample(name + '_sum', labels, self._sum))
+         lines.append(self._format_sample(name + '_count', labels, self._count))
+      return lines
+
+
+class MetricsRegistry(object):
+   NAMESPACE = 'mechabridget'
+
+   def __init__(self) -> None:
+      self._lock = threading.Lock()
+      self._metrics = {}
+
+   def counter(self, name: str, description: str, label_names: tuple[str, ...] = ()) -> Counter:
+      return self._get_or_create(Counter, name, description, label_names)
+
+   def gauge(self, name: str, description: str, label_names: tuple[str, ...] = ()) -> Gauge:
+      return self._get_or_create(Gauge, name, description, label_names)
+
+   def histogram(self, name: str, description: str, label_names: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = Histogram.DEFAULT_BUCKETS) -> Histogram:
+      return self._get_or_create(Histogram, name, description, label_names, buckets=buckets)
+
+   def render(self) -> str:
+      with self._lock:
+         all_metrics = list(self._metrics.values())
+      lines = []
+      for metric in all_metrics:
+         lines.extend(metric.render())
+      return '\n'.join(lines) + '\n'
+
+   def _get_or_create(self, metric_cls: type, name: str, description: str,
+                      label_names: tuple[str, ...], **kwargs) -> Metric:
+      full_name = '{}_{}'.format(self.NAMESPACE, name)
+      with self._lock:
+         metric = self._metrics.get(full_name)
+         if metric is None:
+            metric = metric_cls(full_name, description, label_names, **kwargs)
+            self._metrics[full_name] = metric
+         elif not isinstance(metric, metric_cls) or metric.label_names != label_names:
+            raise ValueError('Metric "{}" already registered with a different type or labels'.format(full_name))
+         return metric
+
+
+metrics = MetricsRegistry()
+
+# Metrics shared between several components.
+STAGE_SECONDS = metrics.histogram(
+   'stage_seconds', 'Latency of each processing stage in seconds.', ('stage',))
+QUEUE_DEPTH = metrics.gauge(
+   'queue_depth', 'Number of work items waiting or in progress.', ('queue',))
+ERRORS = metrics.counter(
+   'errors', 'Number of errors returned by external services.', ('service',))
+
+
+class MetricsServer(object):
+   CONFIG_SECTION = 'metrics'
+   CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+   def __init__(self) -> None:
+      self._setup_logging()
+      self._enabled = config.getboolean(self.CONFIG_SECTION, 'enabled')
+      self._host = config.get(self.CONFIG_SECTION, 'host')
+      self._port = config.getint(self.CONFIG_SECTION, 'port')
+      self._runner: Optional[web.AppRunner] = None
+
+   async def start(self) -> None:
+      if not self._enabled:
+         return
+      app = web.Application()
+      app.router.add_get('/metrics', self._handle_metrics)
+      app.router.add_post('/profile', self._handle_profile)
+      self._runner = web.AppRunner(app, access_log=None)
+      await self._runner.setup()
+      await web.TCPSite(self._runner, self._host, self._port).start()
+      self._log.info('Serving metrics, address="http://{}:{}/metrics"'.format(self._host, self._port))
+
+   async def stop(self) -> None:
+      if self._runner:
+         await self._runner.cleanup()
+
+   async def _handle_metrics(self, request: web.Request) -> web.Response:
+      return web.Response(body=metrics.render().encode('utf-8'), headers={'Content-Type': self.CONTENT_TYPE})
+
+   async def _handle_profile(self, request: web.Request) -> web.Response:
+      # Responds once done, e.g. curl -X POST "http://127.0.0.1:9464/profile?duration=60".
+      try:
+         duration = float(request.query.get('duration', live_profiler.default_duration))
+      except ValueError:
+         return web.Response(status=400, text='Invalid duration\n')
+      try:
+         report = await live_profiler.profile(duration)
+      except ProfilerBusyError as e:
+         return web.Response(status=409, text='{}\n'.format(str(e)))
+      lines = report.summary + ['', 'Folded stacks: {}'.format(report.folded_file),
+                                'Report: {}'.format(report.report_file)]
+      return web.Response(text='\n'.join(lines) + '\n')
+
+   def _setup_logging(self) -> None:
+      self._log = logger_factory.get_logger('metrics-server')
+      self._log.setLevel(logging.INFO)
@@ -0,0 +1,98 @@
+from __future__ import annotations
+
+import os
+import io
+import csv
+import glob
+import logging
+from typing import Optional
+
+from lazy_loader import lazy_import
+from logging_utils import logger_factory
+
+numpy = lazy_import('numpy')
+
+
+class PriceSnapshot(object):
+   def __init__(self, data: dict[str, list[Optional[int]]], version: int, fetched_time: float,
+                starting_time: int, max_turn: int) -> None:
+      self.data = data
+      self.version = version
+      self.fetched_time = fetched_time
+      self.starting_time = starting_time
+      self.max_turn = max_turn
+
+
+class PriceSnapshotStore(object):
+   # Price data of each sheet profile and event, saved as one .npz file of a (town, turn) matrix.
+   # Unknown prices are masked rather than stored as a special value.
+   FILENAME_FORMAT = '{}-{}.npz'
+
+   def __init__(self, directory: str) -> None:
+      self._setup_logging()
+      self._directory = directory
+
+   def save(self, profile_name: str, snapshot: PriceSnapshot) -> None:
+      towns = list(snapshot.data.keys())
+      prices = numpy.zeros((len(towns), snapshot.max_turn), dtype=numpy.int32)
+      known = numpy.zeros((len(towns), snapshot.max_turn), dtype=bool)
+      for town_idx, town in enumerate(towns):
+         for turn_idx, price in enumerate(snapshot.data[town]):
+            if price is not None:
+               prices[town_idx, turn_idx] = price
+               known[town_idx, turn_idx] = True
+      os.makedirs(self._directory, exist_ok=True)
+      path = self._get_path(profile_name, snapshot.starting_time)
+      # Written aside then moved over, so a crash never leaves a truncated snapshot.
+      tmp_path = path + '.tmp'
+      with open(tmp_path, 'wb') as file:
+         numpy.savez_compressed(
+            file, towns=numpy.array(towns), prices=prices, known=known, version=snapshot.version,
+            fetched_time=snapshot.fetched_time, starting_time=snapshot.starting_time, max_turn=snapshot.max_turn)
+      os.replace(tmp_path, path)
+      self._log.debug('Saved price snapshot, path="%s", version=%d', path, snapshot.version)
+
+   def load(self, profile_name: str, starting_time: int) -> Optional[PriceSnapshot]:
+      path = self._get_path(profile_name, starting_time)
+      if not os.path.exists(path):
+         return None
+      return self._load_path(path)
+
+   def load_all(self, profile_name: str) -> list[PriceSnapshot]:
+      # Snapshots of every event of the profile, oldest first.
+      paths = glob.glob(os.path.join(self._directory, self.FILENAME_FORMAT.format(glob.escape(profile_name), '*')))
+      snapshots = [self._load_path(path) for path in paths]
+      return sorted([snapshot for snapshot in snapshots if snapshot], key=lambda snapshot: snapshot.starting_time)
+
+   @staticmethod
+   def to_csv(snapshot: PriceSnapshot) -> str:
+      # One column per town, one row per turn. Unknown prices are left empty.
+      output = io.StringIO()
+      writer = csv.writer(output)
+      towns = list(snapshot.data.keys())
+      writer.writerow(['turn'] + towns)
+      for turn_idx in range(snapshot.max_turn):
+         row = [snapshot.data[town][turn_idx] for town in towns]
+         writer.writerow([turn_idx + 1] + ['' if price is None else price for price in row])
+      return output.getvalue()
+
+   def _load_path(self, path: str) -> Optional[PriceSnapshot]:
+      try:
+         with numpy.load(path) as npz:
+            towns = [str(town) for town in npz['towns']]
+            prices = npz['prices']
+            known = npz['known']
+            data = {town: [int(price) if is_known else None for price, is_known in zip(prices[idx], known[idx])]
+                    for idx, town in enumerate(towns)}
+            return PriceSnapshot(data, int(npz['version']), float(npz['fetched_time']),
+                                 int(npz['starting_time']), int(npz['max_turn']))
+      except Exception as e:
+         self._log.error('Failed loading price snapshot, path="{}", exception="{}"'.format(path, repr(e)))
+         return None
+
+   def _get_path(self, profile_name: str, starting_time: int) -> str:
+      return os.path.join(self._directory, self.FILENAME_FORMAT.format(profile_name, starting_time))
+
+   def _setup_logging(self) -> None:
+      self._log = logger_factory.get_logger('price-snapshots')
+      self._log.setLevel(logging.INFO)
@@ -0,0 +1,79 @@
+import logging
+import configparser
+from typing import Optional
+
+from basic_utils import BasicUtils
+from config_loader import config
+from logging_utils import logger_factory
+
+
+class SheetProfile(object):
+   # Settings of one stonk sheet: where it is, its layout, and the timing of its event.
+   # Keys missing from the profile's own section are taken from the default sections.
+   DEFAULT_SECTIONS = ('stonk-sheet-base', 'stonk-sheet-querier')
+
+   def __init__(self, name: str, section: Optional[str], guild_ids: list[int], channels: list[str]) -> None:
+      self.name = name
+      self._section = section
+      self._guild_ids = guild_ids
+      self._channels = channels
+
+   def get(self, key: str) -> str:
+      for section in self._get_sections():
+         if config.has_option(section, key):
+            return config.get(section, key)
+      raise configparser.NoOptionError(key, self._section or self.DEFAULT_SECTIONS[0])
+
+   def getint(self, key: str) -> int:
+      return int(self.get(key))
+
+   def matches(self, guild_id: int, channel_name: str) -> bool:
+      # An empty list matches everything.
+      if self._guild_ids and (guild_id not in self._guild_ids):
+         return False
+      if self._channels and (channel_name not in self._channels):
+         return False
+      return True
+
+   def _get_sections(self) -> list[str]:
+      sections = list(self.DEFAULT_SECTIONS)
+      if self._section:
+         sections.insert(0, self._section)
+      return sections
+
+
+class SheetProfileRouter(object):
+   SECTION_PREFIX = 'sheet-profile:'
+   DEFAULT_PROFILE_NAME = 'default'
+
+   def __init__(self) -> None:
+      self._setup_logging()
+      self._default_profile = SheetProfile(self.DEFAULT_PROFILE_NAME, None, [], [])
+      self._profiles = []
+      for section in config.sections():
+         if not section.startswith(self.SECTION_PREFIX):
+            continue
+         profile = SheetProfile(
+            section[len(self.SECTION_PREFIX):], section,
+            BasicUtils.get_int_list_from_csv(config.get(section, 'guilds', fallback='')),
+            BasicUtils.get_list_from_csv(config.get(section, 'channels', fallback='')))
+         self._profiles.append(profile)
+         self._log.info('Loaded sheet profile, name="{}"'.format(profile.name))
+      # Resolved profile of each (guild, channel), since the same few are looked up for every message.
+      self._routes = {}
+
+   def get_profiles(self) -> list[SheetProfile]:
+      return [self._default_profile] + self._profiles
+
+   def get_profile(self, guild_id: int, channel_name: str) -> SheetProfile:
+      route = (guild_id, channel_name)
+      profile = self._routes.get(route)
+      if profile is None:
+         # The first matching profile wins, in the order of the config file.
+         profile = next((p for p in self._profiles if p.matches(guild_id, channel_name)), self._default_profile)
+         self._routes[route] = profile
+      return profile
+
+   def _setup_logging(self) -> None:
+      self._log = logger_factory.get_logger('sheet-profile-router')
+      self._log.setLevel(logging.INFO)
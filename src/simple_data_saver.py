@@ -1,51 +1,182 @@
 import os
 import pickle
-import copy
+import atexit
+import sqlite3
 import logging
+import threading
+from typing import Iterator, Sequence, Union
 
+from lazy_loader import LazySingleton
 from logging_utils import logger_factory
 
 
+class SavedItems(Sequence):
+   # Read-only, indexed view of a saved list. Items are read from the store on access, so large
+   # lists never need to be loaded into memory as a whole.
+   def __init__(self, saver: 'SimpleDataSaver', key: str) -> None:
+      self._saver = saver
+      self._key = key
+
+   def __len__(self) -> int:
+      return self._saver.count_items(self._key)
+
+   def __getitem__(self, idx: Union[int, slice]):
+      if isinstance(idx, slice):
+         start, stop, step = idx.indices(len(self))
+         items = self._saver.get_items(self._key, start, max(stop - start, 0))
+         return items[::step]
+      length = len(self)
+      if idx < 0:
+         idx += length
+      if not (0 <= idx < length):
+         raise IndexError('Saved items index out of range')
+      return self._saver.get_items(self._key, idx, 1)[0]
+
+   def __iter__(self) -> Iterator:
+      return iter(self._saver.get_items(self._key, 0, -1))
+
+
 class SimpleDataSaver(object):
-   SAVE_FILE = os.path.join(os.environ['ROOT_DIR'], '.saved')
+   SAVE_FILE = os.path.join(os.environ['ROOT_DIR'], '.saved.sqlite3')
+   # Whole-file pickle used by older versions. Migrated into the database on first start.
+   LEGACY_SAVE_FILE = os.path.join(os.environ['ROOT_DIR'], '.saved')
    PICKLE_PROTOCOL = 4
+   # Number of seconds writes are held so they can be committed together in one transaction.
+   FLUSH_INTERVAL = 0.5
 
    def __init__(self) -> None:
       self._setup_logging()
-      self._data = {}
-      self._load_data()
+      self._lock = threading.RLock()
+      # Statements not committed yet, in order, and the latest pending value of each key.
+      self._pending_statements = []
+      self._pending_values = {}
+      self._flush_timer = None
+      self._connect()
+      self._migrate_legacy_save_file()
+      atexit.register(self.flush)
 
    def load_key(self, key: str, default = None):
-      try:
-         ret = copy.deepcopy(self._data[key])
-      except KeyError:
-         ret = default
-      self._log.debug('Loaded key, key="{}", default={}, ret={}'.format(
-         key, default, ret))
+      with self._lock:
+         if key in self._pending_values:
+            blob = self._pending_values[key]
+         else:
+            row = self._conn.execute('SELECT value FROM kv WHERE key = ?', (key,)).fetchone()
+            blob = row[0] if row else None
+      # Unpickling always returns a fresh copy, so callers can't alter the saved value.
+      ret = default if blob is None else pickle.loads(blob)
+      self._log.debug('Loaded key, key="%s", default=%s, ret=%s', key, default, ret)
       return ret
 
    def save_key(self, key: str, value) -> None:
-      self._data[key] = copy.deepcopy(value)
-      self._save_data()
-      self._log.debug('Saved key, key="{}", value={}, data={}'.format(
-         key, value, self._data))
+      # Pickle now to take a snapshot of the value. Only this key is written to disk.
+      blob = pickle.dumps(value, protocol=self.PICKLE_PROTOCOL)
+      with self._lock:
+         self._pending_values[key] = blob
+         self._add_pending_statement('INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)', (key, blob))
+      self._log.debug('Saved key, key="%s", value=%s', key, value)
+
+   def delete_key(self, key: str) -> None:
+      with self._lock:
+         self._pending_values[key] = None
+         self._add_pending_statement('DELETE FROM kv WHERE key = ?', (key,))
+      self._log.debug('Deleted key, key="%s"', key)
+
+   def append_items(self, key: str, items: list) -> None:
+      # Appending costs O(len(items)) no matter how long the saved list already is.
+      with self._lock:
+         for item in items:
+            self._add_pending_statement(
+               'INSERT INTO items (key, value) VALUES (?, ?)',
+               (key, pickle.dumps(item, protocol=self.PICKLE_PROTOCOL)))
+      self._log.debug('Appended items, key="%s", count=%d', key, len(items))
+
+   def get_items(self, key: str, offset: int = 0, limit: int = -1) -> list:
+      with self._lock:
+         self._flush_locked()
+         rows = self._conn.execute(
+            'SELECT value FROM items WHERE key = ? ORDER BY id LIMIT ? OFFSET ?',
+            (key, limit, offset)).fetchall()
+      return [pickle.loads(row[0]) for row in rows]
+
+   def get_items_view(self, key: str) -> SavedItems:
+      return SavedItems(self, key)
+
+   def count_items(self, key: str) -> int:
+      with self._lock:
+         self._flush_locked()
+         return self._conn.execute('SELECT COUNT(*) FROM items WHERE key = ?', (key,)).fetchone()[0]
+
+   def move_items(self, src_key: str, dst_key: str) -> None:
+      with self._lock:
+         self._add_pending_statement('UPDATE items SET key = ? WHERE key = ?', (dst_key, src_key))
+
+   def clear_items(self, key: str) -> None:
+      with self._lock:
+         self._add_pending_statement('DELETE FROM items WHERE key = ?', (key,))
+
+   def migrate_key_to_items(self, key: str) -> None:
+      # Convert a list saved as a single value into saved items.
+      value = self.load_key(key)
+      if isinstance(value, list):
+         with self._lock:
+            self.append_items(key, value)
+            self.delete_key(key)
+
+   def flush(self) -> None:
+      with self._lock:
+         self._flush_locked()
+
+   def _add_pending_statement(self, sql: str, params: tuple) -> None:
+      self._pending_statements.append((sql, params))
+      if self.FLUSH_INTERVAL <= 0:
+         self._flush_locked()
+      elif self._flush_timer is None:
+         self._flush_timer = threading.Timer(self.FLUSH_INTERVAL, self.flush)
+         self._flush_timer.daemon = True
+         self._flush_timer.start()
 
-   def _load_data(self) -> None:
-      self._ensure_save_file()
-      with open(self.SAVE_FILE, 'rb') as file:
-         self._data = pickle.load(file)
+   def _flush_locked(self) -> None:
+      if self._flush_timer is not None:
+         self._flush_timer.cancel()
+         self._flush_timer = None
+      if not self._pending_statements:
+         return
+      # All pending writes are committed atomically.
+      with self._conn:
+         for sql, params in self._pending_statements:
+            self._conn.execute(sql, params)
+      self._log.debug('Committed pending writes, count=%d', len(self._pending_statements))
+      self._pending_statements.clear()
+      self._pending_values.clear()
 
-   def _save_data(self) -> None:
-      with open(self.SAVE_FILE, 'wb') as file:
-         pickle.dump(self._data, file, protocol=self.PICKLE_PROTOCOL)
+   def _connect(self) -> None:
+      self._conn = sqlite3.connect(self.SAVE_FILE, check_same_thread=False)
+      # WAL keeps the database consistent on crashes while only syncing on checkpoints.
+      self._conn.execute('PRAGMA journal_mode=WAL')
+      self._conn.execute('PRAGMA synchronous=NORMAL')
+      with self._conn:
+         self._conn.execute('CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB NOT NULL)')
+         self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS items (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'key TEXT NOT NULL, value BLOB NOT NULL)')
+         self._conn.execute('CREATE INDEX IF NOT EXISTS items_key_id ON items (key, id)')
 
-   def _ensure_save_file(self) -> None:
-      if not os.path.isfile(self.SAVE_FILE):
-         self._save_data()
+   def _migrate_legacy_save_file(self) -> None:
+      if not os.path.isfile(self.LEGACY_SAVE_FILE):
+         return
+      with open(self.LEGACY_SAVE_FILE, 'rb') as file:
+         legacy_data = pickle.load(file)
+      with self._lock:
+         for key, value in legacy_data.items():
+            self.save_key(key, value)
+         self._flush_locked()
+      # Keep the old file around, renamed so the migration only happens once.
+      os.replace(self.LEGACY_SAVE_FILE, self.LEGACY_SAVE_FILE + '.migrated')
+      self._log.info('Migrated legacy save file, keys={}'.format(list(legacy_data.keys())))
 
    def _setup_logging(self) -> None:
       self._log = logger_factory.get_logger('simple-data-saver')
       self._log.setLevel(logging.INFO)
 
 
-simple_saver = SimpleDataSaver()
+simple_saver = LazySingleton('simple_saver', SimpleDataSaver)
@@ -1,49 +1,151 @@
-from google.oauth2 import service_account
-import gspread
+from __future__ import annotations
 
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from lazy_loader import lazy_import, startup_profiler
 from config_loader import config
 from shared_constants import HeroTown
+from sheet_profiles import SheetProfile
+
+service_account = lazy_import('google.oauth2.service_account')
+gspread = lazy_import('gspread')
+
+
+class SheetTimeoutError(Exception):
+   pass
+
+
+class AsyncWorksheet(object):
+   # Async facade of a gspread worksheet. Every (blocking) Google API call runs on a dedicated,
+   # bounded executor so a slow Sheets response never holds up the event loop.
+   # The worksheet is only opened by the first call (or a warm-up), on the executor's thread.
+   def __init__(self, open_worksheet: Callable[[], gspread.Worksheet], executor: ThreadPoolExecutor,
+                timeout: float, on_opened: Optional[Callable[[gspread.Worksheet], None]] = None) -> None:
+      self._open_worksheet = open_worksheet
+      self._on_opened = on_opened
+      self._worksheet = None
+      # Known once the worksheet is opened, read without any Google call after that.
+      self._worksheet_id: Optional[int] = None
+      self._worksheet_lock = threading.Lock()
+      self._executor = executor
+      self._timeout = timeout
+
+   @property
+   def worksheet(self) -> gspread.Worksheet:
+      with self._worksheet_lock:
+         if self._worksheet is None:
+            with startup_profiler.step('open worksheet'):
+               worksheet = self._open_worksheet()
+               if self._on_opened:
+                  self._on_opened(worksheet)
+            self._worksheet_id = worksheet.id
+            self._worksheet = worksheet
+         return self._worksheet
+
+   async def get_id(self, timeout: Optional[float] = None) -> int:
+      if self._worksheet_id is not None:
+         return self._worksheet_id
+      # Not opened yet (no warm-up), opened on the executor like any other call.
+      return await self._run(lambda: self.worksheet.id, 'open', timeout)
+
+   async def batch_get(self, ranges: list[str], timeout: Optional[float] = None) -> list:
+      return await self._call('batch_get', ranges, timeout=timeout)
+
+   async def update(self, cell: str, value: Any, raw: bool = True, timeout: Optional[float] = None) -> None:
+      await self._call('update', cell, value, raw=raw, timeout=timeout)
+
+   async def format(self, cell: str, cell_format: dict, timeout: Optional[float] = None) -> None:
+      await self._call('format', cell, cell_format, timeout=timeout)
+
+   def _call_worksheet(self, method_name: str, *args, **kwargs) -> Any:
+      return getattr(self.worksheet, method_name)(*args, **kwargs)
+
+   async def _call(self, method_name: str, *args, timeout: Optional[float] = None, **kwargs) -> Any:
+      return await self._run(functools.partial(self._call_worksheet, method_name, *args, **kwargs), method_name,
+                             timeout)
+
+   async def _run(self, func: Callable[[], Any], call_name: str, timeout: Optional[float]) -> Any:
+      timeout = self._timeout if timeout is None else timeout
+      future = self._executor.submit(func)
+      try:
+         # Cancelling the wrapper (by timeout or by the caller) also cancels the call if it is
+         # still queued. A call already running cannot be interrupted, but its result is dropped.
+         return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+      except asyncio.TimeoutError:
+         raise SheetTimeoutError('Timed out calling Google Sheets, call="{}", timeout={}'.format(
+            call_name, timeout))
 
 
 class StonkSheetBase(object):
    CONFIG_SECTION = 'stonk-sheet-base'
-   PRICE_COLUMNS = {
-      HeroTown.CELINE.value: config.get(CONFIG_SECTION, 'price_column_celine'),
-      HeroTown.CHOCOLAT.value: config.get(CONFIG_SECTION, 'price_column_chocolat'),
-      HeroTown.FERGUS.value: config.get(CONFIG_SECTION, 'price_column_fergus'),
-      HeroTown.LENNY.value: config.get(CONFIG_SECTION, 'price_column_lenny'),
-      HeroTown.LEDNAS.value: config.get(CONFIG_SECTION, 'price_column_lednas')
-   }
-   CHANGE_COLUMNS = {
-      HeroTown.CELINE.value: config.get(CONFIG_SECTION, 'change_column_celine'),
-      HeroTown.CHOCOLAT.value: config.get(CONFIG_SECTION, 'change_column_chocolat'),
-      HeroTown.FERGUS.value: config.get(CONFIG_SECTION, 'change_column_fergus'),
-      HeroTown.LENNY.value: config.get(CONFIG_SECTION, 'change_column_lenny'),
-      HeroTown.LEDNAS.value: config.get(CONFIG_SECTION, 'change_column_lednas')
-   }
-   ACTION_COLUMNS = {
-      HeroTown.CELINE.value: config.get(CONFIG_SECTION, 'action_column_celine'),
-      HeroTown.CHOCOLAT.value: config.get(CONFIG_SECTION, 'action_column_chocolat'),
-      HeroTown.FERGUS.value: config.get(CONFIG_SECTION, 'action_column_fergus'),
-      HeroTown.LENNY.value: config.get(CONFIG_SECTION, 'action_column_lenny'),
-      HeroTown.LEDNAS.value: config.get(CONFIG_SECTION, 'action_column_lednas')
-   }
-
-   def _setup_stonk_sheet(self) -> None:
+   # Executor shared by all sheet clients, so the total number of concurrent Google calls is bounded.
+   _io_executor: Optional[ThreadPoolExecutor] = None
+   # Google clients (by credentials file) and opened worksheets (by spreadsheet ID and sheet name),
+   # shared by the queriers and updaters of all sheet profiles.
+   _gsheets_clients: dict[str, gspread.Client] = {}
+   _worksheets: dict[tuple[str, str], gspread.Worksheet] = {}
+   _gsheets_lock = threading.Lock()
+
+   def warm_up(self) -> None:
+      # Open the worksheet ahead of the first call.
+      self._sheet.worksheet
+
+   def _setup_stonk_sheet(self, profile: SheetProfile,
+                          on_opened: Optional[Callable[[gspread.Worksheet], None]] = None) -> None:
       # Subclass will override this value. So need to be specific here.
       config_section = StonkSheetBase.CONFIG_SECTION
-      gsheets_credentials = service_account.Credentials.from_service_account_file(
-         filename=config.get(config_section, 'gsheets_service_account_file'),
-         scopes=[
-            'https://www.googleapis.com/auth/drive.readonly',
-            'https://www.googleapis.com/auth/spreadsheets'
-         ]
-      )
-      gsheets_client = gspread.authorize(gsheets_credentials)
-      spreadsheet = gsheets_client.open_by_key(config.get(config_section, 'spreadsheet_id'))
-      self._sheet = spreadsheet.worksheet(config.get(config_section, 'sheet_name'))
-      self._starting_row = config.getint(config_section, 'starting_row')
-      self._max_turn = config.getint(config_section, 'max_turn')
+      if StonkSheetBase._io_executor is None:
+         StonkSheetBase._io_executor = ThreadPoolExecutor(
+            max_workers=config.getint(config_section, 'io_max_workers'),
+            thread_name_prefix='stonk-sheet-io')
+      self._profile = profile
+      self._sheet = AsyncWorksheet(
+         self._open_worksheet, StonkSheetBase._io_executor, config.getfloat(config_section, 'io_timeout'),
+         on_opened)
+      self._starting_row = profile.getint('starting_row')
+      self._max_turn = profile.getint('max_turn')
+      self._price_columns = self._get_columns('price')
+      self._change_columns = self._get_columns('change')
+      self._action_columns = self._get_columns('action')
+
+   def _open_worksheet(self) -> gspread.Worksheet:
+      spreadsheet_id = self._profile.get('spreadsheet_id')
+      sheet_name = self._profile.get('sheet_name')
+      with StonkSheetBase._gsheets_lock:
+         worksheet = StonkSheetBase._worksheets.get((spreadsheet_id, sheet_name))
+         if worksheet is None:
+            gsheets_client = self._get_gsheets_client(self._profile.get('gsheets_service_account_file'))
+            spreadsheet = gsheets_client.open_by_key(spreadsheet_id)
+            worksheet = spreadsheet.worksheet(sheet_name)
+            StonkSheetBase._worksheets[(spreadsheet_id, sheet_name)] = worksheet
+      return worksheet
+
+   @staticmethod
+   def _get_gsheets_client(service_account_file: str) -> gspread.Client:
+      gsheets_client = StonkSheetBase._gsheets_clients.get(service_account_file)
+      if gsheets_client is None:
+         gsheets_credentials = service_account.Credentials.from_service_account_file(
+            filename=service_account_file,
+            scopes=[
+               'https://www.googleapis.com/auth/drive.readonly',
+               'https://www.googleapis.com/auth/spreadsheets'
+            ]
+         )
+         gsheets_client = gspread.authorize(gsheets_credentials)
+         StonkSheetBase._gsheets_clients[service_account_file] = gsheets_client
+      return gsheets_client
+
+   def _get_columns(self, column_type: str) -> dict[str, str]:
+      # Maps each hero town's name to its column, e.g. "price_column_celine".
+      columns = {}
+      for hero_town in HeroTown:
+         if hero_town != HeroTown.UNKNOWN:
+            columns[hero_town.value] = self._profile.get('{}_column_{}'.format(column_type, hero_town.value.lower()))
+      return columns
 
    def _get_fixed_row_turn_acell(self, col: str, turn: int) -> str:
       return '{}${}'.format(col, self._get_row_number(turn))
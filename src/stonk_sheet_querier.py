@@ -1,32 +1,150 @@
+import os
 import time
+import asyncio
 import logging
-from typing import Optional
+from typing import Awaitable, Callable, Optional
 
 from basic_utils import BasicUtils
 from config_loader import config
 from logging_utils import logger_factory
+from metrics import ERRORS, STAGE_SECONDS, metrics
+from live_profiler import profiler_hook
 from shared_constants import HeroTown
 from stonk_sheet_base import StonkSheetBase
+from sheet_profiles import SheetProfile
+from price_snapshots import PriceSnapshot, PriceSnapshotStore
+
+
+class PriceChange(object):
+   # Price of a turn entered or changed in the sheet, usually by a new tip.
+   def __init__(self, hero_town_name: str, turn: int, old_price: Optional[int], new_price: int,
+                change_percent: Optional[float]) -> None:
+      self.hero_town_name = hero_town_name
+      self.turn = turn
+      self.old_price = old_price
+      self.new_price = new_price
+      # From the current turn's price. None for the current turn itself, or without its price.
+      self.change_percent = change_percent
 
 
 class StonkSheetQuerier(StonkSheetBase):
    CONFIG_SECTION = 'stonk-sheet-querier'
+   CACHE_LOOKUPS = metrics.counter(
+      'querier_cache_lookups', 'Number of price data lookups by the sheet querier.', ('result',))
+   ANSWER_LOOKUPS = metrics.counter(
+      'querier_answer_lookups', 'Number of command answers looked up by the sheet querier.', ('result',))
+   ALL_STOCKS = [hero_town for hero_town in HeroTown if hero_town is not HeroTown.UNKNOWN]
 
-   def __init__(self) -> None:
+   def __init__(self, profile: SheetProfile) -> None:
       self._setup_logging()
-      self._setup_stonk_sheet()
-      self._starting_time = config.getint(self.CONFIG_SECTION, 'starting_time')
+      self._setup_stonk_sheet(profile)
+      self._starting_time = profile.getint('starting_time')
       self._cache_fresh_time = config.getint(self.CONFIG_SECTION, 'cache_fresh_time')
       self._cached_data = None
       self._cached_time = 0
+      self._fetch_task = None
+      # Incremented whenever fetched data differs from the cached one.
+      self._data_version = 0
+      # Answers computed for the current (turn, data version), by command and arguments.
+      self._answers = {}
+      self._answers_key = None
+      snapshot_dir = config.get(self.CONFIG_SECTION, 'snapshot_dir')
+      self._snapshot_store = (PriceSnapshotStore(os.path.join(os.environ['ROOT_DIR'], snapshot_dir))
+                              if snapshot_dir else None)
+      self._snapshot_interval = config.getfloat(self.CONFIG_SECTION, 'snapshot_interval')
+      self._snapshot_time = 0
+      self._snapshot_version = 0
+      self._snapshot_task = None
+      # Whether the snapshot was looked for, and whether the cached data still comes from it.
+      self._snapshot_checked = False
+      self._is_cached_from_snapshot = False
+      # Price data the last price changes were found against.
+      self._watched_data = None
+
+   async def get_best_buy_msg(self) -> str:
+      return await self._get_answer(('bestbuy',), self._make_best_buy_msg)
+
+   async def get_target_buy_msg(self, target_turns: list[int]) -> str:
+      return await self._get_answer(('targetbuy', tuple(target_turns)), self._make_target_buy_msg, target_turns)
+
+   async def get_tips_msg(self, stocks: list[HeroTown]) -> str:
+      return await self._get_answer(('tips', tuple(stocks)), self._make_tips_msg, stocks)
+
+   async def precompute_answers(self, target_turns: list[int]) -> tuple[str, str]:
+      # Fetches the data of the new turn once and computes the answers everyone is about to ask for.
+      # Returns the best buy and the tips of all stocks.
+      self._cached_time = 0
+      best_buy_msg = await self.get_best_buy_msg()
+      for target_turn in target_turns:
+         await self.get_target_buy_msg([target_turn])
+      tips_msg = await self.get_tips_msg(self.ALL_STOCKS)
+      return best_buy_msg, tips_msg
+
+   async def get_price_changes(self, max_age: float) -> list[PriceChange]:
+      # Returns the prices of the current and next turns which were entered or changed since the
+      # last call, from data fetched at most max_age seconds ago. Nothing on the first call.
+      data = await self._get_data(max_age)
+      watched_data = self._watched_data
+      self._watched_data = data
+      if (watched_data is None) or (watched_data is data):
+         return []
+      current_idx = self._get_idx_for_turn(self._get_current_turn())
+      changes = []
+      for hero_town_name, prices in data.items():
+         old_prices = watched_data.get(hero_town_name, [None] * len(prices))
+         if len(old_prices) != len(prices):
+            # Not comparable turn by turn, e.g. max_turn changed in between. Only taken as reference.
+            continue
+         current_price = prices[current_idx]
+         for idx in range(current_idx, len(prices)):
+            if (prices[idx] is None) or (prices[idx] == old_prices[idx]):
+               continue
+            change_percent = None
+            if current_price and (idx != current_idx):
+               change_percent = self._get_change_percent(current_price, prices[idx])
+            changes.append(PriceChange(hero_town_name, idx + 1, old_prices[idx], prices[idx], change_percent))
+      return changes
+
+   def reset_price_changes(self) -> None:
+      # The next call only takes the data as reference.
+      self._watched_data = None
 
-   def get_best_buy_msg(self) -> str:
+   def get_price_changes_msg(self, changes: list[PriceChange]) -> str:
+      lines = []
+      for change in changes:
+         if change.change_percent is None:
+            line = '{} is {} on round {}.'.format(change.hero_town_name, change.new_price, change.turn)
+         else:
+            line = '{} will be {} on round {}. A change of {}.'.format(
+               change.hero_town_name, change.new_price, change.turn, str(change.change_percent) + r'%')
+         if change.old_price is not None:
+            line += ' (was {})'.format(change.old_price)
+         lines.append(line)
+      return '\n'.join(lines)
+
+   def get_snapshots(self) -> list[PriceSnapshot]:
+      # Saved price data of every event of this sheet profile.
+      if self._snapshot_store is None:
+         return []
+      return self._snapshot_store.load_all(self._profile.name)
+
+   def get_seconds_to_next_turn(self) -> Optional[float]:
+      # None once the last turn has started.
+      elapsed_time = time.time() - self._starting_time
+      if elapsed_time < 0:
+         return -elapsed_time
+      next_turn = int(elapsed_time / 3600) + 2
+      if next_turn > self._max_turn:
+         return None
+      return 3600 * (next_turn - 1) - elapsed_time
+
+   async def _make_best_buy_msg(self) -> str:
       current_turn = self._get_current_turn()
       lines = [self.get_current_turn_msg()]
       if current_turn == self._max_turn:
          return lines[0]
 
-      excludes, _, includes_data = self._get_only_usable_data()
+      excludes, _, includes_data = await self._get_only_usable_data()
       # If missing current turn's price for at least 1 stock.
       if excludes:
          lines.append(self._get_missing_current_price_msg(excludes))
@@ -42,13 +160,13 @@ class StonkSheetQuerier(StonkSheetBase):
 
       return '\n'.join(lines)
 
-   def get_target_buy_msg(self, target_turns: list[int]) -> str:
+   async def _make_target_buy_msg(self, target_turns: list[int]) -> str:
       current_turn = self._get_current_turn()
       lines = [self.get_current_turn_msg()]
       if current_turn == self._max_turn:
          return lines[0]
       
-      excludes, _, includes_data = self._get_only_usable_data()
+      excludes, _, includes_data = await self._get_only_usable_data()
       # If missing current turn's price for at least 1 stock.
       if excludes:
          lines.append(self._get_missing_current_price_msg(excludes))
@@ -66,13 +184,13 @@ class StonkSheetQuerier(StonkSheetBase):
 
       return '\n'.join(lines)
 
-   def get_tips_msg(self, stocks: list[HeroTown]) -> str:
+   async def _make_tips_msg(self, stocks: list[HeroTown]) -> str:
       current_turn = self._get_current_turn()
       lines = [self.get_current_turn_msg()]
       if current_turn == self._max_turn:
          return lines[0]
 
-      excludes, _, includes_data = self._get_only_usable_data()
+      excludes, _, includes_data = await self._get_only_usable_data()
       if excludes:
          lines.append(self._get_missing_current_price_msg(excludes))
       next_turn = current_turn + 1
@@ -98,10 +216,10 @@ class StonkSheetQuerier(StonkSheetBase):
 
       return '\n'.join(lines)
 
-   def get_sheet_msg(self) -> str:
-      spreadsheet_id = config.get(StonkSheetBase.CONFIG_SECTION, 'spreadsheet_id')
+   async def get_sheet_msg(self) -> str:
+      spreadsheet_id = self._profile.get('spreadsheet_id')
       return 'https://docs.google.com/spreadsheets/d/{}/#gid={}'.format(
-         spreadsheet_id, self._sheet.id)
+         spreadsheet_id, await self._sheet.get_id())
 
    def get_current_turn_msg(self) -> str:
       current_turn = self._get_current_turn()
@@ -134,10 +252,29 @@ class StonkSheetQuerier(StonkSheetBase):
             best_change_percent = change_percent
       return (best_change_name, best_change_percent)
 
-   def _get_only_usable_data(self) -> tuple[list[str], list[str],
+   async def _get_answer(self, answer_key: tuple, make_answer: Callable[..., Awaitable[str]], *args) -> str:
+      # Answers only depend on the turn and the data. Asked again during the same turn with unchanged
+      # data, the same question is answered without computing it again.
+      await self._get_data()
+      answers_key = (self._get_current_turn(), self._data_version)
+      if answers_key != self._answers_key:
+         self._answers = {}
+         self._answers_key = answers_key
+      answer = self._answers.get(answer_key)
+      if answer is not None:
+         self.ANSWER_LOOKUPS.labels('hit').inc()
+         return answer
+      self.ANSWER_LOOKUPS.labels('miss').inc()
+      answer = await make_answer(*args)
+      # Not kept if the turn or the data changed meanwhile.
+      if answers_key == (self._get_current_turn(), self._data_version):
+         self._answers[answer_key] = answer
+      return answer
+
+   async def _get_only_usable_data(self) -> tuple[list[str], list[str],
                                             dict[str, list[Optional[int]]]]:
       current_turn = self._get_current_turn()
-      data = self._get_data()
+      data = await self._get_data()
       excludes = []
       includes = []
       for hero_town_name, hero_town_data in data.items():
@@ -148,23 +285,42 @@ class StonkSheetQuerier(StonkSheetBase):
       includes_data = {k: data[k] for k in includes}
       return (excludes, includes, includes_data)
 
-   def _get_data(self) -> dict[str, list[Optional[int]]]:
-      if not self._should_use_cache():
-         self._fetch_new_data()
+   async def _get_data(self, max_age: Optional[float] = None) -> dict[str, list[Optional[int]]]:
+      if not self._snapshot_checked:
+         self._load_snapshot()
+      if not self._should_use_cache(max_age):
+         # Concurrent commands missing the cache share a single fetch.
+         if self._fetch_task is None:
+            self._fetch_task = asyncio.ensure_future(self._fetch_new_data())
+            self._fetch_task.add_done_callback(self._on_fetch_done)
+         if self._is_cached_from_snapshot:
+            # Right after a restart, answer from the snapshot while the sheet is fetched.
+            self.CACHE_LOOKUPS.labels('snapshot').inc()
+            return self._cached_data
+         self.CACHE_LOOKUPS.labels('miss').inc()
+         await asyncio.shield(self._fetch_task)
+      else:
+         self.CACHE_LOOKUPS.labels('hit').inc()
       return self._cached_data
 
-   def _fetch_new_data(self) -> None:
+   @profiler_hook('querier_fetch')
+   async def _fetch_new_data(self) -> None:
       cell_ranges = []
       hero_town_names = []
-      for hero_town_name, col in self.PRICE_COLUMNS.items():
+      for hero_town_name, col in self._price_columns.items():
          start_cell = self._get_turn_acell(col, 1)
          end_cell = self._get_turn_acell(col, self._max_turn)
          cell_range = '{}:{}'.format(start_cell, end_cell)
          cell_ranges.append(cell_range)
          hero_town_names.append(hero_town_name)
-      raw_data_all = self._sheet.batch_get(cell_ranges)
+      try:
+         with STAGE_SECONDS.labels('querier_fetch').time():
+            raw_data_all = await self._sheet.batch_get(cell_ranges)
+      except Exception:
+         ERRORS.labels('sheets').inc()
+         raise
 
-      self._cached_data = {}
+      cached_data = {}
       for hero_town_name, raw_data in zip(hero_town_names, raw_data_all):
          processed_data = [None] * self._max_turn
          for idx, entry in enumerate(raw_data):
@@ -173,12 +329,62 @@ class StonkSheetQuerier(StonkSheetBase):
                   processed_data[idx] = int(entry[0])
                except ValueError:
                   pass
-         self._cached_data[hero_town_name] = processed_data
+         cached_data[hero_town_name] = processed_data
+      if cached_data != self._cached_data:
+         self._cached_data = cached_data
+         self._data_version += 1
       self._cached_time = time.time()
+      self._is_cached_from_snapshot = False
+      self._save_snapshot()
+
+   def _on_fetch_done(self, task: asyncio.Future) -> None:
+      self._fetch_task = None
+      # Nobody may be waiting for a fetch started while answering from the snapshot.
+      if not task.cancelled() and task.exception():
+         self._log.error('Failed fetching stonk sheet, exception="{}"'.format(repr(task.exception())))
+
+   def _load_snapshot(self) -> None:
+      self._snapshot_checked = True
+      if (self._snapshot_store is None) or (self._cached_data is not None):
+         return
+      snapshot = self._snapshot_store.load(self._profile.name, self._starting_time)
+      if (snapshot is None) or (snapshot.max_turn != self._max_turn) or \
+         (set(snapshot.data.keys()) != set(self._price_columns.keys())):
+         return
+      self._cached_data = snapshot.data
+      self._data_version = snapshot.version
+      # Stale, so the first command also starts a fetch.
+      self._cached_time = 0
+      self._snapshot_time = snapshot.fetched_time
+      self._snapshot_version = snapshot.version
+      self._is_cached_from_snapshot = True
+      self._log.info('Loaded price snapshot, profile="{}", version={}, age={:.0f}s'.format(
+         self._profile.name, snapshot.version, time.time() - snapshot.fetched_time))
+
+   def _save_snapshot(self) -> None:
+      # At most once per interval, and only when the data changed since the last snapshot.
+      if (self._snapshot_store is None) or (self._snapshot_task is not None):
+         return
+      if (self._cached_time - self._snapshot_time) < self._snapshot_interval:
+         return
+      if self._data_version == self._snapshot_version:
+         return
+      snapshot = PriceSnapshot(self._cached_data, self._data_version, self._cached_time,
+                               self._starting_time, self._max_turn)
+      self._snapshot_time = self._cached_time
+      self._snapshot_version = self._data_version
+      self._snapshot_task = asyncio.ensure_future(
+         asyncio.to_thread(self._snapshot_store.save, self._profile.name, snapshot))
+      self._snapshot_task.add_done_callback(self._on_snapshot_done)
+
+   def _on_snapshot_done(self, task: asyncio.Future) -> None:
+      self._snapshot_task = None
+      if not task.cancelled() and task.exception():
+         self._log.error('Failed saving price snapshot, exception="{}"'.format(repr(task.exception())))
 
-   def _should_use_cache(self) -> bool:
-      return ((self._cached_data is not None) and
-              ((time.time() - self._cached_time) <= self._cache_fresh_time))
+   def _should_use_cache(self, max_age: Optional[float] = None) -> bool:
+      max_age = self._cache_fresh_time if max_age is None else max_age
+      return (self._cached_data is not None) and ((time.time() - self._cached_time) <= max_age)
 
    def _get_change_percent(self, before: int, after: int) -> float:
       return round(100 * ((after - before) / before), 2)
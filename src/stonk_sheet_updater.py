@@ -1,52 +1,65 @@
+from __future__ import annotations
+
 import os
 import json
 import logging
 
-import gspread_formatting as gsf
-
+from lazy_loader import lazy_import
 from config_loader import config
 from logging_utils import logger_factory
+from metrics import ERRORS, STAGE_SECONDS
+from live_profiler import profiler_hook
 from stonk_sheet_base import StonkSheetBase
+from sheet_profiles import SheetProfile
 from tip_recognizer import Tip
 
+gspread = lazy_import('gspread')
+gsf = lazy_import('gspread_formatting')
+
 
 class StonkSheetUpdater(StonkSheetBase):
    CONFIG_SECTION = 'stonk-sheet-updater'
    PRICE_CELL_FORMAT = os.path.join(os.environ['TEMPLATES_DIR'], 'price_cell_format.json')
    CHANGE_CELL_FORMAT = os.path.join(os.environ['TEMPLATES_DIR'], 'change_cell_format.json')
 
-   def __init__(self) -> None:
+   def __init__(self, profile: SheetProfile) -> None:
       self._setup_logging()
-      self._setup_stonk_sheet()
       self._incl_change_update = config.getboolean(self.CONFIG_SECTION, 'incl_change_update')
       self._incl_action_update = config.getboolean(self.CONFIG_SECTION, 'incl_action_update')
+      # Setup conditional format rules for change columns, once the worksheet is opened.
+      self._setup_stonk_sheet(profile, self._setup_change_format_rules if self._incl_change_update else None)
       with open(self.PRICE_CELL_FORMAT, 'r') as file:
          self._price_cell_format = json.load(file)
       with open(self.CHANGE_CELL_FORMAT, 'r') as file:
          self._change_cell_format = json.load(file)
-      if self._incl_change_update:
-         # Setup conditional format rules for change columns.
-         self._setup_change_format_rules()
 
-   def update_sheet(self, tip: Tip) -> None:
-      self._update_price(tip)
-      if self._incl_change_update:
-         self._update_change(tip)
-      if self._incl_action_update:
-         self._update_action(tip)
+   @profiler_hook('update_sheet')
+   async def update_sheet(self, tip: Tip) -> None:
+      try:
+         with STAGE_SECONDS.labels('sheet_update_price').time():
+            await self._update_price(tip)
+         if self._incl_change_update:
+            with STAGE_SECONDS.labels('sheet_update_change').time():
+               await self._update_change(tip)
+         if self._incl_action_update:
+            with STAGE_SECONDS.labels('sheet_update_action').time():
+               await self._update_action(tip)
+      except Exception:
+         ERRORS.labels('sheets').inc()
+         raise
 
-   def _update_price(self, tip: Tip) -> None:
-      col = self.PRICE_COLUMNS[tip.hero_town.value]
+   async def _update_price(self, tip: Tip) -> None:
+      col = self._price_columns[tip.hero_town.value]
       src_cell = self._get_turn_acell(col, tip.current_turn)
       dst_cell = self._get_turn_acell(col, tip.target_turn)
       op, abs_price_change = tip.get_price_change_op_and_abs()
       dst_value = '=HYPERLINK("{}", IF(ISNUMBER({}), {} {} {}, "T{} {} {}"))'.format(
          tip.url, src_cell, src_cell, op, abs_price_change, tip.current_turn, op, abs_price_change)
-      self._sheet.update(dst_cell, dst_value, raw=False)
-      self._sheet.format(dst_cell, self._price_cell_format)
+      await self._sheet.update(dst_cell, dst_value, raw=False)
+      await self._sheet.format(dst_cell, self._price_cell_format)
 
-   def _update_change(self, tip: Tip) -> None:
-      price_col = self.PRICE_COLUMNS[tip.hero_town.value]
+   async def _update_change(self, tip: Tip) -> None:
+      price_col = self._price_columns[tip.hero_town.value]
       start_cell = self._get_fixed_row_turn_acell(price_col, 1)
       end_cell = self._get_turn_acell(price_col, tip.target_turn - 1)
       target_cell = self._get_turn_acell(price_col, tip.target_turn)
@@ -62,12 +75,12 @@ class StonkSheetUpdater(StonkSheetBase):
       dst_value = '=IF(ISNUMBER({}), CONCATENATE({}, ABS({}), "%"), "")'.format(
          target_cell, sign_formula, change_formula)
       # Edit destination cell.
-      change_col = self.CHANGE_COLUMNS[tip.hero_town.value]
+      change_col = self._change_columns[tip.hero_town.value]
       dst_cell = self._get_turn_acell(change_col, tip.target_turn)
-      self._sheet.update(dst_cell, dst_value, raw=False)
-      self._sheet.format(dst_cell, self._change_cell_format)
+      await self._sheet.update(dst_cell, dst_value, raw=False)
+      await self._sheet.format(dst_cell, self._change_cell_format)
 
-   def _update_action(self, tip: Tip) -> None:
+   async def _update_action(self, tip: Tip) -> None:
       # TODO: Meh, too much effort to automate this effectively.
       pass
 
@@ -75,15 +88,16 @@ class StonkSheetUpdater(StonkSheetBase):
       self._log = logger_factory.get_logger('stonk-sheet-updater')
       self._log.setLevel(logging.INFO)
 
-   def _setup_change_format_rules(self):
-      rules = gsf.get_conditional_format_rules(self._sheet)
+   def _setup_change_format_rules(self, worksheet: gspread.Worksheet) -> None:
+      # Done once when the worksheet is opened, already on the sheet's executor thread.
+      rules = gsf.get_conditional_format_rules(worksheet)
       rules.clear()
       cell_ranges = []
-      for _, col in self.CHANGE_COLUMNS.items():
+      for _, col in self._change_columns.items():
          start_cell = self._get_turn_acell(col, 1)
          end_cell = self._get_turn_acell(col, self._max_turn)
          cell_range = '{}:{}'.format(start_cell, end_cell)
-         cell_ranges.append(gsf.GridRange.from_a1_range(cell_range, self._sheet))
+         cell_ranges.append(gsf.GridRange.from_a1_range(cell_range, worksheet))
       inc_price_rule = gsf.ConditionalFormatRule(
          ranges=cell_ranges,
          booleanRule=gsf.BooleanRule(
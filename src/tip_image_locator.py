@@ -0,0 +1,360 @@
+from __future__ import annotations
+
+import math
+from typing import Optional
+
+from lazy_loader import lazy_import
+from basic_utils import BasicUtils
+from config_loader import config
+
+numpy = lazy_import('numpy')
+cv2 = lazy_import('cv2')
+
+
+class OpenCVError(Exception):
+   pass
+
+
+class TipRegionCandidate(object):
+   def __init__(self, curturn_contour: numpy.ndarray, content_contour: numpy.ndarray,
+                score: float, threshold: int) -> None:
+      self.curturn_contour = curturn_contour
+      self.content_contour = content_contour
+      self.score = score
+      self.threshold = threshold
+      self.content_area = cv2.contourArea(content_contour)
+      curturn_x, curturn_y, curturn_w, curturn_h = cv2.boundingRect(curturn_contour)
+      content_x, content_y, content_w, content_h = cv2.boundingRect(content_contour)
+      self.left = min(curturn_x, content_x)
+      self.top = min(curturn_y, content_y)
+      self.right = max(curturn_x + curturn_w, content_x + content_w)
+      self.bottom = max(curturn_y + curturn_h, content_y + content_h)
+
+   def is_better_than(self, other: Optional['TipRegionCandidate'], min_score: float) -> bool:
+      if other is None:
+         return True
+      # Among acceptable candidates, the largest tip's box wins since it is the latest tip.
+      if (self.score >= min_score) and (other.score >= min_score):
+         return self.content_area > other.content_area
+      return self.score > other.score
+
+   def overlaps(self, other: 'TipRegionCandidate') -> bool:
+      return ((self.left < other.right) and (other.left < self.right) and
+              (self.top < other.bottom) and (other.top < self.bottom))
+
+
+class TipImageLocator(object):
+   # Shares the config section with the recognizer since the locator used to be a part of it.
+   CONFIG_SECTION = 'tip-recognizer'
+   ENCODING_EXT = '.png'
+   # Number of largest inner-most contours paired with each other when looking for the tip's boxes.
+   MAX_PAIRED_CONTOURS = 8
+   # Number of largest boxes checked when looking for the tip history.
+   MAX_HISTORY_BOXES = 8
+   # A tip history's box is much wider than tall, and split by a vertical line somewhere in this
+   # range of its width. The line covers most of the box's height, but not all of it.
+   MIN_HISTORY_BOX_ASPECT_RATIO = 4
+   HISTORY_DIVIDER_RANGE = (0.08, 0.35)
+   MIN_HISTORY_DIVIDER_COVERAGE = 0.8
+   # Black pixels between the tips stacked or packed into a single image, so no word spans 2 tips.
+   TIP_STACK_GAP = 16
+   # Pixels (at full resolution) around the boxes found at low resolution, searched again at full
+   # resolution, on top of the pixels a single low resolution pixel spans.
+   COARSE_SEARCH_MARGIN = 16
+
+   def __init__(self) -> None:
+      self._border_threshold = config.getint(self.CONFIG_SECTION, 'latest_tip_border_threshold')
+      self._extra_border_thresholds = BasicUtils.get_int_list_from_csv(
+         config.get(self.CONFIG_SECTION, 'extra_tip_border_thresholds'))
+      self._use_otsu_threshold = config.getboolean(self.CONFIG_SECTION, 'use_otsu_tip_border_threshold')
+      self._min_region_score = config.getfloat(self.CONFIG_SECTION, 'min_tip_region_score')
+      self._extract_tip_history = config.getboolean(self.CONFIG_SECTION, 'extract_tip_history')
+      self._history_border_threshold = config.getint(self.CONFIG_SECTION, 'tip_history_border_threshold')
+      self._coarse_search_max_size = config.getint(self.CONFIG_SECTION, 'coarse_tip_search_max_size')
+
+   def decode_image(self, image_data: bytes) -> numpy.ndarray:
+      image = None
+      if len(image_data) > 0:
+         image = cv2.imdecode(numpy.frombuffer(image_data, dtype='uint8'), cv2.IMREAD_COLOR)
+      if image is None:
+         raise OpenCVError('Cannot decode image, size={}'.format(len(image_data)))
+      return image
+
+   def encode_image(self, image: numpy.ndarray) -> bytes:
+      success, encoded_image = cv2.imencode(self.ENCODING_EXT, image)
+      if not success:
+         raise OpenCVError('Cannot encode image, shape={}'.format(image.shape))
+      return encoded_image.tobytes()
+
+   @staticmethod
+   def get_device_profile(image: numpy.ndarray) -> str:
+      # Screenshots taken on the same device share the same resolution, and so the same look.
+      height, width = image.shape[:2]
+      return '{}x{}'.format(width, height)
+
+   def extract_tip_images(self, image: numpy.ndarray,
+                          preferred_threshold: Optional[int] = None) -> tuple[list[numpy.ndarray], Optional[int]]:
+      # The latest tip comes first, followed by the tips of the history from top to bottom.
+      # The returned threshold is the one which located the latest tip, None if it was a poor match.
+      grayscale = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+      latest_candidate = self._locate_latest_tip_region(grayscale, preferred_threshold)
+      candidates = [latest_candidate]
+      if self._extract_tip_history:
+         history_candidates = self._locate_tip_history_regions(grayscale)
+         if ((latest_candidate.score < self._min_region_score) and
+               any(candidate.overlaps(latest_candidate) for candidate in history_candidates)):
+            # A poor match for the latest tip, on top of tips of the history. Likely a cropped
+            # screenshot of older tips.
+            candidates = history_candidates
+         else:
+            candidates += [candidate for candidate in history_candidates
+                           if not candidate.overlaps(latest_candidate)]
+      tip_images = [self._crop_tip_region(image, candidate) for candidate in candidates]
+      threshold = latest_candidate.threshold if latest_candidate.score >= self._min_region_score else None
+      return tip_images, threshold
+
+   def stack_tip_images(self, tip_images: list[numpy.ndarray]
+                        ) -> tuple[numpy.ndarray, list[tuple[int, int, int, int]]]:
+      # Stacks the tips vertically so they can be read by a single OCR request. Also returns the
+      # region (x, y, w, h) of each tip, to split the text back.
+      width = max(tip_image.shape[1] for tip_image in tip_images)
+      rows = []
+      tip_regions = []
+      top = 0
+      for idx, tip_image in enumerate(tip_images):
+         bottom_gap = self.TIP_STACK_GAP if idx < len(tip_images) - 1 else 0
+         rows.append(cv2.copyMakeBorder(tip_image, top=0, bottom=bottom_gap, left=0,
+            right=width - tip_image.shape[1], borderType=cv2.BORDER_CONSTANT, value=0))
+         tip_regions.append((0, top, tip_image.shape[1], tip_image.shape[0]))
+         top += tip_image.shape[0] + bottom_gap
+      return cv2.vconcat(rows), tip_regions
+
+   def pack_tip_images(self, images: list[numpy.ndarray], max_width: int
+                       ) -> tuple[numpy.ndarray, list[tuple[int, int]]]:
+      # Packs several images (each holding stacked tips) into a single mosaic, in shelves of at
+      # most max_width pixels, tallest first. Also returns the offset (x, y) of each image.
+      max_width = max([max_width] + [image.shape[1] for image in images])
+      order = sorted(range(len(images)), reverse=True, key=lambda idx: images[idx].shape[0])
+      offsets = [(0, 0)] * len(images)
+      x = 0
+      y = 0
+      shelf_height = 0
+      for idx in order:
+         height, width = images[idx].shape[:2]
+         if (x > 0) and (x + width > max_width):
+            x = 0
+            y += shelf_height + self.TIP_STACK_GAP
+            shelf_height = 0
+         offsets[idx] = (x, y)
+         x += width + self.TIP_STACK_GAP
+         shelf_height = max(shelf_height, height)
+      mosaic_width = max(offset[0] + image.shape[1] for offset, image in zip(offsets, images))
+      mosaic = numpy.zeros((y + shelf_height, mosaic_width, 3), dtype=numpy.uint8)
+      for (x, y), image in zip(offsets, images):
+         mosaic[y:y + image.shape[0], x:x + image.shape[1]] = image
+      return mosaic, offsets
+
+   def _locate_latest_tip_region(self, grayscale: numpy.ndarray, preferred_threshold: Optional[int]
+                                 ) -> TipRegionCandidate:
+      # Finding the tip's boxes costs more than linearly with the size of the screenshot. On large
+      # screenshots, find them on a downscaled level of the image pyramid first, then only search
+      # around them at full resolution. Searching the whole screenshot, with Otsu's threshold, is
+      # left for when that doesn't find them clearly, so the result is the same either way.
+      coarse_region = self._locate_coarse_tip_region(grayscale, preferred_threshold)
+      if coarse_region is not None:
+         left, top, right, bottom = coarse_region
+         region = grayscale[top:bottom, left:right]
+         candidate = self._search_latest_tip_region(
+            region, self._get_thresholds(preferred_threshold), self._get_histogram(region), (left, top))
+         if (candidate is not None) and (candidate.score >= self._min_region_score):
+            return candidate
+      histogram = self._get_histogram(grayscale)
+      candidate = self._search_latest_tip_region(
+         grayscale, self._get_thresholds(preferred_threshold, histogram), histogram)
+      if candidate is None:
+         raise OpenCVError('Cannot locate contours surrounding the latest tip')
+      return candidate
+
+   def _locate_coarse_tip_region(self, grayscale: numpy.ndarray, preferred_threshold: Optional[int]
+                                 ) -> Optional[tuple[int, int, int, int]]:
+      # Region (left, top, right, bottom) of the latest tip found on a downscaled screenshot, if the
+      # screenshot is large and the tip clearly found.
+      if self._coarse_search_max_size <= 0:
+         return None
+      height, width = grayscale.shape
+      coarse = grayscale
+      scale = 1
+      while max(coarse.shape) > self._coarse_search_max_size:
+         coarse = cv2.pyrDown(coarse)
+         scale /= 2
+      if scale == 1:
+         return None
+      candidate = self._search_latest_tip_region(
+         coarse, self._get_thresholds(preferred_threshold), self._get_histogram(coarse))
+      if (candidate is None) or (candidate.score < self._min_region_score):
+         return None
+      # The candidate's coordinates include the 1-pixel border drawn around the binary image.
+      margin = self.COARSE_SEARCH_MARGIN + math.ceil(1 / scale)
+      return (max(int((candidate.left - 1) / scale) - margin, 0),
+              max(int((candidate.top - 1) / scale) - margin, 0),
+              min(math.ceil((candidate.right - 1) / scale) + margin, width),
+              min(math.ceil((candidate.bottom - 1) / scale) + margin, height))
+
+   def _search_latest_tip_region(self, grayscale: numpy.ndarray, thresholds: list[int], histogram: numpy.ndarray,
+                                 offset: tuple[int, int] = (0, 0)) -> Optional[TipRegionCandidate]:
+      # Number of pixels above each threshold. Thresholds with the same count produce the exact
+      # same binary image, so only the first of them is tried.
+      white_counts = grayscale.size - numpy.cumsum(histogram)
+      tried_white_counts = set()
+      best_candidate = None
+      fallback_candidate = None
+      for threshold in thresholds:
+         if white_counts[threshold] in tried_white_counts:
+            continue
+         tried_white_counts.add(white_counts[threshold])
+         candidate, largest_pair = self._find_tip_region_candidate(grayscale, threshold, offset)
+         if fallback_candidate is None:
+            fallback_candidate = largest_pair
+         if (candidate is not None) and candidate.is_better_than(best_candidate, self._min_region_score):
+            best_candidate = candidate
+         if (best_candidate is not None) and (best_candidate.score >= self._min_region_score):
+            break
+      if (best_candidate is None) or (best_candidate.score <= 0):
+         # Nothing looks like the tip's boxes. Fall back to the 2 largest, inner-most contours.
+         best_candidate = fallback_candidate
+      return best_candidate
+
+   def _locate_tip_history_regions(self, grayscale: numpy.ndarray) -> list[TipRegionCandidate]:
+      # The tip history's boxes have dimmer borders, and each is a single box split by a line
+      # which doesn't reach its borders. Their text is brighter than the borders, so look for
+      # the holes within the borders rather than for inner-most contours, then for the line.
+      _, binary = cv2.threshold(grayscale, self._history_border_threshold, 255, cv2.THRESH_BINARY)
+      binary = cv2.copyMakeBorder(binary, top=1, bottom=1, left=1, right=1,
+         borderType=cv2.BORDER_CONSTANT, value=255)
+      contours, hierarchy = cv2.findContours(binary, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
+      if not contours:
+         return []
+      # With 2 levels of hierarchy, the contours having a parent are the holes.
+      holes = [contours[idx] for idx, entry in enumerate(hierarchy[0]) if entry[3] != -1]
+      holes.sort(reverse=True, key=cv2.contourArea)
+      binary_height, binary_width = binary.shape
+      candidates = []
+      for hole in holes[:self.MAX_HISTORY_BOXES]:
+         x, y, w, h = cv2.boundingRect(hole)
+         # Skip the inside of the border drawn above.
+         if (x <= 1) or (y <= 1) or (x + w >= binary_width - 1) or (y + h >= binary_height - 1):
+            continue
+         if w < self.MIN_HISTORY_BOX_ASPECT_RATIO * h:
+            continue
+         rectangularity = cv2.contourArea(hole) / (w * h)
+         if rectangularity < self._min_region_score:
+            continue
+         coverage = numpy.count_nonzero(binary[y:y + h, x:x + w], axis=0) / h
+         search_start = int(w * self.HISTORY_DIVIDER_RANGE[0])
+         search_end = int(w * self.HISTORY_DIVIDER_RANGE[1])
+         divider_start = search_start + int(numpy.argmax(coverage[search_start:search_end]))
+         if coverage[divider_start] < self.MIN_HISTORY_DIVIDER_COVERAGE:
+            continue
+         divider_end = divider_start
+         while (divider_end < w) and (coverage[divider_end] >= self.MIN_HISTORY_DIVIDER_COVERAGE):
+            divider_end += 1
+         curturn_contour = self._get_rect_contour(x, y, divider_start, h)
+         content_contour = self._get_rect_contour(x + divider_end, y, w - divider_end, h)
+         candidates.append(TipRegionCandidate(curturn_contour, content_contour, rectangularity,
+                                              self._history_border_threshold))
+      # From top to bottom, which is from the newest to the oldest.
+      candidates.sort(key=lambda candidate: candidate.top)
+      return candidates
+
+   @staticmethod
+   def _get_rect_contour(x: int, y: int, w: int, h: int) -> numpy.ndarray:
+      return numpy.array([[[x, y]], [[x, y + h - 1]], [[x + w - 1, y + h - 1]], [[x + w - 1, y]]], dtype=numpy.int32)
+
+   @staticmethod
+   def _crop_tip_region(image: numpy.ndarray, candidate: TipRegionCandidate) -> numpy.ndarray:
+      # Mask each of the tip's boxes within their bounding rectangle, then put the current turn's
+      # box on top of the content's box.
+      outputs = []
+      for cntr in [candidate.curturn_contour, candidate.content_contour]:
+         x, y, w, h = cv2.boundingRect(cntr)
+         region = image[y:y + h, x:x + w]
+         mask = numpy.zeros(region.shape[:2], dtype=numpy.uint8)
+         cv2.drawContours(mask, [cntr], -1, 255, -1, offset=(-x, -y))
+         outputs.append(cv2.bitwise_and(region, region, mask=mask))
+      width = max(output.shape[1] for output in outputs)
+      outputs = [cv2.copyMakeBorder(output, top=0, bottom=0, left=0, right=width - output.shape[1],
+                    borderType=cv2.BORDER_CONSTANT, value=0) for output in outputs]
+      return cv2.vconcat(outputs)
+
+   def _get_thresholds(self, preferred_threshold: Optional[int], histogram: Optional[numpy.ndarray] = None
+                       ) -> list[int]:
+      # Otsu's threshold is only included given the histogram of the whole screenshot.
+      thresholds = [self._border_threshold] + self._extra_border_thresholds
+      if self._use_otsu_threshold and (histogram is not None):
+         thresholds.append(self._get_otsu_threshold(histogram))
+      if preferred_threshold is not None:
+         thresholds.insert(0, preferred_threshold)
+      return [BasicUtils.clamp_number(threshold, 0, 255) for threshold in thresholds]
+
+   def _find_tip_region_candidate(self, grayscale: numpy.ndarray, threshold: int, offset: tuple[int, int] = (0, 0)
+                                  ) -> tuple[Optional[TipRegionCandidate], Optional[TipRegionCandidate]]:
+      # The offset of a region of the screenshot is added to the contours found in it.
+      _, binary = cv2.threshold(grayscale, threshold, 255, cv2.THRESH_BINARY)
+      # Draw a 1-pixel-wide border around the binary image to help forming a contour for
+      # images in which the author were too lazy to capture the entire latest tip's box.
+      binary = cv2.copyMakeBorder(binary, top=1, bottom=1, left=1, right=1,
+         borderType=cv2.BORDER_CONSTANT, value=255)
+      contours, hierarchy = cv2.findContours(binary, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE, offset=offset)
+      if not contours:
+         return None, None
+      inner_most_contours = []
+      for idx, entry in enumerate(hierarchy[0]):
+         # Inner-most = No child contour.
+         if entry[2] == -1:
+            inner_most_contours.append(contours[idx])
+      if len(inner_most_contours) < 2:
+         return None, None
+      inner_most_contours.sort(reverse=True, key=cv2.contourArea)
+      inner_most_contours = inner_most_contours[:self.MAX_PAIRED_CONTOURS]
+      # Usually, the largest is the tip's content, and the second largest is the tip's current turn.
+      largest_pair = TipRegionCandidate(inner_most_contours[1], inner_most_contours[0], 0, threshold)
+      best_candidate = None
+      for content_idx, content_contour in enumerate(inner_most_contours):
+         for curturn_contour in inner_most_contours[content_idx + 1:]:
+            score = self._get_tip_region_score(curturn_contour, content_contour)
+            candidate = TipRegionCandidate(curturn_contour, content_contour, score, threshold)
+            if candidate.is_better_than(best_candidate, self._min_region_score):
+               best_candidate = candidate
+      return best_candidate, largest_pair
+
+   @staticmethod
+   def _get_tip_region_score(curturn_contour: numpy.ndarray, content_contour: numpy.ndarray) -> float:
+      # The tip is made of 2 rectangular boxes of the same height: the current turn's box directly
+      # followed by the content's box on its right. Score how close the pair is to that, in [0, 1].
+      curturn_x, curturn_y, curturn_w, curturn_h = cv2.boundingRect(curturn_contour)
+      content_x, content_y, content_w, content_h = cv2.boundingRect(content_contour)
+      curturn_rectangularity = cv2.contourArea(curturn_contour) / max(curturn_w * curturn_h, 1)
+      content_rectangularity = cv2.contourArea(content_contour) / max(content_w * content_h, 1)
+      vertical_overlap = max(0, min(curturn_y + curturn_h, content_y + content_h) - max(curturn_y, content_y))
+      vertical_alignment = vertical_overlap / max(curturn_h, content_h, 1)
+      horizontal_gap = content_x - (curturn_x + curturn_w)
+      adjacency = max(0.0, 1 - abs(horizontal_gap) / max(content_h, 1))
+      return curturn_rectangularity * content_rectangularity * vertical_alignment * adjacency
+
+   @staticmethod
+   def _get_histogram(grayscale: numpy.ndarray) -> numpy.ndarray:
+      return numpy.bincount(grayscale.ravel(), minlength=256)
+
+   @staticmethod
+   def _get_otsu_threshold(histogram: numpy.ndarray) -> int:
+      # Otsu's method on the histogram already computed: the threshold maximizing the variance
+      # between the dark and the bright pixels.
+      levels = numpy.arange(histogram.size)
+      weight_dark = numpy.cumsum(histogram).astype(numpy.float64)
+      weight_bright = weight_dark[-1] - weight_dark
+      cum_intensity = numpy.cumsum(histogram * levels).astype(numpy.float64)
+      with numpy.errstate(divide='ignore', invalid='ignore'):
+         mean_dark = cum_intensity / weight_dark
+         mean_bright = (cum_intensity[-1] - cum_intensity) / weight_bright
+         between_variance = weight_dark * weight_bright * (mean_dark - mean_bright) ** 2
+      return int(numpy.argmax(numpy.nan_to_num(between_variance)))
@@ -0,0 +1,256 @@
+import os
+import time
+import pickle
+import asyncio
+import logging
+import sqlite3
+import threading
+from typing import Any, Awaitable, Callable, Optional
+
+from logging_utils import logger_factory
+from metrics import QUEUE_DEPTH, metrics
+from tip_pipeline import TipPipelineResult
+from vision_quota import VisionDeferredError
+
+
+class TipJobFailedError(Exception):
+   pass
+
+
+class TipJob(object):
+   # A tip message handed to the tip workers. Only plain values, the workers have no Discord client.
+   def __init__(self, guild_id: int, channel_id: int, message_id: int, profile_name: str, update_sheet: bool,
+                attachments: list[tuple[str, Optional[str], Optional[int]]]) -> None:
+      self.guild_id = guild_id
+      self.channel_id = channel_id
+      self.message_id = message_id
+      self.profile_name = profile_name
+      self.update_sheet = update_sheet
+      # (URL, content type, size in bytes) of each attachment.
+      self.attachments = attachments
+
+
+class TipJobResult(object):
+   DONE = 'done'
+   DEFERRED = 'deferred'
+   FAILED = 'failed'
+
+   def __init__(self, status: str, pipeline_result: Optional[TipPipelineResult] = None, error: str = '',
+                retry_after: float = 0.0) -> None:
+      self.status = status
+      self.pipeline_result = pipeline_result
+      self.error = error
+      # Seconds before a deferred job may be retried.
+      self.retry_after = retry_after
+
+
+class TipJobQueue(object):
+   # Durable queue of tip jobs shared by the Discord process and the tip workers, in its own SQLite
+   # database so it doesn't contend with the other saved data. Jobs are keyed by message ID, so a
+   # message queued twice (e.g. by the history replay) is only processed once.
+   # A worker claims a job for a lease. Jobs of a worker which died or stalled are claimed again
+   # by another one once their lease expires, up to a max number of attempts.
+   QUEUE_FILE = os.path.join(os.environ['ROOT_DIR'], '.tip_jobs.sqlite3')
+   PICKLE_PROTOCOL = 4
+   PENDING = 'pending'
+   RUNNING = 'running'
+   FINISHED = 'finished'
+
+   def __init__(self, lease_seconds: float, max_attempts: int) -> None:
+      self._setup_logging()
+      self._lease_seconds = lease_seconds
+      self._max_attempts = max_attempts
+      self._lock = threading.Lock()
+      # Transactions are handled explicitly. Writers of other processes are waited for.
+      self._conn = sqlite3.connect(self.QUEUE_FILE, timeout=30, isolation_level=None, check_same_thread=False)
+      self._conn.execute('PRAGMA journal_mode=WAL')
+      self._conn.execute('PRAGMA synchronous=NORMAL')
+      self._conn.execute(
+         'CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, status TEXT NOT NULL, payload BLOB NOT NULL, '
+         'result BLOB, worker TEXT, lease_until REAL, attempts INTEGER NOT NULL DEFAULT 0, '
+         'queued_time REAL NOT NULL)')
+      self._conn.execute('CREATE INDEX IF NOT EXISTS jobs_status_id ON jobs (status, id)')
+
+   def enqueue(self, job_id: int, job: Any) -> bool:
+      # Returns whether the job is new, rather than already queued or running.
+      with self._lock:
+         cursor = self._conn.execute(
+            'INSERT OR IGNORE INTO jobs (id, status, payload, queued_time) VALUES (?, ?, ?, ?)',
+            (job_id, self.PENDING, pickle.dumps(job, protocol=self.PICKLE_PROTOCOL), time.time()))
+      return cursor.rowcount > 0
+
+   def claim(self, worker: str) -> Optional[tuple[int, Any]]:
+      # Takes the oldest pending job, or a job whose lease expired.
+      with self._lock:
+         now = time.time()
+         self._conn.execute('BEGIN IMMEDIATE')
+         try:
+            while True:
+               row = self._conn.execute(
+                  'SELECT id, payload, attempts, worker FROM jobs WHERE status = ? OR (status = ? AND lease_until < ?) '
+                  'ORDER BY id LIMIT 1', (self.PENDING, self.RUNNING, now)).fetchone()
+               if row is None:
+                  self._conn.execute('COMMIT')
+                  return None
+               job_id, payload, attempts, previous_worker = row
+               if attempts >= self._max_attempts:
+                  self._finish_locked(job_id, TipJobResult(
+                     TipJobResult.FAILED, error='Gave up after {} attempts'.format(attempts)))
+                  self._log.error('Gave up tip job, id={}, attempts={}, last_worker="{}"'.format(
+                     job_id, attempts, previous_worker))
+                  continue
+               self._conn.execute(
+                  'UPDATE jobs SET status = ?, worker = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ?',
+                  (self.RUNNING, worker, now + self._lease_seconds, job_id))
+               self._conn.execute('COMMIT')
+               if previous_worker:
+                  self._log.warning('Claimed tip job again, id={}, attempts={}, previous_worker="{}"'.format(
+                     job_id, attempts + 1, previous_worker))
+               return job_id, pickle.loads(payload)
+         except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+
+   def renew(self, job_id: int, worker: str) -> bool:
+      # Extends the lease of a job still being processed. Returns whether the worker still owns it,
+      # rather than it having been claimed by another worker meanwhile.
+      with self._lock:
+         cursor = self._conn.execute(
+            'UPDATE jobs SET lease_until = ? WHERE id = ? AND status = ? AND worker = ?',
+            (time.time() + self._lease_seconds, job_id, self.RUNNING, worker))
+      return cursor.rowcount > 0
+
+   def complete(self, job_id: int, worker: str, result: TipJobResult) -> bool:
+      # Returns whether the result was saved. It isn't if the job was claimed by another worker.
+      with self._lock:
+         self._conn.execute('BEGIN IMMEDIATE')
+         try:
+            row = self._conn.execute('SELECT status, worker FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            is_owner = (row is not None) and (row[0] == self.RUNNING) and (row[1] == worker)
+            if is_owner:
+               self._finish_locked(job_id, result)
+            self._conn.execute('COMMIT')
+         except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+      return is_owner
+
+   def release(self, job_id: int, worker: str) -> None:
+      # Puts back a job its worker failed on, for another attempt.
+      with self._lock:
+         self._conn.execute('UPDATE jobs SET status = ?, lease_until = NULL WHERE id = ? AND status = ? AND worker = ?',
+                            (self.PENDING, job_id, self.RUNNING, worker))
+
+   def pop_results(self) -> list[tuple[int, Any, TipJobResult]]:
+      # Removes the finished jobs. Returns (job ID, job, result) of each.
+      with self._lock:
+         self._conn.execute('BEGIN IMMEDIATE')
+         try:
+            rows = self._conn.execute(
+               'SELECT id, payload, result FROM jobs WHERE status = ? ORDER BY id', (self.FINISHED,)).fetchall()
+            self._conn.executemany('DELETE FROM jobs WHERE id = ?', [(row[0],) for row in rows])
+            self._conn.execute('COMMIT')
+         except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+      return [(job_id, pickle.loads(payload), pickle.loads(result)) for job_id, payload, result in rows]
+
+   def get_max_job_seconds(self) -> float:
+      # How long a job may take over all its attempts, if each of them ran into its lease.
+      return self._lease_seconds * self._max_attempts
+
+   def count_unfinished(self) -> int:
+      with self._lock:
+         return self._conn.execute('SELECT COUNT(*) FROM jobs WHERE status != ?', (self.FINISHED,)).fetchone()[0]
+
+   def _finish_locked(self, job_id: int, result: TipJobResult) -> None:
+      self._conn.execute('UPDATE jobs SET status = ?, result = ?, lease_until = NULL WHERE id = ?',
+                         (self.FINISHED, pickle.dumps(result, protocol=self.PICKLE_PROTOCOL), job_id))
+
+   def _setup_logging(self) -> None:
+      self._log = logger_factory.get_logger('tip-job-queue')
+      self._log.setLevel(logging.INFO)
+
+
+class TipJobDispatcher(object):
+   # Discord process' side of the queue: queues the tip jobs and hands their results back to the
+   # messages waiting for them.
+   JOBS = metrics.counter('tip_jobs', 'Number of finished tip jobs, by status.', ('status',))
+
+   def __init__(self, queue: TipJobQueue, poll_interval: float,
+                on_orphan_result: Callable[[TipJob, TipJobResult], Awaitable[None]]) -> None:
+      self._setup_logging()
+      self._queue = queue
+      self._poll_interval = poll_interval
+      # Results of jobs still not finished by then are replied to as orphans, if ever.
+      self._wait_timeout = queue.get_max_job_seconds() + poll_interval
+      # Called with the results of jobs nobody waits for anymore, e.g. queued before a restart.
+      self._on_orphan_result = on_orphan_result
+      self._waiters: dict[int, asyncio.Future] = {}
+      self._poll_task = None
+      self._orphan_tasks = set()
+
+   def start(self) -> None:
+      if self._poll_task is None:
+         self._poll_task = asyncio.create_task(self._poll_results())
+
+   def stop(self) -> None:
+      if self._poll_task:
+         self._poll_task.cancel()
+         self._poll_task = None
+
+   async def run(self, job: TipJob) -> TipPipelineResult:
+      # Raises VisionDeferredError if the job should be retried later, TipJobFailedError if no
+      # worker could process it in time.
+      waiter = self._waiters.get(job.message_id)
+      if waiter is None:
+         waiter = asyncio.get_running_loop().create_future()
+         self._waiters[job.message_id] = waiter
+         is_new = await asyncio.to_thread(self._queue.enqueue, job.message_id, job)
+         self._log.info('{} tip job, id={}, attachments={}'.format(
+            'Queued' if is_new else 'Waiting for queued', job.message_id, len(job.attachments)))
+      try:
+         result = await asyncio.wait_for(asyncio.shield(waiter), self._wait_timeout)
+      except asyncio.TimeoutError:
+         # Likely no worker is running. Fails every caller waiting for the same job.
+         if self._waiters.get(job.message_id) is waiter:
+            del self._waiters[job.message_id]
+         if not waiter.done():
+            self._log.error('Timed out waiting for tip job, id={}, timeout={}'.format(
+               job.message_id, self._wait_timeout))
+            waiter.set_result(TipJobResult(
+               TipJobResult.FAILED, error='Timed out after {} seconds'.format(self._wait_timeout)))
+         result = waiter.result()
+      return self.get_pipeline_result(result)
+
+   async def _poll_results(self) -> None:
+      while True:
+         await asyncio.sleep(self._poll_interval)
+         try:
+            results = await asyncio.to_thread(self._queue.pop_results)
+            QUEUE_DEPTH.labels('tip_jobs').set(await asyncio.to_thread(self._queue.count_unfinished))
+         except Exception as e:
+            self._log.error('Failed polling tip job results, exception="{}"'.format(repr(e)))
+            continue
+         for job_id, job, result in results:
+            self.JOBS.labels(result.status).inc()
+            waiter = self._waiters.pop(job_id, None)
+            if waiter is not None:
+               if not waiter.done():
+                  waiter.set_result(result)
+               continue
+            task = asyncio.create_task(self._on_orphan_result(job, result))
+            self._orphan_tasks.add(task)
+            task.add_done_callback(self._orphan_tasks.discard)
+
+   @staticmethod
+   def get_pipeline_result(result: TipJobResult) -> TipPipelineResult:
+      if result.status == TipJobResult.DEFERRED:
+         raise VisionDeferredError(result.error, result.retry_after)
+      if result.status == TipJobResult.FAILED:
+         raise TipJobFailedError(result.error)
+      return result.pipeline_result
+
+   def _setup_logging(self) -> None:
+      self._log = logger_factory.get_logger('tip-job-dispatcher')
+      self._log.setLevel(logging.INFO)
@@ -0,0 +1,125 @@
+import enum
+import time
+import logging
+import sqlite3
+import threading
+from typing import Optional
+
+from logging_utils import logger_factory
+from metrics import metrics
+from simple_data_saver import SimpleDataSaver, simple_saver
+from shared_constants import HeroTown
+from tip_recognizer import Tip
+
+
+class TipLedgerStatus(enum.Enum):
+   NEW = 'new'
+   DUPLICATE = 'duplicate'
+   CONFLICT = 'conflict'
+   # The cell is reserved by another message, whose write may still fail.
+   PENDING = 'pending'
+
+
+class TipLedger(object):
+   # Tips written to a sheet during one event, in a table of the saved data's database shared by
+   # the bot and its tip workers. Only 1 tip can be written to a (town, target turn) cell, so that
+   # is the ledger's key: a tip reserves its cell before being written to the sheet, atomically,
+   # so the same cell is never written twice at once, by this process or another one.
+   # Saved as a list of items by older versions.
+   LEGACY_SAVE_KEY = 'tip-ledger-{}-{}'
+   # Number of seconds after which a cell reserved but never written (e.g. its process was killed
+   # while writing) can be reserved again.
+   RESERVATION_TIMEOUT = 600
+   LOOKUPS = metrics.counter(
+      'tip_ledger_lookups', 'Number of tips looked up in the tip ledger, by result.', ('result',))
+
+   def __init__(self, profile_name: str, event_id: str) -> None:
+      self._setup_logging()
+      self._ledger_key = '{}-{}'.format(profile_name, event_id)
+      self._lock = threading.Lock()
+      # Transactions are handled explicitly. Writers of other processes are waited for.
+      self._conn = sqlite3.connect(SimpleDataSaver.SAVE_FILE, timeout=30, isolation_level=None,
+                                   check_same_thread=False)
+      self._conn.execute(
+         'CREATE TABLE IF NOT EXISTS tip_ledger (ledger TEXT NOT NULL, hero_town TEXT NOT NULL, '
+         'target_turn INTEGER NOT NULL, current_turn INTEGER NOT NULL, price_change INTEGER NOT NULL, '
+         'url TEXT, written INTEGER NOT NULL, reserved_time REAL NOT NULL, '
+         'PRIMARY KEY (ledger, hero_town, target_turn))')
+      self._migrate_legacy_ledger(self.LEGACY_SAVE_KEY.format(profile_name, event_id))
+      count = self._conn.execute('SELECT COUNT(*) FROM tip_ledger WHERE ledger = ? AND written = 1',
+                                 (self._ledger_key,)).fetchone()[0]
+      self._log.info('Loaded tip ledger, key="{}", count={}'.format(self._ledger_key, count))
+
+   def reserve(self, tip: Tip) -> tuple[TipLedgerStatus, Optional[Tip]]:
+      # Returns the status of the given tip, and the recorded (or being written) tip for the same
+      # cell if any. A NEW tip holds its cell until confirm() or release(). A PENDING tip should be
+      # looked up again once the tip being written is confirmed or released.
+      now = time.time()
+      with self._lock:
+         self._conn.execute('BEGIN IMMEDIATE')
+         try:
+            row = self._conn.execute(
+               'SELECT current_turn, price_change, url, written, reserved_time FROM tip_ledger '
+               'WHERE ledger = ? AND hero_town = ? AND target_turn = ?',
+               (self._ledger_key, tip.hero_town.value, tip.target_turn)).fetchone()
+            if (row is None) or (not row[3] and (now - row[4]) > self.RESERVATION_TIMEOUT):
+               self._conn.execute(
+                  'INSERT OR REPLACE INTO tip_ledger (ledger, hero_town, target_turn, current_turn, price_change, '
+                  'url, written, reserved_time) VALUES (?, ?, ?, ?, ?, ?, 0, ?)',
+                  (self._ledger_key, tip.hero_town.value, tip.target_turn, tip.current_turn, tip.price_change,
+                   tip.url, now))
+               row = None
+            self._conn.execute('COMMIT')
+         except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+      if row is None:
+         status, recorded_tip = TipLedgerStatus.NEW, None
+      else:
+         recorded_tip = Tip(tip.hero_town, row[0], tip.target_turn, row[1])
+         recorded_tip.url = row[2]
+         if not row[3]:
+            status = TipLedgerStatus.PENDING
+         elif (recorded_tip.current_turn == tip.current_turn) and (recorded_tip.price_change == tip.price_change):
+            status = TipLedgerStatus.DUPLICATE
+         else:
+            status = TipLedgerStatus.CONFLICT
+      self.LOOKUPS.labels(status.value).inc()
+      return status, recorded_tip
+
+   def confirm(self, tip: Tip) -> None:
+      # Called once the reserved tip is written to the sheet.
+      with self._lock:
+         self._conn.execute('UPDATE tip_ledger SET written = 1 WHERE ledger = ? AND hero_town = ? AND target_turn = ?',
+                            (self._ledger_key, tip.hero_town.value, tip.target_turn))
+
+   def release(self, tip: Tip) -> None:
+      # Frees the cell of a reserved tip which could not be written.
+      with self._lock:
+         self._conn.execute(
+            'DELETE FROM tip_ledger WHERE ledger = ? AND hero_town = ? AND target_turn = ? AND written = 0',
+            (self._ledger_key, tip.hero_town.value, tip.target_turn))
+
+   def _migrate_legacy_ledger(self, legacy_save_key: str) -> None:
+      entries = simple_saver.get_items(legacy_save_key)
+      if not entries:
+         return
+      with self._lock:
+         self._conn.execute('BEGIN IMMEDIATE')
+         try:
+            self._conn.executemany(
+               'INSERT OR IGNORE INTO tip_ledger (ledger, hero_town, target_turn, current_turn, price_change, url, '
+               'written, reserved_time) VALUES (?, ?, ?, ?, ?, ?, 1, ?)',
+               [(self._ledger_key, hero_town_name, target_turn, current_turn, price_change, url, time.time())
+                for hero_town_name, current_turn, target_turn, price_change, url in entries])
+            self._conn.execute('COMMIT')
+         except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+      simple_saver.clear_items(legacy_save_key)
+      simple_saver.flush()
+      self._log.info('Migrated legacy tip ledger, key="{}", count={}'.format(legacy_save_key, len(entries)))
+
+   def _setup_logging(self) -> None:
+      self._log = logger_factory.get_logger('tip-ledger')
+      self._log.setLevel(logging.INFO)
@@ -0,0 +1,91 @@
+import asyncio
+import logging
+from typing import Any, Callable
+
+from config_loader import config
+from logging_utils import logger_factory
+from metrics import QUEUE_DEPTH, metrics
+from image_worker_pool import ImageWorkerPool
+from tip_image_locator import OpenCVError
+from tip_recognizer import Tip, TipRecognizer
+
+
+class TipOcrBatcher(object):
+   # Collects the tip images of attachments processed at the same time, so the recognizer reads
+   # them all with a single OCR request.
+   CONFIG_SECTION = 'tip-recognizer'
+
+   def __init__(self, tip_recognizer: TipRecognizer, image_pool: ImageWorkerPool) -> None:
+      self._setup_logging()
+      self._tip_recognizer = tip_recognizer
+      self._image_pool = image_pool
+      self._mosaic_max_width = config.getint(self.CONFIG_SECTION, 'ocr_mosaic_max_width')
+      self._max_batch_images = config.getint(self.CONFIG_SECTION, 'ocr_batch_max_images')
+      self._max_batch_delay = config.getfloat(self.CONFIG_SECTION, 'ocr_batch_max_delay')
+      self._batch_images = metrics.histogram(
+         'ocr_batch_images', 'Number of images read by each OCR request.', buckets=(1, 2, 4, 8, 16, 32))
+      # Each entry is (tip image, tip regions, future of the result).
+      self._pending = []
+      self._flush_handle = None
+      # Keep references to the running batches, or they may be garbage collected.
+      self._batch_tasks = set()
+
+   async def process_tip_image(self, tip_image: bytes, tip_regions: list[tuple[int, int, int, int]]
+                               ) -> tuple[bool, list[Tip]]:
+      future = asyncio.get_running_loop().create_future()
+      self._pending.append((tip_image, tip_regions, future))
+      if len(self._pending) >= self._max_batch_images:
+         self._flush()
+      elif self._flush_handle is None:
+         self._flush_handle = asyncio.get_running_loop().call_later(self._max_batch_delay, self._flush)
+      return await future
+
+   def _flush(self) -> None:
+      if self._flush_handle is not None:
+         self._flush_handle.cancel()
+         self._flush_handle = None
+      batch = self._pending
+      self._pending = []
+      if batch:
+         task = asyncio.ensure_future(self._process_batch(batch))
+         self._batch_tasks.add(task)
+         task.add_done_callback(self._batch_tasks.discard)
+
+   async def _process_batch(self, batch: list[tuple[bytes, list[tuple[int, int, int, int]], asyncio.Future]]) -> None:
+      self._batch_images.observe(len(batch))
+      self._log.debug('Reading tip images in one request, count=%d', len(batch))
+      try:
+         if len(batch) == 1:
+            tip_image, tip_regions, _ = batch[0]
+            results = [await self._read_tip_images(self._tip_recognizer.process_tip_image, tip_image, tip_regions)]
+         else:
+            # Packing is CPU-bound, it is done by the image workers like the rest of the image work.
+            try:
+               mosaic, offsets = await self._image_pool.pack_tip_images(
+                  [tip_image for tip_image, _, _ in batch], self._mosaic_max_width)
+            except OpenCVError as e:
+               self._log.error(str(e))
+               results = [(False, []) for _ in batch]
+            else:
+               results = await self._read_tip_images(
+                  self._tip_recognizer.process_packed_tip_images, mosaic, offsets,
+                  [tip_regions for _, tip_regions, _ in batch])
+      except Exception as e:
+         for _, _, future in batch:
+            if not future.done():
+               future.set_exception(e)
+         return
+      for (_, _, future), result in zip(batch, results):
+         # The waiting attachment may have been cancelled meanwhile.
+         if not future.done():
+            future.set_result(result)
+
+   async def _read_tip_images(self, process: Callable[..., Any], *args) -> Any:
+      # The Vision client stays in this process. Run it in a thread to keep the event loop free
+      # for other messages while waiting for the response.
+      with QUEUE_DEPTH.labels('vision').track_inprogress():
+         return await asyncio.to_thread(process, *args)
+
+   def _setup_logging(self) -> None:
+      self._log = logger_factory.get_logger('tip-ocr-batcher')
+      self._log.setLevel(logging.INFO)
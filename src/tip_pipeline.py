@@ -0,0 +1,213 @@
+import time
+import asyncio
+import logging
+from typing import Optional, Protocol
+
+from logging_utils import logger_factory
+from metrics import STAGE_SECONDS
+from tip_image_locator import OpenCVError
+from tip_prefilter import NotATipError
+from tip_recognizer import Tip, TipRecognizer
+from tip_ocr_batcher import TipOcrBatcher
+from image_worker_pool import ImageWorkerPool
+from image_archive import image_archive
+from image_memory_budget import image_memory_budget
+from stonk_sheet_updater import StonkSheetUpdater
+from sheet_profiles import SheetProfileRouter
+from tip_ledger import TipLedger, TipLedgerStatus
+
+
+class TipAttachment(Protocol):
+   # What the pipeline needs from an attachment. Satisfied by discord.Attachment.
+   url: str
+   content_type: Optional[str]
+   # Size in bytes, if known before downloading.
+   size: Optional[int]
+
+   async def read(self) -> bytes:
+      ...
+
+
+class TipPipelineResult(object):
+   # Sent back from the tip workers pickled as a whole, so the duplicate and conflicting tips
+   # still refer to the same objects as in the tips list.
+   def __init__(self, tips: list[Tip], duplicate_tips: list[Tip], conflicting_tips: list[tuple[Tip, Tip]],
+                failed_urls: list[str]) -> None:
+      self.tips = tips
+      self.duplicate_tips = duplicate_tips
+      self.conflicting_tips = conflicting_tips
+      self.failed_urls = failed_urls
+
+
+class TipPipeline(object):
+   # Reads the tips of a message's attachments and writes the new ones to the stonk sheet.
+   # Run by the Discord process itself, or by the tip workers in the split deployment.
+   # Number of seconds between 2 lookups of a tip whose cell is being written by another message,
+   # and max number of seconds waiting for that write (longer than a call to Google Sheets).
+   PENDING_TIP_RETRY_INTERVAL = 0.5
+   PENDING_TIP_MAX_WAIT = 60
+
+   def __init__(self, sheet_profile_router: SheetProfileRouter) -> None:
+      self._setup_logging()
+      self.tip_recognizer = TipRecognizer()
+      self.image_pool = ImageWorkerPool()
+      self._ocr_batcher = TipOcrBatcher(self.tip_recognizer, self.image_pool)
+      # One updater per sheet profile. Tips are written to the sheet of the guild/channel they come from.
+      self.sheet_updaters = {profile.name: StonkSheetUpdater(profile)
+                             for profile in sheet_profile_router.get_profiles()}
+      # Tips already written to each sheet during its current event.
+      self._tip_ledgers = {profile.name: TipLedger(profile.name, profile.get('starting_time'))
+                           for profile in sheet_profile_router.get_profiles()}
+
+   def warm_up(self) -> None:
+      # Blocking. Gets the clients and worker processes ready before the first tip comes in.
+      self.image_pool.warm_up()
+      self.tip_recognizer.warm_up()
+      for profile_name, sheet_updater in self.sheet_updaters.items():
+         try:
+            sheet_updater.warm_up()
+         except Exception as e:
+            self._log.error('Failed opening stonk sheet, profile="{}", exception="{}"'.format(profile_name, repr(e)))
+
+   def shutdown(self) -> None:
+      self.image_pool.shutdown()
+
+   @staticmethod
+   def is_image(content_type: Optional[str]) -> bool:
+      return bool(content_type) and content_type.startswith('image/')
+
+   async def process(self, profile_name: str, attachments: list[TipAttachment],
+                     update_sheet: bool) -> TipPipelineResult:
+      tips, failed_urls = await self._process_attachments(attachments)
+      duplicate_tips = []
+      conflicting_tips = []
+      failed_tips = []
+      # (Sensitive) Add new tips to stonk sheet.
+      if update_sheet and tips:
+         sheet_updater = self.sheet_updaters[profile_name]
+         tip_ledger = self._tip_ledgers[profile_name]
+         for tip in tips:
+            # Reserves the tip's cell, against concurrent messages and the other tip workers.
+            status, recorded_tip = await self._reserve_tip(tip_ledger, tip)
+            if status == TipLedgerStatus.PENDING:
+               # Still not written by the other message. Can't tell whether it will be.
+               self._log.warning('Timed out waiting for tip being written, tip="{}", recorded_url="{}"'.format(
+                  tip.to_string(), recorded_tip.url))
+               failed_tips.append(tip)
+               continue
+            if status == TipLedgerStatus.DUPLICATE:
+               # Same tip posted again, likely by another member. The sheet already has it.
+               duplicate_tips.append(tip)
+               continue
+            if status == TipLedgerStatus.CONFLICT:
+               # Don't overwrite the recorded tip. Let someone check which one is right.
+               self._log.warning('Conflicting tip, tip="{}", recorded_tip="{}", recorded_url="{}"'.format(
+                  tip.to_string(), recorded_tip.to_string(), recorded_tip.url))
+               conflicting_tips.append((tip, recorded_tip))
+               continue
+            try:
+               await sheet_updater.update_sheet(tip)
+            except Exception as e:
+               await asyncio.to_thread(tip_ledger.release, tip)
+               self._log.error('Failed updating stonk sheet, tip="{}", exception="{}"'.format(
+                  tip.to_string(), repr(e)))
+               failed_tips.append(tip)
+               continue
+            except BaseException:
+               # Cancelled. Free the cell now rather than once the reservation times out.
+               tip_ledger.release(tip)
+               raise
+            await asyncio.to_thread(tip_ledger.confirm, tip)
+      if failed_tips:
+         # Not on the sheet. Their images go to the failed-URL pile, to be processed again from ";fails".
+         failed_ids = {id(tip) for tip in failed_tips}
+         tips = [tip for tip in tips if id(tip) not in failed_ids]
+         failed_urls += [url for url in dict.fromkeys(tip.url for tip in failed_tips) if url not in failed_urls]
+      return TipPipelineResult(tips, duplicate_tips, conflicting_tips, failed_urls)
+
+   async def _reserve_tip(self, tip_ledger: TipLedger, tip: Tip) -> tuple[TipLedgerStatus, Optional[Tip]]:
+      # Waits for the outcome of the same cell being written by another message: the tip is a
+      # duplicate once that write is confirmed, and new if it failed.
+      deadline = time.monotonic() + self.PENDING_TIP_MAX_WAIT
+      while True:
+         status, recorded_tip = await asyncio.to_thread(tip_ledger.reserve, tip)
+         if (status != TipLedgerStatus.PENDING) or (time.monotonic() >= deadline):
+            return status, recorded_tip
+         await asyncio.sleep(self.PENDING_TIP_RETRY_INTERVAL)
+
+   async def _process_attachments(self, attachments: list[TipAttachment]) -> tuple[list[Tip], list[str]]:
+      # Skip non-image attachments.
+      image_attachments = [attachment for attachment in attachments if self.is_image(attachment.content_type)]
+      # Process all images concurrently so they can be spread over the image worker pool.
+      results = await asyncio.gather(*[self._process_attachment(attachment) for attachment in image_attachments],
+                                     return_exceptions=True)
+      for result in results:
+         if isinstance(result, BaseException):
+            raise result
+      tips = []
+      failed_urls = []
+      for attachment, result in zip(image_attachments, results):
+         if result is None:
+            # Not a tip at all (meme, photo...). Neither a tip nor a failure.
+            continue
+         # An image may hold several tips, some of which may fail while others don't.
+         success, image_tips = result
+         for tip in image_tips:
+            tip.url = attachment.url
+            tips.append(tip)
+         if not success:
+            failed_urls.append(attachment.url)
+      return tips, failed_urls
+
+   async def _process_attachment(self, attachment: TipAttachment) -> Optional[tuple[bool, list[Tip]]]:
+      # The full-size image is only held until the (much smaller) tip image is extracted.
+      async with image_memory_budget.reserve(attachment.size or 0) as memory_reservation:
+         image_data, is_archived = await self._load_attached_image(attachment)
+         if image_data is None:
+            return False, []
+         await memory_reservation.resize(image_memory_budget.get_image_cost(image_data))
+         digest = None
+         archive_file = None
+         if image_archive.enabled and not is_archived:
+            digest = image_archive.get_digest(image_data)
+            archive_file = await asyncio.to_thread(image_archive.get_new_file, digest, image_data)
+         try:
+            tip_image, tip_regions, border_threshold = await self.image_pool.extract_tip_image(
+               image_data, archive_file)
+         except NotATipError as e:
+            if digest is not None:
+               await asyncio.to_thread(image_archive.discard, digest)
+            self._log.info('Skipped image, reason="{}", url="{}"'.format(str(e), attachment.url))
+            return None
+         except OpenCVError as e:
+            self._log.error('{}, url="{}"'.format(str(e), attachment.url))
+            tip_image, tip_regions, border_threshold = None, [], None
+         # Failed images too, they are the ones ";fails" shows.
+         if digest is not None:
+            await asyncio.to_thread(image_archive.add, attachment.url, digest)
+         if tip_image is None:
+            return False, []
+         del image_data
+      success, tips = await self._ocr_batcher.process_tip_image(tip_image, tip_regions)
+      # A threshold is only trusted once the tips it located are read.
+      if success and (border_threshold is not None):
+         self.image_pool.remember_tip_border_threshold(*border_threshold)
+      return success, tips
+
+   async def _load_attached_image(self, attachment: TipAttachment) -> tuple[Optional[bytes], bool]:
+      # Returns the image data, and whether it comes from the image archive rather than from Discord.
+      if image_archive.enabled:
+         image_data = await asyncio.to_thread(image_archive.load, attachment.url)
+         if image_data is not None:
+            return image_data, True
+      try:
+         with STAGE_SECONDS.labels('download').time():
+            return await attachment.read(), False
+      except Exception as e:
+         self._log.error(
+            'Unknown error occurred while fetching image, url="{}", exception="{}"'.format(attachment.url, repr(e)))
+         return None, False
+
+   def _setup_logging(self) -> None:
+      self._log = logger_factory.get_logger('tip-pipeline')
+      self._log.setLevel(logging.INFO)
@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+from lazy_loader import lazy_import
+from basic_utils import BasicUtils
+from config_loader import config
+
+numpy = lazy_import('numpy')
+cv2 = lazy_import('cv2')
+
+
+class NotATipError(Exception):
+   pass
+
+
+class TipPreFilter(object):
+   CONFIG_SECTION = 'tip-prefilter'
+   # Flags decoding the image directly at a fraction of its size. Only JPEG skips computing the
+   # full resolution, other formats (PNG) are fully decoded then resized by OpenCV anyway.
+   REDUCED_DECODE_FLAGS = {
+      1: 'IMREAD_COLOR',
+      2: 'IMREAD_REDUCED_COLOR_2',
+      4: 'IMREAD_REDUCED_COLOR_4',
+      8: 'IMREAD_REDUCED_COLOR_8'
+   }
+
+   def __init__(self) -> None:
+      self.enabled = config.getboolean(self.CONFIG_SECTION, 'enabled')
+      reduced_decode_scale = config.getint(self.CONFIG_SECTION, 'reduced_decode_scale')
+      if reduced_decode_scale not in self.REDUCED_DECODE_FLAGS:
+         raise ValueError('Invalid reduced_decode_scale, value={}, accept={}'.format(
+            reduced_decode_scale, list(self.REDUCED_DECODE_FLAGS.keys())))
+      self._reduced_decode_scale = reduced_decode_scale
+      self._reduced_decode_flag_name = self.REDUCED_DECODE_FLAGS[reduced_decode_scale]
+      self._min_aspect_ratio = config.getfloat(self.CONFIG_SECTION, 'min_aspect_ratio')
+      self._tip_box_hsv_min = tuple(BasicUtils.get_int_list_from_csv(
+         config.get(self.CONFIG_SECTION, 'tip_box_hsv_min')))
+      self._tip_box_hsv_max = tuple(BasicUtils.get_int_list_from_csv(
+         config.get(self.CONFIG_SECTION, 'tip_box_hsv_max')))
+      self._min_tip_box_color_ratio = config.getfloat(self.CONFIG_SECTION, 'min_tip_box_color_ratio')
+      self._min_tip_box_blob_ratio = config.getfloat(self.CONFIG_SECTION, 'min_tip_box_blob_ratio')
+
+   @staticmethod
+   def is_jpeg(image_data: bytes) -> bool:
+      return bytes(image_data[:2]) == b'\xff\xd8'
+
+   def check_image(self, image_data: bytes) -> None:
+      # For JPEG images, checked before their full decode. Raises NotATipError if the image surely
+      # doesn't contain a tip. Images which cannot be decoded are let through, so they fail (and
+      # are reported) like before.
+      image = None
+      if len(image_data) > 0:
+         image = cv2.imdecode(numpy.frombuffer(image_data, dtype='uint8'),
+                              getattr(cv2, self._reduced_decode_flag_name))
+      if image is not None:
+         self._check_reduced_image(image)
+
+   def check_decoded_image(self, image: numpy.ndarray) -> None:
+      # For the other formats, checked on the fully decoded image, reduced the same.
+      if self._reduced_decode_scale > 1:
+         height, width = image.shape[:2]
+         image = cv2.resize(image, (max(width // self._reduced_decode_scale, 1),
+                                    max(height // self._reduced_decode_scale, 1)), interpolation=cv2.INTER_AREA)
+      self._check_reduced_image(image)
+
+   def _check_reduced_image(self, image: numpy.ndarray) -> None:
+      height, width = image.shape[:2]
+      # Tips are screenshots of the game, which is played in landscape.
+      aspect_ratio = width / height
+      if aspect_ratio < self._min_aspect_ratio:
+         raise NotATipError('Aspect ratio too low, value={:.2f}'.format(aspect_ratio))
+      # The tip's boxes are filled with a specific brown color.
+      hsv_image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+      tip_box_mask = cv2.inRange(hsv_image, self._tip_box_hsv_min, self._tip_box_hsv_max)
+      color_ratio = cv2.countNonZero(tip_box_mask) / (width * height)
+      if color_ratio < self._min_tip_box_color_ratio:
+         raise NotATipError('Too few tip box colored pixels, ratio={:.3f}'.format(color_ratio))
+      # And that color is mostly in one place: the boxes, rather than scattered around.
+      contours, _ = cv2.findContours(tip_box_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+      _, _, blob_w, blob_h = cv2.boundingRect(max(contours, key=cv2.contourArea))
+      blob_ratio = (blob_w * blob_h) / (width * height)
+      if blob_ratio < self._min_tip_box_blob_ratio:
+         raise NotATipError('Tip box colored region too small, ratio={:.3f}'.format(blob_ratio))
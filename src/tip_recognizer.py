@@ -1,27 +1,43 @@
+from __future__ import annotations
+
 import re
+import time
+import random
 import logging
+import threading
+import collections
+from concurrent import futures
+from typing import Optional
 
-import numpy
-import cv2
-from google.oauth2 import service_account
-from google.cloud import vision as google_vision
-
+from lazy_loader import lazy_import, startup_profiler
 from config_loader import config
 from logging_utils import logger_factory
+from metrics import ERRORS, STAGE_SECONDS, metrics
+from live_profiler import profiler_hook
+from vision_quota import VisionUnavailableError, vision_quota
 from shared_constants import HeroTown
+from tip_image_locator import OpenCVError, TipImageLocator
 
+numpy = lazy_import('numpy')
+service_account = lazy_import('google.oauth2.service_account')
+google_vision = lazy_import('google.cloud.vision')
+google_exceptions = lazy_import('google.api_core.exceptions')
 
-class OpenCVError(Exception):
-   pass
 
 class GoogleVisionError(Exception):
    pass
 
+class VisionRetryableError(VisionUnavailableError):
+   pass
+
 class TipParsingError(Exception):
    pass
 
 
 class Tip(object):
+   # Tips are kept for a whole event by the tip ledger. Slots keep each one small.
+   __slots__ = ('hero_town', 'current_turn', 'target_turn', 'price_change', 'url')
+
    def __init__(self, hero_town: HeroTown, current_turn: int,
                 target_turn: int, price_change: int) -> None:
       self.hero_town = hero_town
@@ -43,6 +59,15 @@ class Tip(object):
 
 class TipRecognizer(object):
    CONFIG_SECTION = 'tip-recognizer'
+   # Codes (google.rpc.Code) of Vision errors caused by Vision itself rather than by the image:
+   # DEADLINE_EXCEEDED, RESOURCE_EXHAUSTED, INTERNAL, UNAVAILABLE.
+   TRANSIENT_VISION_ERROR_CODES = (4, 8, 13, 14)
+   # Number of recent Vision requests the hedging delay and the latency report are computed from,
+   # and min number of them before hedging.
+   OCR_LATENCY_WINDOW = 200
+   OCR_HEDGE_MIN_SAMPLES = 20
+   OCR_ATTEMPTS = metrics.counter(
+      'ocr_attempts', 'Number of Vision requests sent by the tip recognizer, by kind and result.', ('kind', 'result'))
    SEARCH_KEYWORDS = (
       (HeroTown.CELINE, ['Celine', 'Atelier', '席琳', '谢琳', '工作室', '셀린', '아뜰리에']),
       (HeroTown.CHOCOLAT, ['Chocolat', 'Bakery', '修可兒拉', '巧克莉', '面包店', '쇼콜라', '베이커리']),
@@ -67,84 +92,285 @@ class TipRecognizer(object):
 
    def __init__(self) -> None:
       self._setup_logging()
-      self._setup_gvision()
+      # The client is only created when first needed, or when warming up in the background.
+      self._gvision_client = None
+      self._gvision_client_lock = threading.Lock()
+      self._locator = TipImageLocator()
+      self._mosaic_max_width = config.getint(self.CONFIG_SECTION, 'ocr_mosaic_max_width')
+      self._ocr_deadline = config.getfloat(self.CONFIG_SECTION, 'ocr_deadline') or None
+      self._ocr_max_attempts = config.getint(self.CONFIG_SECTION, 'ocr_max_attempts')
+      self._ocr_retry_backoff = config.getfloat(self.CONFIG_SECTION, 'ocr_retry_backoff')
+      self._ocr_hedging = config.getboolean(self.CONFIG_SECTION, 'ocr_hedging')
+      self._ocr_hedge_percentile = config.getfloat(self.CONFIG_SECTION, 'ocr_hedge_percentile')
+      self._ocr_hedge_min_delay = config.getfloat(self.CONFIG_SECTION, 'ocr_hedge_min_delay')
+      self._ocr_hedge_max_ratio = config.getfloat(self.CONFIG_SECTION, 'ocr_hedge_max_ratio')
+      self._ocr_executor = futures.ThreadPoolExecutor(
+         max_workers=config.getint(self.CONFIG_SECTION, 'ocr_max_workers'), thread_name_prefix='tip-ocr')
+      # Latencies of the recent successful requests, and of the recent OCR calls (retries and hedges
+      # included), in seconds.
+      self._ocr_request_latencies = collections.deque(maxlen=self.OCR_LATENCY_WINDOW)
+      self._ocr_call_latencies = collections.deque(maxlen=self.OCR_LATENCY_WINDOW)
+      self._ocr_stats_lock = threading.Lock()
+      self._ocr_call_count = 0
+      self._ocr_retried_count = 0
+      self._ocr_hedged_count = 0
+
+   def warm_up(self) -> None:
+      self._get_gvision_client()
 
-   def process_tip(self, image: numpy.ndarray) -> tuple[bool, Tip]:
+   def process_tip(self, image: numpy.ndarray) -> tuple[bool, list[Tip]]:
       try:
-         tip_curturn_image, tip_content_image = self._locate_latest_tip_region(image)
-         tip_text = self._do_gvision_ocr_work(cv2.vconcat([tip_curturn_image, tip_content_image]))
-         hero_town = self._get_hero_town_name(tip_text)
-         curr_turn = self._get_current_turn(tip_text)
-         target_turn = self._get_target_turn(tip_text)
-         price_change = self._get_price_change(tip_text)
+         tip_images, _ = self._locator.extract_tip_images(image)
+         tip_image, tip_regions = self._locator.stack_tip_images(tip_images)
+         tip_image = self._locator.encode_image(tip_image)
+      except OpenCVError as e:
+         self._log.error(str(e))
+         return False, []
+      return self.process_tip_image(tip_image, tip_regions)
+
+   @profiler_hook('process_tip')
+   def process_tip_image(self, tip_image: bytes, tip_regions: Optional[list[tuple[int, int, int, int]]] = None
+                         ) -> tuple[bool, list[Tip]]:
+      # All the tips stacked in the image are read by a single OCR request. Succeeds only if
+      # every one of them is parsed, but the parsed ones are returned either way.
+      try:
+         with STAGE_SECONDS.labels('vision').time():
+            tip_texts = self._do_gvision_ocr_work(tip_image, tip_regions)
+      except GoogleVisionError as e:
+         self._log.error(str(e))
+         return False, []
+      return self._parse_tips(tip_texts)
+
+   def process_tip_images(self, tip_images: list[tuple[bytes, list[tuple[int, int, int, int]]]]
+                          ) -> list[tuple[bool, list[Tip]]]:
+      # Tip images of several attachments are packed into a single mosaic, read by a single OCR
+      # request, since Vision bills per request and the tip images are small.
+      # Packed in this process, the bot has the image workers pack them instead.
+      if len(tip_images) == 1:
+         return [self.process_tip_image(*tip_images[0])]
+      try:
+         images = [self._locator.decode_image(tip_image) for tip_image, _ in tip_images]
+         mosaic, offsets = self._locator.pack_tip_images(images, self._mosaic_max_width)
+         mosaic = self._locator.encode_image(mosaic)
+      except OpenCVError as e:
+         self._log.error(str(e))
+         return [(False, []) for _ in tip_images]
+      return self.process_packed_tip_images(mosaic, offsets, [tip_regions for _, tip_regions in tip_images])
+
+   @profiler_hook('process_tip_batch')
+   def process_packed_tip_images(self, mosaic: bytes, offsets: list[tuple[int, int]],
+                                 tip_regions_list: list[list[tuple[int, int, int, int]]]
+                                 ) -> list[tuple[bool, list[Tip]]]:
+      # Reads the mosaic of several tip images, given the offset of each image within it and the
+      # regions of the tips within each image.
+      # Regions of all the tips within the mosaic, and the image each of them comes from.
+      mosaic_regions = []
+      image_indices = []
+      for image_idx, ((offset_x, offset_y), tip_regions) in enumerate(zip(offsets, tip_regions_list)):
+         for x, y, w, h in tip_regions:
+            mosaic_regions.append((offset_x + x, offset_y + y, w, h))
+            image_indices.append(image_idx)
+      try:
+         with STAGE_SECONDS.labels('vision').time():
+            tip_texts = self._do_gvision_ocr_work(mosaic, mosaic_regions)
+      except GoogleVisionError as e:
+         self._log.error(str(e))
+         return [(False, []) for _ in tip_regions_list]
+      results = []
+      for image_idx in range(len(tip_regions_list)):
+         results.append(self._parse_tips([tip_text for tip_text, text_image_idx in zip(tip_texts, image_indices)
+                                          if text_image_idx == image_idx]))
+      return results
+
+   def _parse_tips(self, tip_texts: list[str]) -> tuple[bool, list[Tip]]:
+      tips = []
+      for tip_text in tip_texts:
+         try:
+            with STAGE_SECONDS.labels('parse').time():
+               hero_town = self._get_hero_town_name(tip_text)
+               curr_turn = self._get_current_turn(tip_text)
+               target_turn = self._get_target_turn(tip_text)
+               price_change = self._get_price_change(tip_text)
+         except TipParsingError as e:
+            self._log.error(str(e))
+            continue
          tip = Tip(hero_town, curr_turn, target_turn, price_change)
          self._log.info('Parsed tip: "{}"'.format(tip.to_string()))
-         return True, tip
-      except (OpenCVError, GoogleVisionError, TipParsingError) as e:
-         self._log.error(str(e))
-         return False, Tip(HeroTown.UNKNOWN, -1, -1, 0)
+         tips.append(tip)
+      return len(tips) == len(tip_texts), tips
 
    def _setup_logging(self) -> None:
       self._log = logger_factory.get_logger('tip-recognizer')
       self._log.setLevel(logging.INFO)
 
-   def _setup_gvision(self) -> None:
-      gvision_credentials = service_account.Credentials.from_service_account_file(
-         filename=config.get(self.CONFIG_SECTION, 'gvision_service_account_file'),
-         scopes=['https://www.googleapis.com/auth/cloud-platform'])
-      self._gvision_client = google_vision.ImageAnnotatorClient(credentials=gvision_credentials)
-
-   def _locate_latest_tip_region(self, image: numpy.ndarray) -> tuple[numpy.ndarray, numpy.ndarray]:
-      grayscale = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-      _, binary = cv2.threshold(
-         grayscale, config.getint(self.CONFIG_SECTION, 'latest_tip_border_threshold'),
-         255, cv2.THRESH_BINARY)
-      # Draw a 1-pixel-wide border around the binary image to help forming a contour for
-      # images in which the author were too lazy to capture the entire latest tip's box.
-      binary = cv2.copyMakeBorder(binary, top=1, bottom=1, left=1, right=1,
-         borderType=cv2.BORDER_CONSTANT, value=255)
-      # Find the 2 largest, inner-most contours.
-      # The largest is the tip's content, and the second largest is the tip's current turn.
-      contours, hierarchy = cv2.findContours(binary, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-      if not contours:
-         raise OpenCVError('No contour found')
-      inner_most_contours = []
-      for idx, entry in enumerate(hierarchy[0]):
-         # Inner-most = No child contour.
-         if entry[2] == -1:
-            inner_most_contours.append((idx, contours[idx]))
-      if len(inner_most_contours) < 2:
-         raise OpenCVError('Cannot locate contours surrounding the latest tip')
-      inner_most_contours.sort(reverse=True, key=lambda e: cv2.contourArea(e[1]))
-      first_contour = contours[inner_most_contours[0][0]]
-      second_contour = contours[inner_most_contours[1][0]]
-      # Mask the original image.
-      white_color = (255, 255, 255)
-      outputs = []
-      for cntr in [second_contour, first_contour]:
-         mask = numpy.zeros_like(image)
-         out = numpy.zeros_like(image)
-         cv2.drawContours(mask, [cntr], -1, white_color, -1)
-         out[mask == 255] = image[mask == 255]
-         outputs.append(out)
-      return tuple(outputs)
-
-   def _do_gvision_ocr_work(self, image: numpy.ndarray) -> str:
-      _, encoded_image = cv2.imencode('.png', image)
-      gvision_image = google_vision.Image(content=encoded_image.tobytes())
-      response = self._gvision_client.text_detection(image=gvision_image)
+   def _get_gvision_client(self) -> google_vision.ImageAnnotatorClient:
+      with self._gvision_client_lock:
+         if self._gvision_client is None:
+            with startup_profiler.step('init gvision client'):
+               gvision_credentials = service_account.Credentials.from_service_account_file(
+                  filename=config.get(self.CONFIG_SECTION, 'gvision_service_account_file'),
+                  scopes=['https://www.googleapis.com/auth/cloud-platform'])
+               self._gvision_client = google_vision.ImageAnnotatorClient(credentials=gvision_credentials)
+         return self._gvision_client
+
+   def _do_gvision_ocr_work(self, tip_image: bytes,
+                            tip_regions: Optional[list[tuple[int, int, int, int]]]) -> list[str]:
+      gvision_image = google_vision.Image(content=tip_image)
+      response = self._request_text_detection(gvision_image)
       err_msg = response.error.message
       if err_msg:
+         ERRORS.labels('vision').inc()
          raise GoogleVisionError('Failed GoogleOCR, message="{}"'.format(err_msg))
-      if not response.text_annotations:
-         return ''
-      return response.text_annotations[0].description.replace('\n', ' ')
+      if (tip_regions is None) or (len(tip_regions) == 1):
+         if not response.text_annotations:
+            return ['']
+         return [response.text_annotations[0].description.replace('\n', ' ')]
+      return self._split_text_by_tip_regions(response.full_text_annotation, tip_regions)
+
+   def get_ocr_latency_msg(self) -> str:
+      with self._ocr_stats_lock:
+         latencies = sorted(self._ocr_call_latencies)
+         call_count = self._ocr_call_count
+         retried_count = self._ocr_retried_count
+         hedged_count = self._ocr_hedged_count
+      if not latencies:
+         return 'No OCR request so far.'
+      percentiles = ['p{}: {:.2f}s'.format(percent, latencies[min(int(len(latencies) * percent / 100), len(latencies) - 1)])
+                     for percent in (50, 95, 99)]
+      return 'OCR latency of the last {} requests: {}. Retried: {}, hedged: {} of {} requests.'.format(
+         len(latencies), ', '.join(percentiles), retried_count, hedged_count, call_count)
+
+   def _request_text_detection(self, gvision_image: google_vision.Image) -> google_vision.AnnotateImageResponse:
+      start = time.perf_counter()
+      with self._ocr_stats_lock:
+         self._ocr_call_count += 1
+      try:
+         for attempt in range(1, self._ocr_max_attempts + 1):
+            try:
+               return self._request_text_detection_hedged(gvision_image)
+            except VisionRetryableError as e:
+               if attempt == self._ocr_max_attempts:
+                  raise
+               self._log.warning('Retrying GoogleOCR, attempt={}, error="{}"'.format(attempt, str(e)))
+               if attempt == 1:
+                  with self._ocr_stats_lock:
+                     self._ocr_retried_count += 1
+               # Full jitter: retries of concurrent requests failing together don't come back together.
+               time.sleep(random.uniform(0, self._ocr_retry_backoff * (2 ** (attempt - 1))))
+      finally:
+         with self._ocr_stats_lock:
+            self._ocr_call_latencies.append(time.perf_counter() - start)
+
+   def _request_text_detection_hedged(self, gvision_image: google_vision.Image) -> google_vision.AnnotateImageResponse:
+      primary = self._ocr_executor.submit(self._call_text_detection, gvision_image, 'primary')
+      hedge_delay = self._get_hedge_delay()
+      if hedge_delay is None:
+         return primary.result()
+      done, _ = futures.wait([primary], timeout=hedge_delay)
+      if done or not self._take_hedge():
+         return primary.result()
+      self._log.debug('Hedging GoogleOCR, delay=%.3f', hedge_delay)
+      pending = {primary, self._ocr_executor.submit(self._call_text_detection, gvision_image, 'hedge')}
+      error = None
+      # The first successful response wins. The other request cannot be cancelled once sent, its
+      # response is dropped.
+      while pending:
+         done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+         for future in done:
+            if future.exception() is None:
+               return future.result()
+            error = future.exception()
+      raise error
+
+   def _call_text_detection(self, gvision_image: google_vision.Image, kind: str) -> google_vision.AnnotateImageResponse:
+      # A single request, accounted for even if its response ends up dropped.
+      vision_quota.before_request()
+      start = time.perf_counter()
+      try:
+         # The client's own retries are disabled, so a stalled request is abandoned after the deadline.
+         response = self._get_gvision_client().text_detection(
+            image=gvision_image, retry=None, timeout=self._ocr_deadline)
+      except Exception as e:
+         ERRORS.labels('vision').inc()
+         vision_quota.record_request(False)
+         retryable = isinstance(e, (google_exceptions.DeadlineExceeded, google_exceptions.ServiceUnavailable,
+                                    google_exceptions.InternalServerError, google_exceptions.TooManyRequests,
+                                    google_exceptions.GatewayTimeout))
+         self.OCR_ATTEMPTS.labels(kind, 'retryable_error' if retryable else 'error').inc()
+         error_class = VisionRetryableError if retryable else VisionUnavailableError
+         raise error_class('Failed calling GoogleOCR, exception="{}"'.format(repr(e))) from e
+      err_msg = response.error.message
+      if err_msg and (response.error.code in self.TRANSIENT_VISION_ERROR_CODES):
+         ERRORS.labels('vision').inc()
+         vision_quota.record_request(False)
+         self.OCR_ATTEMPTS.labels(kind, 'retryable_error').inc()
+         raise VisionRetryableError('Failed GoogleOCR, code={}, message="{}"'.format(response.error.code, err_msg))
+      vision_quota.record_request(True)
+      self.OCR_ATTEMPTS.labels(kind, 'success').inc()
+      with self._ocr_stats_lock:
+         self._ocr_request_latencies.append(time.perf_counter() - start)
+      return response
+
+   def _get_hedge_delay(self) -> Optional[float]:
+      if not self._ocr_hedging:
+         return None
+      with self._ocr_stats_lock:
+         if len(self._ocr_request_latencies) < self.OCR_HEDGE_MIN_SAMPLES:
+            return None
+         latencies = sorted(self._ocr_request_latencies)
+      idx = min(int(len(latencies) * self._ocr_hedge_percentile / 100), len(latencies) - 1)
+      return max(latencies[idx], self._ocr_hedge_min_delay)
+
+   def _take_hedge(self) -> bool:
+      # Hedges are capped to a ratio of the requests, so a slow Vision doesn't double the bill.
+      with self._ocr_stats_lock:
+         if self._ocr_hedged_count + 1 > self._ocr_hedge_max_ratio * self._ocr_call_count:
+            return False
+         self._ocr_hedged_count += 1
+         return True
+
+   @staticmethod
+   def _split_text_by_tip_regions(annotation: google_vision.TextAnnotation,
+                                  tip_regions: list[tuple[int, int, int, int]]) -> list[str]:
+      # Rebuild the text of each tip from the words in its region, with the breaks detected by Vision
+      # turned into spaces like in the full text.
+      break_types = google_vision.TextAnnotation.DetectedBreak.BreakType
+      space_breaks = (break_types.SPACE, break_types.SURE_SPACE, break_types.EOL_SURE_SPACE, break_types.LINE_BREAK)
+      tip_texts = [[] for _ in tip_regions]
+      for page in annotation.pages:
+         for block in page.blocks:
+            for paragraph in block.paragraphs:
+               for word in paragraph.words:
+                  vertices = word.bounding_box.vertices
+                  if not vertices:
+                     continue
+                  center_x = (min(vertex.x for vertex in vertices) + max(vertex.x for vertex in vertices)) / 2
+                  center_y = (min(vertex.y for vertex in vertices) + max(vertex.y for vertex in vertices)) / 2
+                  tip_idx = TipRecognizer._get_closest_region_idx(tip_regions, center_x, center_y)
+                  for symbol in word.symbols:
+                     tip_texts[tip_idx].append(symbol.text)
+                     break_type = symbol.property.detected_break.type_
+                     if break_type == break_types.HYPHEN:
+                        tip_texts[tip_idx].append('- ')
+                     elif break_type in space_breaks:
+                        tip_texts[tip_idx].append(' ')
+      return [''.join(tip_text) for tip_text in tip_texts]
+
+   @staticmethod
+   def _get_closest_region_idx(regions: list[tuple[int, int, int, int]], x: float, y: float) -> int:
+      # The region containing the point is at a distance of 0.
+      distances = []
+      for left, top, width, height in regions:
+         dx = max(left - x, 0, x - (left + width))
+         dy = max(top - y, 0, y - (top + height))
+         distances.append(dx * dx + dy * dy)
+      return distances.index(min(distances))
 
    def _get_hero_town_name(self, tip_text: str) -> HeroTown:
       for keywords_group in self.SEARCH_KEYWORDS:
          for keyword in keywords_group[1]:
             if keyword in tip_text:
-               self._log.debug('Matched NPC for tip, keyword="{}", tip="{}"'.format(keyword, tip_text))
+               self._log.debug('Matched NPC for tip, keyword="%s", tip="%s"', keyword, tip_text)
                return keywords_group[0]
       raise TipParsingError('Unknown NPC for tip, tip="{}"'.format(tip_text))
 
@@ -155,7 +381,7 @@ class TipRecognizer(object):
       curr_turn_str = re_match.group('turn_number')
       try:
          curr_turn = int(curr_turn_str)
-         self._log.debug('Found current turn for tip, turn={}, tip="{}"'.format(curr_turn, tip_text))
+         self._log.debug('Found current turn for tip, turn=%d, tip="%s"', curr_turn, tip_text)
          return curr_turn
       except ValueError:
          raise TipParsingError('Unknown current turn for tip, match="{}", tip="{}"'.format(curr_turn_str, tip_text))
@@ -169,7 +395,7 @@ class TipRecognizer(object):
          target_turn_str = re_match.group('turn_number')
          try:
             target_turn = int(target_turn_str)
-            self._log.debug('Found target turn for tip, turn={}, tip="{}"'.format(target_turn, tip_text))
+            self._log.debug('Found target turn for tip, turn=%d, tip="%s"', target_turn, tip_text)
             return target_turn
          except ValueError:
             raise TipParsingError('Unknown target turn for tip, match="{}", tip="{}"'.format(target_turn_str, tip_text))
@@ -178,7 +404,7 @@ class TipRecognizer(object):
    def _get_price_change(self, tip_text: str) -> int:
       for keyword in self.PRICE_NO_CHANGE_KEYWORDS:
          if keyword in tip_text:
-            self._log.debug('No price change for tip, keyword="{}", tip="{}"'.format(keyword, tip_text))
+            self._log.debug('No price change for tip, keyword="%s", tip="%s"', keyword, tip_text)
             return 0
       for pattern in (self.PRICE_INC_REGEX_EN, self.PRICE_DEC_REGEX_EN,
                       self.PRICE_INC_REGEX_TRA_CN, self.PRICE_DEC_REGEX_TRA_CN,
@@ -193,7 +419,7 @@ class TipRecognizer(object):
             price_change_str = price_change_str.replace(' ', '')
          try:
             price_change = int(price_change_str)
-            self._log.debug('Found price change for tip, price_change={}, tip="{}"'.format(price_change, tip_text))
+            self._log.debug('Found price change for tip, price_change=%d, tip="%s"', price_change, tip_text)
             return price_change
          except ValueError:
             raise TipParsingError('Unknown price change for tip, match="{}", tip="{}"'.format(price_change_str, tip_text))
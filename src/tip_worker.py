@@ -0,0 +1,177 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import socket
+from typing import Optional
+
+import aiohttp
+
+from config_loader import config
+from logging_utils import logger_factory
+from metrics import metrics
+from vision_quota import VisionDeferredError
+from sheet_profiles import SheetProfileRouter
+from tip_pipeline import TipPipeline
+from tip_job_queue import TipJob, TipJobQueue, TipJobResult
+
+
+class RemoteAttachment(object):
+   # Attachment of a queued tip message, downloaded by the worker itself from the Discord CDN.
+   def __init__(self, session: aiohttp.ClientSession, url: str, content_type: Optional[str],
+                size: Optional[int]) -> None:
+      self._session = session
+      self.url = url
+      self.content_type = content_type
+      self.size = size
+
+   async def read(self) -> bytes:
+      async with self._session.get(self.url) as response:
+         response.raise_for_status()
+         return await response.read()
+
+
+class TipWorker(object):
+   # Process running the tip pipeline on the tip messages queued by the Discord process, in the
+   # split deployment. Any number of them may share the queue, on the same root directory.
+   CONFIG_SECTION = 'tip-workers'
+
+   def __init__(self, name: str, parent_pid: Optional[int]) -> None:
+      self._setup_logging()
+      # Host and PID make the name unique among workers started by hand with the same name.
+      self._worker_id = '{}@{}:{}'.format(name, socket.gethostname(), os.getpid())
+      self._parent_pid = parent_pid
+      self._concurrency = config.getint(self.CONFIG_SECTION, 'worker_concurrency')
+      self._poll_interval = config.getfloat(self.CONFIG_SECTION, 'poll_interval')
+      lease_seconds = config.getfloat(self.CONFIG_SECTION, 'job_lease_seconds')
+      self._queue = TipJobQueue(lease_seconds, config.getint(self.CONFIG_SECTION, 'max_job_attempts'))
+      # The lease of a job is renewed well before it expires, for as long as the job runs.
+      self._lease_renew_interval = lease_seconds / 3
+      self._pipeline = TipPipeline(SheetProfileRouter())
+      self._session = None
+
+   def run(self) -> None:
+      asyncio.run(self._run())
+
+   async def _run(self) -> None:
+      self._log.info('Started tip worker, id="{}", concurrency={}'.format(self._worker_id, self._concurrency))
+      try:
+         await asyncio.to_thread(self._pipeline.warm_up)
+      except Exception:
+         # Not fatal. The same work is retried on first use.
+         self._log.exception('Failed warming up tip worker')
+      self._session = aiohttp.ClientSession()
+      slots = asyncio.Semaphore(self._concurrency)
+      job_tasks = set()
+      try:
+         while not self._is_orphaned():
+            await slots.acquire()
+            claimed = await asyncio.to_thread(self._queue.claim, self._worker_id)
+            if claimed is None:
+               slots.release()
+               await asyncio.sleep(self._poll_interval)
+               continue
+            task = asyncio.create_task(self._process_job(*claimed))
+            job_tasks.add(task)
+            task.add_done_callback(job_tasks.discard)
+            task.add_done_callback(lambda _: slots.release())
+         self._log.warning('Stopping tip worker, parent process exited, id="{}"'.format(self._worker_id))
+         # Unfinished jobs are claimed again by another worker once their lease expires.
+      finally:
+         for task in job_tasks:
+            task.cancel()
+         await self._session.close()
+         self._pipeline.shutdown()
+
+   async def _process_job(self, job_id: int, job: TipJob) -> None:
+      logger_factory.set_correlation_id('msg-{}'.format(job.message_id))
+      attachments = [RemoteAttachment(self._session, *attachment) for attachment in job.attachments]
+      process_task = asyncio.create_task(self._pipeline.process(job.profile_name, attachments, job.update_sheet))
+      lease_task = asyncio.create_task(self._keep_lease(job_id))
+      try:
+         await asyncio.wait((process_task, lease_task), return_when=asyncio.FIRST_COMPLETED)
+      finally:
+         lease_task.cancel()
+         if not process_task.done():
+            process_task.cancel()
+      if not process_task.done():
+         # Another worker claimed the job, it's processed there.
+         self._log.warning('Stopped tip job, lease lost, id={}'.format(job_id))
+         return
+      try:
+         pipeline_result = process_task.result()
+      except VisionDeferredError as e:
+         result = TipJobResult(TipJobResult.DEFERRED, error=str(e), retry_after=e.retry_after)
+      except Exception as e:
+         self._log.exception('Failed processing tip job, id={}, exception="{}"'.format(job_id, repr(e)))
+         await asyncio.to_thread(self._queue.release, job_id, self._worker_id)
+         return
+      else:
+         result = TipJobResult(TipJobResult.DONE, pipeline_result)
+      if not await asyncio.to_thread(self._queue.complete, job_id, self._worker_id, result):
+         self._log.warning('Dropped tip job result, lease lost, id={}, status={}'.format(job_id, result.status))
+         return
+      self._log.info('Finished tip job, id={}, status={}'.format(job_id, result.status))
+
+   async def _keep_lease(self, job_id: int) -> None:
+      # Returns once the lease is lost.
+      while True:
+         await asyncio.sleep(self._lease_renew_interval)
+         try:
+            if not await asyncio.to_thread(self._queue.renew, job_id, self._worker_id):
+               return
+         except Exception as e:
+            # Retried on the next renewal, well before the lease expires.
+            self._log.error('Failed renewing tip job lease, id={}, exception="{}"'.format(job_id, repr(e)))
+
+   def _is_orphaned(self) -> bool:
+      # Workers started by the Discord process stop along with it, even if it was killed.
+      return (self._parent_pid is not None) and (os.getppid() != self._parent_pid)
+
+   def _setup_logging(self) -> None:
+      self._log = logger_factory.get_logger('tip-worker')
+      self._log.setLevel(logging.INFO)
+
+
+class TipWorkerSupervisor(object):
+   # Starts the tip worker processes of the Discord process, and restarts them when they exit.
+   CONFIG_SECTION = 'tip-workers'
+   MAIN_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+   RESTARTS = metrics.counter('tip_worker_restarts', 'Number of times a tip worker process was restarted.')
+
+   def __init__(self) -> None:
+      self._setup_logging()
+      self._worker_count = config.getint(self.CONFIG_SECTION, 'worker_count')
+      self._restart_delay = config.getfloat(self.CONFIG_SECTION, 'restart_delay')
+      self._tasks = []
+
+   def start(self) -> None:
+      if not self._tasks:
+         self._tasks = [asyncio.create_task(self._supervise('tip-worker-{}'.format(idx + 1)))
+                        for idx in range(self._worker_count)]
+
+   def stop(self) -> None:
+      for task in self._tasks:
+         task.cancel()
+      self._tasks = []
+
+   async def _supervise(self, name: str) -> None:
+      while True:
+         start_time = time.monotonic()
+         process = await asyncio.create_subprocess_exec(
+            sys.executable, self.MAIN_FILE, '--tip-worker', name, '--parent-pid', str(os.getpid()))
+         self._log.info('Started tip worker process, name="{}", pid={}'.format(name, process.pid))
+         try:
+            return_code = await process.wait()
+         except asyncio.CancelledError:
+            process.terminate()
+            raise
+         self.RESTARTS.inc()
+         self._log.error('Tip worker process exited, name="{}", return_code={}'.format(name, return_code))
+         # Don't restart in a tight loop a worker failing right at startup.
+         await asyncio.sleep(max(self._restart_delay - (time.monotonic() - start_time), 0))
+
+   def _setup_logging(self) -> None:
+      self._log = logger_factory.get_logger('tip-worker-supervisor')
+      self._log.setLevel(logging.INFO)
@@ -0,0 +1,324 @@
+import time
+import logging
+import sqlite3
+import threading
+import contextlib
+from typing import Iterator, Optional
+
+from lazy_loader import LazySingleton
+from config_loader import config
+from logging_utils import logger_factory
+from metrics import metrics
+from simple_data_saver import SimpleDataSaver, simple_saver
+
+
+class VisionDeferredError(Exception):
+   # The tip message should be retried later, rather than reported as failed. Not before the given
+   # number of seconds, if known.
+   def __init__(self, message: str = '', retry_after: float = 0.0) -> None:
+      super().__init__(message)
+      self.retry_after = retry_after
+
+class VisionQuotaExceededError(VisionDeferredError):
+   pass
+
+class VisionUnavailableError(VisionDeferredError):
+   pass
+
+
+class TokenBucket(object):
+   def __init__(self, per_minute: float, burst: float) -> None:
+      self._rate = per_minute / 60
+      self.capacity = burst
+      self._tokens = burst
+      self._updated_time = time.monotonic()
+
+   def get_tokens(self) -> float:
+      now = time.monotonic()
+      self._tokens = min(self.capacity, self._tokens + (now - self._updated_time) * self._rate)
+      self._updated_time = now
+      return self._tokens
+
+   def get_wait_seconds(self, count: int) -> float:
+      # Until enough tokens for the given count, or a full bucket if the count is larger.
+      return max(min(count, self.capacity) - self.get_tokens(), 0) / self._rate
+
+   def take(self, count: int) -> None:
+      self._tokens -= count
+
+
+class CircuitBreaker(object):
+   # Times are wall-clock, since the state is shared by the bot and its tip workers (split deployment).
+   CLOSED = 'closed'
+   OPEN = 'open'
+   HALF_OPEN = 'half-open'
+
+   def __init__(self, failure_threshold: int, open_seconds: float) -> None:
+      self._failure_threshold = failure_threshold
+      self._open_seconds = open_seconds
+      self._failure_count = 0
+      self._opened_time = 0.0
+      # Start of the request probing Vision while half-open, 0 if none. A probe is given up after
+      # the open duration, in case its process died before recording it.
+      self._probe_time = 0.0
+      self.state = self.CLOSED
+
+   def get_saved_state(self) -> tuple[str, int, float, float]:
+      return self.state, self._failure_count, self._opened_time, self._probe_time
+
+   def set_saved_state(self, saved_state: tuple[str, int, float, float]) -> None:
+      self.state, self._failure_count, self._opened_time, self._probe_time = saved_state
+
+   def allow_request(self) -> bool:
+      if self.state == self.CLOSED:
+         return True
+      now = time.time()
+      if self.state == self.OPEN and (now - self._opened_time) >= self._open_seconds:
+         # Let a single request through to find out whether Vision is back.
+         self.state = self.HALF_OPEN
+         self._probe_time = 0.0
+      if self.state == self.HALF_OPEN and not self._is_probing(now):
+         self._probe_time = now
+         return True
+      return False
+
+   def is_available(self) -> bool:
+      # Same as allow_request(), without taking the probe.
+      now = time.time()
+      if self.state == self.OPEN:
+         return (now - self._opened_time) >= self._open_seconds
+      return (self.state == self.CLOSED) or not self._is_probing(now)
+
+   def get_retry_after(self) -> float:
+      # Seconds before is_available() may turn true.
+      now = time.time()
+      if self.state == self.OPEN:
+         return max(self._opened_time + self._open_seconds - now, 0)
+      if (self.state == self.HALF_OPEN) and self._is_probing(now):
+         return self._probe_time + self._open_seconds - now
+      return 0.0
+
+   def record_success(self) -> None:
+      self._failure_count = 0
+      self._probe_time = 0.0
+      self.state = self.CLOSED
+
+   def record_failure(self) -> None:
+      self._failure_count += 1
+      self._probe_time = 0.0
+      if (self.state == self.HALF_OPEN) or (self._failure_count >= self._failure_threshold):
+         self.state = self.OPEN
+         self._opened_time = time.time()
+
+   def _is_probing(self, now: float) -> bool:
+      return (self._probe_time != 0) and (now - self._probe_time) < self._open_seconds
+
+
+class VisionQuota(object):
+   # Budget of the Google Vision requests: rate limits per guild and globally, daily caps, a running
+   # cost estimate, and a circuit breaker failing fast while Vision is unhealthy.
+   # Rate limits and guild caps count the tip images admitted, daily cap and cost count the requests
+   # actually sent (several images may share a request).
+   # The usage of each day (UTC) and the circuit state are kept in tables of the saved data's
+   # database, so restarts don't reset them, and the bot and its tip workers (split deployment)
+   # count into the same usage and trip the same circuit. Both are updated in transactions so
+   # no process overwrites the counts of another. Rate limits are per process.
+   CONFIG_SECTION = 'vision-quota'
+   # Usage of a day, saved as a single value by older versions.
+   LEGACY_USAGE_SAVE_KEY = 'vision-usage-{}'
+   GUILD_IMAGES_COUNTER = 'guild-images-{}'
+   DECISIONS = metrics.counter(
+      'vision_quota_decisions', 'Number of tip messages checked by the Vision quota, by result.', ('result',))
+   REQUESTS = metrics.counter(
+      'vision_requests', 'Number of Vision requests sent, by result.', ('result',))
+   CIRCUIT_OPEN = metrics.gauge(
+      'vision_circuit_open', 'Whether Vision requests are currently failing fast (1) or not (0).')
+
+   def __init__(self) -> None:
+      self._setup_logging()
+      self._guild_images_per_minute = config.getfloat(self.CONFIG_SECTION, 'guild_images_per_minute')
+      self._guild_burst = config.getfloat(self.CONFIG_SECTION, 'guild_burst')
+      self._guild_daily_image_cap = config.getint(self.CONFIG_SECTION, 'guild_daily_image_cap')
+      self._daily_request_cap = config.getint(self.CONFIG_SECTION, 'daily_request_cap')
+      self._cost_per_request = config.getfloat(self.CONFIG_SECTION, 'cost_per_1000_requests') / 1000
+      self._global_bucket = TokenBucket(config.getfloat(self.CONFIG_SECTION, 'global_images_per_minute'),
+                                        config.getfloat(self.CONFIG_SECTION, 'global_burst'))
+      self._guild_buckets = {}
+      self._breaker = CircuitBreaker(config.getint(self.CONFIG_SECTION, 'breaker_failure_threshold'),
+                                     config.getfloat(self.CONFIG_SECTION, 'breaker_open_seconds'))
+      # Called from the event loop (admission) and from the Vision threads (requests).
+      self._lock = threading.Lock()
+      # Transactions are handled explicitly. Writers of other processes are waited for.
+      self._conn = sqlite3.connect(SimpleDataSaver.SAVE_FILE, timeout=30, isolation_level=None,
+                                   check_same_thread=False)
+      self._conn.execute(
+         'CREATE TABLE IF NOT EXISTS vision_usage (day TEXT NOT NULL, counter TEXT NOT NULL, '
+         'count INTEGER NOT NULL, PRIMARY KEY (day, counter))')
+      self._conn.execute(
+         'CREATE TABLE IF NOT EXISTS vision_circuit (id INTEGER PRIMARY KEY CHECK (id = 0), state TEXT NOT NULL, '
+         'failure_count INTEGER NOT NULL, opened_time REAL NOT NULL, probe_time REAL NOT NULL)')
+      self._usage_day = self._get_day()
+      self._migrate_legacy_usage()
+
+   def admit(self, guild_id: int, image_count: int) -> None:
+      # Raises VisionDeferredError if the images of a tip message should not be read now.
+      with self._transaction():
+         self._load_breaker_locked()
+         usage = self._get_usage_locked(guild_id)
+         if not self._breaker.is_available():
+            self.DECISIONS.labels('circuit_open').inc()
+            raise VisionUnavailableError('Vision is failing, circuit={}'.format(self._breaker.state),
+                                         self._breaker.get_retry_after())
+         if self._daily_request_cap and (usage['requests'] >= self._daily_request_cap):
+            self.DECISIONS.labels('capped').inc()
+            raise VisionQuotaExceededError('Daily request cap reached, cap={}'.format(self._daily_request_cap),
+                                           self._get_seconds_to_next_day())
+         if self._guild_daily_image_cap and (usage['guild_images'] + image_count > self._guild_daily_image_cap):
+            self.DECISIONS.labels('capped').inc()
+            raise VisionQuotaExceededError('Guild daily image cap reached, guild={}, cap={}'.format(
+               guild_id, self._guild_daily_image_cap), self._get_seconds_to_next_day())
+         guild_bucket = self._guild_buckets.get(guild_id)
+         if guild_bucket is None:
+            guild_bucket = TokenBucket(self._guild_images_per_minute, self._guild_burst)
+            self._guild_buckets[guild_id] = guild_bucket
+         # A message with more images than the burst is let through once the bucket is full.
+         if ((guild_bucket.get_tokens() < min(image_count, guild_bucket.capacity)) or
+             (self._global_bucket.get_tokens() < min(image_count, self._global_bucket.capacity))):
+            self.DECISIONS.labels('rate_limited').inc()
+            retry_after = max(guild_bucket.get_wait_seconds(image_count),
+                              self._global_bucket.get_wait_seconds(image_count))
+            raise VisionQuotaExceededError('Rate limited, guild={}, images={}'.format(guild_id, image_count),
+                                           retry_after)
+         guild_bucket.take(image_count)
+         self._global_bucket.take(image_count)
+         self._add_usage_locked(self.GUILD_IMAGES_COUNTER.format(guild_id), image_count)
+         self.DECISIONS.labels('admitted').inc()
+
+   def before_request(self) -> None:
+      # Fails fast while the circuit is open, rather than waiting for Vision to fail again.
+      with self._transaction():
+         self._load_breaker_locked()
+         allowed = self._breaker.allow_request()
+         self._save_breaker_locked()
+      if not allowed:
+         self.REQUESTS.labels('rejected').inc()
+         raise VisionUnavailableError('Vision is failing, circuit={}'.format(self._breaker.state),
+                                      self._breaker.get_retry_after())
+
+   def record_request(self, success: bool) -> None:
+      # Unsuccessful means Vision itself failed, not that the image could not be read.
+      with self._transaction():
+         self._add_usage_locked('requests', 1)
+         self._load_breaker_locked()
+         if success:
+            self._breaker.record_success()
+         else:
+            self._add_usage_locked('failures', 1)
+            previous_state = self._breaker.state
+            self._breaker.record_failure()
+            if (self._breaker.state == CircuitBreaker.OPEN) and (previous_state != CircuitBreaker.OPEN):
+               self._log.warning('Opened Vision circuit, failures={}'.format(self._get_usage_locked()['failures']))
+         self._save_breaker_locked()
+         self.CIRCUIT_OPEN.set(1 if self._breaker.state != CircuitBreaker.CLOSED else 0)
+      self.REQUESTS.labels('success' if success else 'failure').inc()
+
+   def is_available(self) -> bool:
+      with self._lock:
+         self._load_breaker_locked()
+         return self._breaker.is_available()
+
+   def get_usage_msg(self, guild_id: int) -> str:
+      with self._lock:
+         self._load_breaker_locked()
+         usage = self._get_usage_locked(guild_id)
+         guild_bucket = self._guild_buckets.get(guild_id)
+         lines = [
+            'Vision usage on {} (UTC):'.format(self._usage_day),
+            'Requests: {}{}, failed: {}. Estimated cost: ${:.2f}.'.format(
+               usage['requests'], ' / {}'.format(self._daily_request_cap) if self._daily_request_cap else '',
+               usage['failures'], usage['requests'] * self._cost_per_request),
+            'Images from this guild: {}{}.'.format(
+               usage['guild_images'],
+               ' / {}'.format(self._guild_daily_image_cap) if self._guild_daily_image_cap else ''),
+            'Images available now: {} for this guild, {} overall.'.format(
+               int(guild_bucket.get_tokens()) if guild_bucket else int(self._guild_burst),
+               int(self._global_bucket.get_tokens())),
+            'Circuit: {}.'.format(self._breaker.state)
+         ]
+      return '\n'.join(lines)
+
+   @contextlib.contextmanager
+   def _transaction(self) -> Iterator[None]:
+      with self._lock:
+         self._conn.execute('BEGIN IMMEDIATE')
+         try:
+            yield
+            self._conn.execute('COMMIT')
+         except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+
+   @staticmethod
+   def _get_day() -> str:
+      return time.strftime('%Y-%m-%d', time.gmtime())
+
+   @staticmethod
+   def _get_seconds_to_next_day() -> float:
+      # The daily caps reset at midnight UTC.
+      return 86400 - (time.time() % 86400)
+
+   def _get_usage_locked(self, guild_id: Optional[int] = None) -> dict:
+      # Usage of the current day, with the images of the given guild.
+      self._usage_day = self._get_day()
+      guild_counter = self.GUILD_IMAGES_COUNTER.format(guild_id)
+      counts = dict(self._conn.execute(
+         'SELECT counter, count FROM vision_usage WHERE day = ? AND counter IN (?, ?, ?)',
+         (self._usage_day, 'requests', 'failures', guild_counter)).fetchall())
+      return {'requests': counts.get('requests', 0), 'failures': counts.get('failures', 0),
+              'guild_images': counts.get(guild_counter, 0)}
+
+   def _add_usage_locked(self, counter: str, count: int) -> None:
+      # Incremented in place rather than written back, so concurrent increments add up.
+      self._usage_day = self._get_day()
+      self._conn.execute('INSERT OR IGNORE INTO vision_usage (day, counter, count) VALUES (?, ?, 0)',
+                         (self._usage_day, counter))
+      self._conn.execute('UPDATE vision_usage SET count = count + ? WHERE day = ? AND counter = ?',
+                         (count, self._usage_day, counter))
+
+   def _load_breaker_locked(self) -> None:
+      row = self._conn.execute(
+         'SELECT state, failure_count, opened_time, probe_time FROM vision_circuit WHERE id = 0').fetchone()
+      if row is not None:
+         self._breaker.set_saved_state(row)
+
+   def _save_breaker_locked(self) -> None:
+      self._conn.execute(
+         'INSERT OR REPLACE INTO vision_circuit (id, state, failure_count, opened_time, probe_time) '
+         'VALUES (0, ?, ?, ?, ?)', self._breaker.get_saved_state())
+
+   def _migrate_legacy_usage(self) -> None:
+      # Only the current day's usage counts towards the caps. Marked as migrated in the same
+      # transaction, since the bot and its tip workers start at the same time.
+      legacy_save_key = self.LEGACY_USAGE_SAVE_KEY.format(self._usage_day)
+      usage = simple_saver.load_key(legacy_save_key, None)
+      if not usage:
+         return
+      counts = [('requests', usage['requests']), ('failures', usage['failures'])]
+      counts += [(self.GUILD_IMAGES_COUNTER.format(guild_key), images)
+                 for guild_key, images in usage['guild_images'].items()]
+      with self._transaction():
+         if self._conn.execute('SELECT 1 FROM vision_usage WHERE day = ? AND counter = ?',
+                               (self._usage_day, legacy_save_key)).fetchone() is not None:
+            return
+         for counter, count in counts + [(legacy_save_key, 1)]:
+            self._add_usage_locked(counter, count)
+      simple_saver.delete_key(legacy_save_key)
+      simple_saver.flush()
+      self._log.info('Migrated legacy Vision usage, key="{}", requests={}'.format(legacy_save_key, usage['requests']))
+
+   def _setup_logging(self) -> None:
+      self._log = logger_factory.get_logger('vision-quota')
+      self._log.setLevel(logging.INFO)
+
+
+vision_quota = LazySingleton('vision_quota', VisionQuota)
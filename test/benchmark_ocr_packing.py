@@ -0,0 +1,100 @@
+import os
+import sys
+import glob
+import time
+import argparse
+import logging
+
+import cv2
+
+sys.path.append(os.environ['SRC_DIR'])
+
+from logging_utils import logger_factory
+
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(logger_factory.formatter)
+logger_factory.handler = stream_handler
+
+from tip_image_locator import OpenCVError, TipImageLocator
+from tip_recognizer import TipRecognizer
+
+
+SAMPLES_DIR = os.environ['SAMPLES_DIR']
+EN_IMAGE_PATH = os.path.join(SAMPLES_DIR, 'en')
+CN_IMAGE_PATH = os.path.join(SAMPLES_DIR, 'cn')
+KR_IMAGE_PATH = os.path.join(SAMPLES_DIR, 'kr')
+
+log = logger_factory.get_logger('benchmark')
+log.setLevel(logging.INFO)
+
+locator = TipImageLocator()
+recognizer = TipRecognizer()
+
+
+def parse_args() -> argparse.Namespace:
+   parser = argparse.ArgumentParser()
+   parser.add_argument('--filter', required=False, default='samples',
+      help='Select a sub-group of sample images')
+   parser.add_argument('--batch-size', required=False, type=int, default=8,
+      help='Number of images packed into each OCR request')
+   parser.add_argument('--price-per-1000', required=False, type=float, default=1.5,
+      help='Price in USD of 1000 text detection requests')
+   args = parser.parse_args()
+   return args
+
+def load_tip_images(filter_str: str) -> list[tuple[str, bytes, list[tuple[int, int, int, int]]]]:
+   # Same as the image workers do, for each sample image.
+   tip_images = []
+   for image_dir in (EN_IMAGE_PATH, CN_IMAGE_PATH, KR_IMAGE_PATH):
+      for filepath in sorted(glob.glob(os.path.join(image_dir, '*'))):
+         if filter_str not in filepath:
+            continue
+         try:
+            images, _ = locator.extract_tip_images(cv2.imread(filepath))
+         except OpenCVError as e:
+            log.info('Skipped image: "{}", reason="{}"'.format(filepath, str(e)))
+            continue
+         tip_image, tip_regions = locator.stack_tip_images(images)
+         tip_images.append((filepath.removeprefix(SAMPLES_DIR), locator.encode_image(tip_image), tip_regions))
+   return tip_images
+
+def report(mode: str, request_count: int, elapsed: float, tip_count: int, price_per_1000: float) -> None:
+   log.info('{}: requests={}, cost=${:.4f}, cost_per_tip=${:.6f}, total={:.2f}s, per_tip={:.3f}s, tips={}'.format(
+      mode, request_count, request_count * price_per_1000 / 1000,
+      request_count * price_per_1000 / 1000 / max(tip_count, 1), elapsed, elapsed / max(tip_count, 1), tip_count))
+
+def main() -> None:
+   args = parse_args()
+   tip_images = load_tip_images(args.filter)
+   log.info('Loaded tip images, count={}, tips={}'.format(
+      len(tip_images), sum(len(tip_regions) for _, _, tip_regions in tip_images)))
+   # One request per image.
+   single_results = []
+   start = time.perf_counter()
+   for _, tip_image, tip_regions in tip_images:
+      single_results.append(recognizer.process_tip_image(tip_image, tip_regions))
+   single_elapsed = time.perf_counter() - start
+   # Several images packed in each request.
+   packed_results = []
+   start = time.perf_counter()
+   for idx in range(0, len(tip_images), args.batch_size):
+      batch = tip_images[idx:idx + args.batch_size]
+      packed_results += recognizer.process_tip_images([(tip_image, tip_regions) for _, tip_image, tip_regions in batch])
+   packed_elapsed = time.perf_counter() - start
+   # Both ways should read the same tips.
+   mismatch_count = 0
+   for (name, _, _), (_, single_tips), (_, packed_tips) in zip(tip_images, single_results, packed_results):
+      single_strings = [tip.to_string() for tip in single_tips]
+      packed_strings = [tip.to_string() for tip in packed_tips]
+      if single_strings != packed_strings:
+         mismatch_count += 1
+         log.info('Mismatch: "{}", single={}, packed={}'.format(name, single_strings, packed_strings))
+   report('One request per image', len(tip_images), single_elapsed,
+          sum(len(tips) for _, tips in single_results), args.price_per_1000)
+   report('Packed, batch_size={}'.format(args.batch_size), -(-len(tip_images) // args.batch_size), packed_elapsed,
+          sum(len(tips) for _, tips in packed_results), args.price_per_1000)
+   log.info('Images with different tips, count={}'.format(mismatch_count))
+
+
+if __name__ == '__main__':
+   main()
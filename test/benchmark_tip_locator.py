@@ -0,0 +1,107 @@
+import os
+import sys
+import glob
+import time
+import argparse
+import logging
+
+import cv2
+import numpy
+
+sys.path.append(os.environ['SRC_DIR'])
+
+from logging_utils import logger_factory
+
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(logger_factory.formatter)
+logger_factory.handler = stream_handler
+
+from basic_utils import BasicUtils
+from tip_image_locator import OpenCVError, TipImageLocator
+
+
+SAMPLES_DIR = os.environ['SAMPLES_DIR']
+EN_IMAGE_PATH = os.path.join(SAMPLES_DIR, 'en')
+CN_IMAGE_PATH = os.path.join(SAMPLES_DIR, 'cn')
+KR_IMAGE_PATH = os.path.join(SAMPLES_DIR, 'kr')
+
+log = logger_factory.get_logger('benchmark')
+log.setLevel(logging.INFO)
+
+# Same locator, searching the whole screenshot at full resolution or coarse-to-fine.
+full_locator = TipImageLocator()
+full_locator._coarse_search_max_size = 0
+coarse_locator = TipImageLocator()
+
+
+def parse_args() -> argparse.Namespace:
+   parser = argparse.ArgumentParser()
+   parser.add_argument('--filter', required=False, default='samples',
+      help='Select a sub-group of sample images')
+   parser.add_argument('--scales', required=False, default='1, 2, 3',
+      help='Comma-separated factors the samples are upscaled by, standing for larger screens')
+   parser.add_argument('--repeat', required=False, type=int, default=3,
+      help='Number of times each image is located, the fastest time is kept')
+   args = parser.parse_args()
+   return args
+
+def load_images(filter_str: str) -> list[tuple[str, numpy.ndarray]]:
+   images = []
+   for image_dir in (EN_IMAGE_PATH, CN_IMAGE_PATH, KR_IMAGE_PATH):
+      for filepath in sorted(glob.glob(os.path.join(image_dir, '*'))):
+         if filter_str not in filepath:
+            continue
+         image = cv2.imread(filepath)
+         if image is not None:
+            images.append((filepath.removeprefix(SAMPLES_DIR), image))
+   return images
+
+def locate(locator: TipImageLocator, image: numpy.ndarray, repeat: int
+           ) -> tuple[float, list[numpy.ndarray], int]:
+   # Returns the fastest time, with the tip images and threshold found.
+   elapsed = float('inf')
+   tip_images, threshold = [], -1
+   for _ in range(repeat):
+      start = time.perf_counter()
+      try:
+         tip_images, threshold = locator.extract_tip_images(image)
+      except OpenCVError:
+         tip_images, threshold = [], -1
+      elapsed = min(elapsed, time.perf_counter() - start)
+   return elapsed, tip_images, threshold
+
+def is_same_result(result: tuple[list[numpy.ndarray], int], other: tuple[list[numpy.ndarray], int]) -> bool:
+   tip_images, threshold = result
+   other_tip_images, other_threshold = other
+   return ((threshold == other_threshold) and (len(tip_images) == len(other_tip_images)) and
+           all(numpy.array_equal(tip_image, other_tip_image)
+               for tip_image, other_tip_image in zip(tip_images, other_tip_images)))
+
+def main() -> None:
+   args = parse_args()
+   images = load_images(args.filter)
+   log.info('Loaded sample images, count={}, coarse_max_size={}'.format(
+      len(images), coarse_locator._coarse_search_max_size))
+   for scale in BasicUtils.get_int_list_from_csv(args.scales):
+      full_elapsed = 0
+      coarse_elapsed = 0
+      mismatch_count = 0
+      for name, image in images:
+         if scale > 1:
+            image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_CUBIC)
+         elapsed, *full_result = locate(full_locator, image, args.repeat)
+         full_elapsed += elapsed
+         elapsed, *coarse_result = locate(coarse_locator, image, args.repeat)
+         coarse_elapsed += elapsed
+         if not is_same_result(full_result, coarse_result):
+            mismatch_count += 1
+            log.info('Mismatch: "{}", scale={}, full_threshold={}, coarse_threshold={}'.format(
+               name, scale, full_result[1], coarse_result[1]))
+      log.info('Scale x{}: full={:.3f}s, coarse_to_fine={:.3f}s, speedup={:.2f}x, per_image={:.1f}ms -> {:.1f}ms, '
+               'mismatches={}/{}'.format(
+         scale, full_elapsed, coarse_elapsed, full_elapsed / max(coarse_elapsed, 1e-9),
+         1000 * full_elapsed / len(images), 1000 * coarse_elapsed / len(images), mismatch_count, len(images)))
+
+
+if __name__ == '__main__':
+   main()
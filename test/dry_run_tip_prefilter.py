@@ -0,0 +1,105 @@
+import os
+import sys
+import glob
+import time
+import argparse
+import logging
+
+import cv2
+import numpy
+
+sys.path.append(os.environ['SRC_DIR'])
+
+from logging_utils import logger_factory
+
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(logger_factory.formatter)
+logger_factory.handler = stream_handler
+
+from tip_prefilter import NotATipError, TipPreFilter
+
+
+SAMPLES_DIR = os.environ['SAMPLES_DIR']
+EN_IMAGE_PATH = os.path.join(SAMPLES_DIR, 'en')
+CN_IMAGE_PATH = os.path.join(SAMPLES_DIR, 'cn')
+KR_IMAGE_PATH = os.path.join(SAMPLES_DIR, 'kr')
+
+log = logger_factory.get_logger('dry-run')
+log.setLevel(logging.INFO)
+
+prefilter = TipPreFilter()
+
+
+def parse_args() -> argparse.Namespace:
+   parser = argparse.ArgumentParser()
+   parser.add_argument('--filter', required=False, default='samples',
+      help='Select a sub-group of sample images')
+   parser.add_argument('--negatives-dir', required=False, default=None,
+      help='Directory of images which are not tips, all of them should be rejected')
+   args = parser.parse_args()
+   return args
+
+def get_format(image_data: bytes) -> str:
+   return 'jpeg' if prefilter.is_jpeg(image_data) else 'png' if image_data[:4] == b'\x89PNG' else 'other'
+
+def check_images(filepaths: list[str]) -> tuple[list[tuple[str, str]], dict[str, list[float]]]:
+   # Returns the rejected images with their reason, and by image format: the image count, and the
+   # total time of the pre-filter and of the full decode. Follows the image workers: JPEG images
+   # are checked before being decoded (the full decode is what a reject saves), other images once
+   # decoded.
+   rejects = []
+   timings = {}
+   for filepath in filepaths:
+      with open(filepath, 'rb') as f:
+         image_data = f.read()
+      image_format = get_format(image_data)
+      is_jpeg = image_format == 'jpeg'
+      start = time.perf_counter()
+      try:
+         if is_jpeg:
+            prefilter.check_image(image_data)
+      except NotATipError as e:
+         rejects.append((filepath, str(e)))
+      checked = time.perf_counter()
+      # Also timed for rejected JPEG images, it is what their reject saves.
+      image = cv2.imdecode(numpy.frombuffer(image_data, dtype='uint8'), cv2.IMREAD_COLOR)
+      decoded = time.perf_counter()
+      try:
+         if not is_jpeg:
+            prefilter.check_decoded_image(image)
+      except NotATipError as e:
+         rejects.append((filepath, str(e)))
+      prefilter_time = (checked - start) if is_jpeg else (time.perf_counter() - decoded)
+      decode_time = decoded - checked
+      timing = timings.setdefault(image_format, [0, 0.0, 0.0])
+      timing[0] += 1
+      timing[1] += prefilter_time
+      timing[2] += decode_time
+   return rejects, timings
+
+def main() -> None:
+   args = parse_args()
+   samples = []
+   for image_dir in (EN_IMAGE_PATH, CN_IMAGE_PATH, KR_IMAGE_PATH):
+      samples += [filepath for filepath in glob.glob(os.path.join(image_dir, '*')) if args.filter in filepath]
+   rejects, timings = check_images(samples)
+   for filepath, reason in rejects:
+      log.info('False reject: "{}", reason="{}"'.format(filepath.removeprefix(SAMPLES_DIR), reason))
+   log.info('Completed all samples, count={}, false_rejects={}, false_reject_rate={:.2%}'.format(
+      len(samples), len(rejects), len(rejects) / max(len(samples), 1)))
+   for image_format, (count, prefilter_time, decode_time) in sorted(timings.items()):
+      log.info('Average time, format={}, count={}, prefilter={:.1f}ms, full_decode={:.1f}ms'.format(
+         image_format, count, 1000 * prefilter_time / count, 1000 * decode_time / count))
+   if args.negatives_dir:
+      negatives = glob.glob(os.path.join(args.negatives_dir, '*'))
+      rejects, _ = check_images(negatives)
+      rejected_paths = {filepath for filepath, _ in rejects}
+      for filepath in negatives:
+         if filepath not in rejected_paths:
+            log.info('Missed reject: "{}"'.format(filepath))
+      log.info('Completed all negatives, count={}, rejects={}, reject_rate={:.2%}'.format(
+         len(negatives), len(rejects), len(rejects) / max(len(negatives), 1)))
+
+
+if __name__ == '__main__':
+   main()
@@ -15,6 +15,7 @@ stream_handler.setFormatter(logger_factory.formatter)
 logger_factory.handler = stream_handler
 
 from tip_recognizer import TipRecognizer
+from image_archive import image_archive
 
 
 SAMPLES_DIR = os.environ['SAMPLES_DIR']
@@ -34,6 +35,8 @@ def parse_args() -> argparse.Namespace:
       help='Select a sub-group of sample images')
    parser.add_argument('--show-image', required=False, action='store_true',
       help='Show each image and wait for a keypress before moving to next one')
+   parser.add_argument('--archive', required=False, action='store_true',
+      help='Read the images of the image archive (downloaded from Discord) instead of the samples')
    args = parser.parse_args()
    return args
 
@@ -42,22 +45,27 @@ def main() -> None:
    success_count = 0
    fail_count = 0
    fail_images = []
-   for image_dir in (EN_IMAGE_PATH, CN_IMAGE_PATH, KR_IMAGE_PATH):
-      images = glob.glob(os.path.join(image_dir, '*'))
-      for filepath in images:
-         if args.filter not in filepath:
-            continue
-         log.info('Load image: "{}"'.format(filepath))
-         image = cv2.imread(filepath)
-         success, _ = recognizer.process_tip(image)
-         if success:
-            success_count += 1
-         else:
-            fail_count += 1
-            fail_images.append(filepath.removeprefix(SAMPLES_DIR))
-         if args.show_image:
-            cv2.imshow('tip-image', image)
-            cv2.waitKey(0)
+   if args.archive:
+      # Named by the URL they were downloaded from.
+      images = [(url, filepath) for url, filepath in image_archive.get_files() if args.filter in url]
+   else:
+      images = []
+      for image_dir in (EN_IMAGE_PATH, CN_IMAGE_PATH, KR_IMAGE_PATH):
+         for filepath in glob.glob(os.path.join(image_dir, '*')):
+            if args.filter in filepath:
+               images.append((filepath.removeprefix(SAMPLES_DIR), filepath))
+   for name, filepath in images:
+      log.info('Load image: "{}"'.format(filepath))
+      image = cv2.imread(filepath)
+      success, _ = recognizer.process_tip(image)
+      if success:
+         success_count += 1
+      else:
+         fail_count += 1
+         fail_images.append(name)
+      if args.show_image:
+         cv2.imshow('tip-image', image)
+         cv2.waitKey(0)
    log.info('Completed all samples, success={}, fail={}'.format(success_count, fail_count))
    if fail_count > 0:
       log.info('Failed images: {}'.format(fail_images))
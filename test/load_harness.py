@@ -0,0 +1,488 @@
+import os
+import re
+import sys
+import time
+import glob
+import random
+import asyncio
+import argparse
+import logging
+import tempfile
+import threading
+
+import cv2
+import numpy
+from google.api_core import exceptions as google_exceptions
+from google.cloud import vision as google_vision
+
+sys.path.append(os.environ['SRC_DIR'])
+
+from logging_utils import logger_factory
+
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(logger_factory.formatter)
+logger_factory.handler = stream_handler
+
+# Keep the saved data of the bot (ledger, failed URLs...) out of the harness.
+from simple_data_saver import SimpleDataSaver
+SAVE_DIR = tempfile.mkdtemp(prefix='load-harness-')
+SimpleDataSaver.SAVE_FILE = os.path.join(SAVE_DIR, '.saved.sqlite3')
+SimpleDataSaver.LEGACY_SAVE_FILE = os.path.join(SAVE_DIR, '.saved')
+
+from config_loader import config
+from simple_data_saver import simple_saver
+from basic_utils import BasicUtils
+from stonk_sheet_base import AsyncWorksheet, StonkSheetBase
+from tip_image_locator import TipImageLocator
+from tip_recognizer import TipRecognizer
+from loop_watchdog import loop_watchdog
+from image_memory_budget import image_memory_budget
+
+
+SAMPLES_DIR = os.environ['SAMPLES_DIR']
+HYPERLINK_REGEX = re.compile(r'HYPERLINK\("(?P<url>[^"]+)"')
+
+log = logger_factory.get_logger('load-harness')
+log.setLevel(logging.INFO)
+
+
+def parse_args() -> argparse.Namespace:
+   parser = argparse.ArgumentParser()
+   parser.add_argument('--scenario', required=False, default='all', choices=['backfill', 'flood', 'commands', 'all'],
+      help='Scenario to run')
+   parser.add_argument('--messages', required=False, type=int, default=100,
+      help='Number of tip messages of the backfill and flood scenarios')
+   parser.add_argument('--max-attachments', required=False, type=int, default=3,
+      help='Max number of sample images attached to each tip message')
+   parser.add_argument('--message-rate', required=False, type=float, default=20,
+      help='Tip messages per second during the flood')
+   parser.add_argument('--commands', required=False, type=int, default=300,
+      help='Number of commands of the command spike')
+   parser.add_argument('--command-rate', required=False, type=float, default=100,
+      help='Commands per second during the command spike')
+   parser.add_argument('--download-latency', required=False, type=float, default=0.05,
+      help='Seconds taken to download each attachment')
+   parser.add_argument('--vision-latency', required=False, type=float, default=0.4,
+      help='Mean seconds taken by each Vision request')
+   parser.add_argument('--vision-jitter', required=False, type=float, default=0.15,
+      help='Standard deviation of the seconds taken by each Vision request')
+   parser.add_argument('--vision-error-rate', required=False, type=float, default=0.02,
+      help='Ratio of Vision requests answered with an error')
+   parser.add_argument('--vision-exception-rate', required=False, type=float, default=0,
+      help='Ratio of Vision requests raising an exception')
+   parser.add_argument('--vision-stall-rate', required=False, type=float, default=0,
+      help='Ratio of Vision requests taking 10 times longer than usual')
+   parser.add_argument('--no-ocr-hedging', required=False, action='store_true',
+      help='Disable hedging of the Vision requests')
+   parser.add_argument('--no-vision-rate-limits', required=False, action='store_true',
+      help='Lift the per-minute limits of the Vision quota')
+   parser.add_argument('--sheet-latency', required=False, type=float, default=0.2,
+      help='Seconds taken by each Google Sheets call')
+   parser.add_argument('--current-turn', required=False, type=int, default=20,
+      help='Current turn of the simulated event')
+   parser.add_argument('--seed', required=False, type=int, default=0,
+      help='Seed of the random generator')
+   parser.add_argument('--verbose', required=False, action='store_true',
+      help='Show the logs of the bot')
+   args = parser.parse_args()
+   return args
+
+def get_percentile(values: list[float], percent: float) -> float:
+   if not values:
+      return 0
+   values = sorted(values)
+   return values[min(int(len(values) * percent / 100), len(values) - 1)]
+
+
+class FakeVisionClient(object):
+   # Stand-in for the Vision client. Finds the tips in the image the way the locator lays them
+   # out (blocks separated by black gaps) and makes up the text of a random tip for each.
+   BREAK_TYPES = google_vision.TextAnnotation.DetectedBreak.BreakType
+   HERO_TOWN_KEYWORDS = {hero_town: keywords[0] for hero_town, keywords in TipRecognizer.SEARCH_KEYWORDS}
+
+   def __init__(self, rng: random.Random, latency: float, jitter: float, error_rate: float,
+                exception_rate: float, stall_rate: float, max_turn: int) -> None:
+      self._rng = rng
+      self._rng_lock = threading.Lock()
+      self._latency = latency
+      self._jitter = jitter
+      self._error_rate = error_rate
+      self._exception_rate = exception_rate
+      self._stall_rate = stall_rate
+      self._max_turn = max_turn
+      self.request_count = 0
+      self.error_count = 0
+
+   def text_detection(self, image: google_vision.Image, retry=None, timeout: float = None
+                      ) -> google_vision.AnnotateImageResponse:
+      with self._rng_lock:
+         self.request_count += 1
+         latency = max(0.0, self._rng.gauss(self._latency, self._jitter))
+         if self._rng.random() < self._stall_rate:
+            latency *= 10
+         outcome = self._rng.random()
+      if (timeout is not None) and (latency > timeout):
+         time.sleep(timeout)
+         with self._rng_lock:
+            self.error_count += 1
+         raise google_exceptions.DeadlineExceeded('Simulated Vision deadline')
+      time.sleep(latency)
+      if outcome < self._exception_rate:
+         self.error_count += 1
+         raise RuntimeError('Simulated Vision exception')
+      if outcome < self._exception_rate + self._error_rate:
+         self.error_count += 1
+         return google_vision.AnnotateImageResponse(error={'message': 'Simulated Vision error'})
+      words = []
+      lines = []
+      for x, y, w, h in self._find_tip_regions(image.content):
+         tip_lines = self._make_tip_lines()
+         for line_idx, line in enumerate(tip_lines):
+            line_words = line.split(' ')
+            line_y = y + int(h * (line_idx + 0.5) / len(tip_lines))
+            for word_idx, text in enumerate(line_words):
+               word_x = x + int(w * (word_idx + 0.5) / len(line_words))
+               is_last = word_idx == len(line_words) - 1
+               words.append(self._make_word(text, word_x, line_y, is_last))
+            lines.append(line)
+      return google_vision.AnnotateImageResponse(
+         text_annotations=[{'description': '\n'.join(lines) + '\n'}] if lines else [],
+         full_text_annotation={'pages': [{'blocks': [{'paragraphs': [{'words': words}]}]}]})
+
+   def _find_tip_regions(self, image_data: bytes) -> list[tuple[int, int, int, int]]:
+      image = cv2.imdecode(numpy.frombuffer(image_data, dtype='uint8'), cv2.IMREAD_GRAYSCALE)
+      mask = cv2.dilate((image > 0).astype(numpy.uint8), numpy.ones((5, 5), numpy.uint8))
+      count, _, stats, _ = cv2.connectedComponentsWithStats(mask)
+      min_area = (TipImageLocator.TIP_STACK_GAP * 2) ** 2
+      regions = [tuple(int(value) for value in stats[idx][:4]) for idx in range(1, count)
+                 if stats[idx][cv2.CC_STAT_AREA] >= min_area]
+      return sorted(regions, key=lambda region: (region[1], region[0]))
+
+   def _make_tip_lines(self) -> list[str]:
+      with self._rng_lock:
+         hero_town = self._rng.choice(list(self.HERO_TOWN_KEYWORDS.keys()))
+         current_turn = self._rng.randint(1, self._max_turn - 1)
+         target_turn = min(current_turn + self._rng.randint(1, 8), self._max_turn)
+         price_change = self._rng.randint(-50, 50) * 10
+      if price_change > 0:
+         change = 'rise by approximately {}'.format(price_change)
+      elif price_change < 0:
+         change = 'fall by approximately {}'.format(price_change)
+      else:
+         change = 'remain stable'
+      return ['TURN {}'.format(current_turn),
+              'The popularity of {} is expected to {} for Turn {}.'.format(
+                 self.HERO_TOWN_KEYWORDS[hero_town], change, target_turn)]
+
+   def _make_word(self, text: str, x: int, y: int, is_last: bool) -> dict:
+      symbols = [{'text': char} for char in text]
+      break_type = self.BREAK_TYPES.EOL_SURE_SPACE if is_last else self.BREAK_TYPES.SPACE
+      symbols[-1]['property'] = {'detected_break': {'type_': break_type}}
+      vertices = [{'x': x - 2, 'y': y - 2}, {'x': x + 2, 'y': y - 2}, {'x': x + 2, 'y': y + 2}, {'x': x - 2, 'y': y + 2}]
+      return {'symbols': symbols, 'bounding_box': {'vertices': vertices}}
+
+
+class FakeWorksheet(object):
+   # Stand-in for a gspread worksheet. Calls block their (executor) thread like the real ones.
+   def __init__(self, rng: random.Random, latency: float, current_turn: int) -> None:
+      self.id = 0
+      self._rng = rng
+      self._latency = latency
+      self._current_turn = current_turn
+      self._lock = threading.Lock()
+      self.price_writes = []
+
+   def batch_get(self, ranges: list[str]) -> list[list[list[str]]]:
+      time.sleep(self._latency)
+      with self._lock:
+         # Known prices up to the current turn, and a few tips after it.
+         return [[[str(self._rng.randint(500, 1500))] if (turn <= self._current_turn) or (self._rng.random() < 0.2) else []
+                  for turn in range(1, self._current_turn + 10)] for _ in ranges]
+
+   def update(self, cell: str, value: str, raw: bool = True) -> None:
+      time.sleep(self._latency)
+      re_match = HYPERLINK_REGEX.search(value)
+      if re_match:
+         with self._lock:
+            self.price_writes.append((time.perf_counter(), re_match.group('url')))
+
+   def format(self, cell: str, cell_format: dict) -> None:
+      time.sleep(self._latency)
+
+
+class FakeRole(object):
+   def __init__(self, name: str) -> None:
+      self.name = name
+      self.mention = '@{}'.format(name)
+
+
+class FakeAuthor(object):
+   def __init__(self, author_id: int, roles: list[FakeRole]) -> None:
+      self.id = author_id
+      self.name = 'member-{}'.format(author_id)
+      self.roles = roles
+
+
+class FakeChannel(object):
+   def __init__(self, channel_id: int, name: str, messages: list['FakeMessage'] = ()) -> None:
+      self.id = channel_id
+      self.name = name
+      self._messages = list(messages)
+
+   async def history(self, limit: int):
+      for message in self._messages[:limit]:
+         yield message
+
+
+class FakeGuild(object):
+   def __init__(self, guild_id: int, roles: list[FakeRole], text_channels: list[FakeChannel] = ()) -> None:
+      self.id = guild_id
+      self.roles = roles
+      self.text_channels = list(text_channels)
+      self.threads = []
+
+
+class FakeAttachment(object):
+   def __init__(self, url: str, data: bytes, latency: float) -> None:
+      self.url = url
+      self.filename = os.path.basename(url)
+      self.content_type = 'image/png' if url.endswith('.png') else 'image/jpeg'
+      self.size = len(data)
+      self._data = data
+      self._latency = latency
+
+   async def read(self) -> bytes:
+      await asyncio.sleep(self._latency)
+      return self._data
+
+
+class FakeMessage(object):
+   def __init__(self, harness: 'LoadHarness', message_id: int, channel: FakeChannel, guild: FakeGuild,
+                author: FakeAuthor, attachments: list[FakeAttachment], content: str = '') -> None:
+      self._harness = harness
+      self.id = message_id
+      self.channel = channel
+      self.guild = guild
+      self.author = author
+      self.attachments = attachments
+      self.content = content
+      self.reactions = []
+
+   async def reply(self, content: str = None, embed=None, mention_author: bool = False) -> None:
+      await asyncio.sleep(self._harness.discord_latency)
+      self._harness.on_reply(self)
+
+   async def add_reaction(self, emoji) -> None:
+      await asyncio.sleep(self._harness.discord_latency)
+
+
+class FakeContext(object):
+   def __init__(self, message: FakeMessage, command) -> None:
+      self.message = message
+      self.channel = message.channel
+      self.guild = message.guild
+      self.author = message.author
+      self.command = command
+
+
+class FakeBot(object):
+   def __init__(self) -> None:
+      self.user = object()
+      self.emojis = []
+      self.guilds = []
+
+   def add_view(self, view, message_id: int) -> None:
+      pass
+
+   def dispatch(self, event_name: str, *args) -> None:
+      pass
+
+
+class LoadHarness(object):
+   # Drives the cogs of a real (but never logged in) DiscordBot, with its Discord, Vision and
+   # Sheets sides replaced by local stand-ins.
+   LAG_SAMPLE_INTERVAL = 0.005
+
+   def __init__(self, args: argparse.Namespace) -> None:
+      self._args = args
+      self._rng = random.Random(args.seed)
+      self.discord_latency = 0.05
+      # Make the event current, so commands have prices to work with.
+      starting_time = int(time.time()) - 3600 * (args.current_turn - 1) - 60
+      config.set('stonk-sheet-querier', 'starting_time', str(starting_time))
+      if args.no_ocr_hedging:
+         config.set('tip-recognizer', 'ocr_hedging', 'false')
+      if args.no_vision_rate_limits:
+         for key in ('guild_images_per_minute', 'guild_burst', 'global_images_per_minute', 'global_burst'):
+            config.set('vision-quota', key, '1000000')
+      from discord_bot import DiscordBot
+      self._discord_bot = DiscordBot()
+      self._loop = asyncio.get_event_loop()
+      self._bot = FakeBot()
+      self._tip_cog = self._discord_bot._bot.get_cog('TipProcessingCog')
+      self._helper_cog = self._discord_bot._bot.get_cog('SheetHelperCog')
+      self._tip_cog.bot = self._bot
+      self._helper_cog.bot = self._bot
+      self._vision_client = FakeVisionClient(
+         self._rng, args.vision_latency, args.vision_jitter, args.vision_error_rate, args.vision_exception_rate,
+         args.vision_stall_rate, config.getint('stonk-sheet-base', 'max_turn'))
+      self._tip_cog._tip_pipeline.tip_recognizer._gvision_client = self._vision_client
+      self._worksheet = FakeWorksheet(self._rng, args.sheet_latency, args.current_turn)
+      io_timeout = config.getfloat('stonk-sheet-base', 'io_timeout')
+      for sheet_client in list(self._tip_cog._tip_pipeline.sheet_updaters.values()) + list(self._helper_cog._sheet_queriers.values()):
+         sheet_client._sheet = AsyncWorksheet(lambda: self._worksheet, StonkSheetBase._io_executor, io_timeout)
+      self._tip_channel = BasicUtils.get_list_from_csv(config.get('discord-bot', 'tip_posting_channels'))[0]
+      self._query_channel = BasicUtils.get_list_from_csv(config.get('discord-bot', 'tip_querying_channels'))[0]
+      self._roles = [FakeRole(name) for name in
+                     BasicUtils.get_list_from_csv(config.get('discord-bot', 'failed_tip_mention_roles'))]
+      self._guild = FakeGuild(1, self._roles)
+      self._samples = []
+      for filepath in sorted(glob.glob(os.path.join(SAMPLES_DIR, '*', '*'))):
+         with open(filepath, 'rb') as file:
+            self._samples.append((filepath.removeprefix(SAMPLES_DIR), file.read()))
+      self._next_id = 1
+
+   def run(self) -> None:
+      # Start the worker processes (and "open" the sheets) first, like the bot does while logging in.
+      self._tip_cog.warm_up()
+      self._helper_cog.warm_up()
+      scenarios = ['backfill', 'flood', 'commands'] if self._args.scenario == 'all' else [self._args.scenario]
+      for scenario in scenarios:
+         self._loop.run_until_complete(self._run_scenario(scenario))
+      if self._tip_cog._deferred_retry_task:
+         self._tip_cog._deferred_retry_task.cancel()
+      # Blocking regressions show up here, with the stack they were caught at.
+      loop_watchdog.stop()
+      for line in loop_watchdog.get_report():
+         log.info(line)
+
+   def on_reply(self, message: FakeMessage) -> None:
+      self._reply_times[message.id] = time.perf_counter()
+
+   async def _run_scenario(self, scenario: str) -> None:
+      self._dispatch_times = {}
+      self._url_dispatch_times = {}
+      self._reply_times = {}
+      self._command_ids = set()
+      self._tasks = []
+      self._lag_samples = []
+      self._worksheet.price_writes = []
+      vision_requests = self._vision_client.request_count
+      vision_errors = self._vision_client.error_count
+      deferred_key = self._tip_cog.DEFERRED_MESSAGES_SAVE_KEY
+      deferred_count = simple_saver.count_items(deferred_key)
+      lag_task = asyncio.ensure_future(self._sample_loop_lag())
+      loop_watchdog.start()
+      start = time.perf_counter()
+      if scenario == 'backfill':
+         await self._run_backfill()
+      elif scenario == 'flood':
+         await self._run_flood()
+      elif scenario == 'commands':
+         await self._run_command_spike()
+      results = await asyncio.gather(*self._tasks, return_exceptions=True)
+      elapsed = time.perf_counter() - start
+      lag_task.cancel()
+      self._report(scenario, elapsed, [result for result in results if isinstance(result, Exception)],
+                   self._vision_client.request_count - vision_requests, self._vision_client.error_count - vision_errors,
+                   simple_saver.count_items(deferred_key) - deferred_count)
+
+   async def _run_backfill(self) -> None:
+      # Restart: the bot catches up with the channel's history when ready, one message after another.
+      messages = [self._make_tip_message() for _ in range(self._args.messages)]
+      for message in messages:
+         self._dispatch_times[message.id] = time.perf_counter()
+      self._bot.guilds = [FakeGuild(self._guild.id, self._roles, [FakeChannel(1, self._tip_channel, messages)])]
+      self._tasks.append(asyncio.ensure_future(self._tip_cog.on_ready()))
+
+   async def _run_flood(self) -> None:
+      # Tips posted by many members at once, each dispatched to its own task like discord.py does.
+      for _ in range(self._args.messages):
+         message = self._make_tip_message()
+         self._dispatch_times[message.id] = time.perf_counter()
+         self._tasks.append(asyncio.ensure_future(self._tip_cog.on_message(message)))
+         await asyncio.sleep(self._rng.expovariate(self._args.message_rate))
+
+   async def _run_command_spike(self) -> None:
+      # Everyone asking for the best buy right after a new round, with a few tips still coming in.
+      commands = [(self._helper_cog.bestbuy, ()), (self._helper_cog.targetbuy, ('1', '3')),
+                  (self._helper_cog.tips, ('all',)), (self._helper_cog.round, ())]
+      for idx in range(self._args.commands):
+         command, command_args = self._rng.choice(commands)
+         message = FakeMessage(self, self._get_next_id(), FakeChannel(2, self._query_channel), self._guild,
+                               FakeAuthor(self._rng.randint(1, 1000), self._roles), [])
+         self._command_ids.add(message.id)
+         self._dispatch_times[message.id] = time.perf_counter()
+         self._tasks.append(asyncio.ensure_future(
+            command.callback(self._helper_cog, FakeContext(message, command), *command_args)))
+         if idx % 20 == 0:
+            tip_message = self._make_tip_message()
+            self._dispatch_times[tip_message.id] = time.perf_counter()
+            self._tasks.append(asyncio.ensure_future(self._tip_cog.on_message(tip_message)))
+         await asyncio.sleep(self._rng.expovariate(self._args.command_rate))
+
+   async def _sample_loop_lag(self) -> None:
+      while True:
+         start = self._loop.time()
+         await asyncio.sleep(self.LAG_SAMPLE_INTERVAL)
+         self._lag_samples.append(max(0.0, self._loop.time() - start - self.LAG_SAMPLE_INTERVAL))
+
+   def _make_tip_message(self) -> FakeMessage:
+      message_id = self._get_next_id()
+      attachments = []
+      for idx in range(self._rng.randint(1, self._args.max_attachments)):
+         name, data = self._rng.choice(self._samples)
+         url = 'https://cdn.example.com/{}/{}{}'.format(message_id, idx, name.replace('/', '-'))
+         attachments.append(FakeAttachment(url, data, self._args.download_latency))
+         self._url_dispatch_times[url] = message_id
+      return FakeMessage(self, message_id, FakeChannel(1, self._tip_channel), self._guild,
+                         FakeAuthor(self._rng.randint(1, 1000), self._roles), attachments)
+
+   def _get_next_id(self) -> int:
+      self._next_id += 1
+      return self._next_id
+
+   def _report(self, scenario: str, elapsed: float, exceptions: list[Exception],
+               vision_requests: int, vision_errors: int, deferred_count: int) -> None:
+      tip_message_ids = [message_id for message_id in self._dispatch_times if message_id not in self._command_ids]
+      sheet_latencies = [write_time - self._dispatch_times[self._url_dispatch_times[url]]
+                         for write_time, url in self._worksheet.price_writes if url in self._url_dispatch_times]
+      reply_latencies = [self._reply_times[message_id] - self._dispatch_times[message_id]
+                         for message_id in tip_message_ids if message_id in self._reply_times]
+      command_latencies = [self._reply_times[message_id] - self._dispatch_times[message_id]
+                           for message_id in self._command_ids if message_id in self._reply_times]
+      log.info('Scenario "{}" completed in {:.2f}s'.format(scenario, elapsed))
+      log.info('  Tip messages: count={}, replied={}, deferred={}, throughput={:.1f}/s'.format(
+         len(tip_message_ids), len(reply_latencies), deferred_count, len(reply_latencies) / elapsed))
+      log.info('  Sheet writes: count={}, throughput={:.1f}/s, latency_p50={:.3f}s, latency_p99={:.3f}s'.format(
+         len(sheet_latencies), len(sheet_latencies) / elapsed,
+         get_percentile(sheet_latencies, 50), get_percentile(sheet_latencies, 99)))
+      log.info('  Message to reply: latency_p50={:.3f}s, latency_p99={:.3f}s'.format(
+         get_percentile(reply_latencies, 50), get_percentile(reply_latencies, 99)))
+      if self._command_ids:
+         log.info('  Commands: count={}, replied={}, latency_p50={:.3f}s, latency_p99={:.3f}s'.format(
+            len(self._command_ids), len(command_latencies),
+            get_percentile(command_latencies, 50), get_percentile(command_latencies, 99)))
+      log.info('  Vision: requests={}, errors={}'.format(vision_requests, vision_errors))
+      log.info('  {}'.format(self._tip_cog._tip_pipeline.tip_recognizer.get_ocr_latency_msg()))
+      log.info('  {}'.format(image_memory_budget.get_usage_msg()))
+      log.info('  Event loop lag: p50={:.1f}ms, p99={:.1f}ms, max={:.1f}ms'.format(
+         1000 * get_percentile(self._lag_samples, 50), 1000 * get_percentile(self._lag_samples, 99),
+         1000 * max(self._lag_samples, default=0)))
+      if exceptions:
+         log.info('  Unhandled exceptions: count={}, first={}'.format(len(exceptions), repr(exceptions[0])))
+
+
+def main() -> None:
+   args = parse_args()
+   stream_handler.setLevel(logging.INFO if args.verbose else logging.CRITICAL)
+   # The harness' own report is always shown.
+   report_handler = logging.StreamHandler()
+   report_handler.setFormatter(logger_factory.formatter)
+   log.addHandler(report_handler)
+   log.propagate = False
+   LoadHarness(args).run()
+
+
+if __name__ == '__main__':
+   main()